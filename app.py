@@ -2,7 +2,10 @@ import os
 import streamlit as st
 import time
 import json
+from contextlib import contextmanager
 from gmail_service import GmailService
+from index_manager import IndexManager
+from metrics import metrics, LogSink, PrometheusSink
 from rag_engine import RAGEngine
 from utils import save_uploaded_file, get_sample_emails
 
@@ -24,48 +27,86 @@ if "authenticated" not in st.session_state:
 if "gmail_service" not in st.session_state:
     st.session_state.gmail_service = None
 
-if "rag_engine" not in st.session_state:
-    st.session_state.rag_engine = None
+# The signed-in Gmail address; its engine is shared by every session for it
+if "account" not in st.session_state:
+    st.session_state.account = None
+
+if "demo_engine" not in st.session_state:
+    st.session_state.demo_engine = None
 
 if "email_count" not in st.session_state:
     st.session_state.email_count = 0
 
+if "pending_question" not in st.session_state:
+    st.session_state.pending_question = None
+
+if "indexing_job" not in st.session_state:
+    st.session_state.indexing_job = None
+
+@st.cache_resource
+def get_index_manager():
+    """Process-wide manager of per-account indexes, shared by all sessions"""
+    memory_budget_mb = int(os.getenv('INDEX_MEMORY_BUDGET_MB', '1024'))
+    # Compressed vectors let more accounts fit in the budget, re-ranked at full precision
+    engine_options = {
+        'quantization': os.getenv('INDEX_QUANTIZATION') or None,
+        'search_dimension': int(os.getenv('INDEX_DIMENSIONS', '0')) or None
+    }
+    return IndexManager(root="indexes", memory_budget_mb=memory_budget_mb, engine_options=engine_options)
+
+@st.cache_resource
+def setup_metrics():
+    """Attach the metrics sinks configured in the environment, once per server process"""
+    # Print any stage slower than this many seconds
+    log_seconds = os.getenv('METRICS_LOG_SECONDS')
+    if log_seconds:
+        metrics.add_sink(LogSink(min_seconds=float(log_seconds)))
+    # Serve Prometheus metrics at /metrics on this port
+    port = os.getenv('METRICS_PORT')
+    if port:
+        metrics.add_sink(PrometheusSink()).serve(int(port))
+    return metrics
+
+setup_metrics()
+
+def current_engine():
+    """The engine answering this session's questions, or None before connecting"""
+    if st.session_state.account is not None:
+        # Fetched on every use rather than kept in the session, so idle accounts can be evicted
+        return get_index_manager().get(st.session_state.account, st.session_state.gmail_service)
+    return st.session_state.demo_engine
+
+@contextmanager
+def engine_in_use():
+    """The session's engine, kept loaded until the block ends"""
+    if st.session_state.account is not None:
+        with get_index_manager().use(st.session_state.account, st.session_state.gmail_service) as rag_engine:
+            yield rag_engine
+    else:
+        yield st.session_state.demo_engine
+
 def authenticate_gmail():
     """Handle Gmail authentication process"""
     try:
         credentials_file = "credentials.json"
-        st.session_state.gmail_service = GmailService(credentials_file)
+        # Parsing HTML-heavy mailboxes is CPU-bound, so it can be spread over worker processes
+        parse_processes = int(os.getenv('PARSE_PROCESSES', '0'))
+        st.session_state.gmail_service = GmailService(credentials_file, parse_processes=parse_processes)
         user_info = st.session_state.gmail_service.get_user_profile()
         
         st.session_state.authenticated = True
         st.session_state.messages.append(
-            {"role": "assistant", "content": f"Successfully connected to Gmail account: {user_info['emailAddress']}. I'm now indexing your emails..."}
+            {"role": "assistant", "content": f"Successfully connected to Gmail account: {user_info['emailAddress']}. I'm now indexing your emails in the background; you can ask questions about the ones indexed so far while it runs."}
         )
         
-        # Initialize RAG engine with Gmail service
-        st.session_state.rag_engine = RAGEngine(st.session_state.gmail_service)
+        # Load the account's index, or share it if another session already has
+        st.session_state.account = user_info['emailAddress']
+        st.session_state.email_count = len(current_engine().store)
         
-        # Fetch and index emails
-        with st.spinner("Indexing your emails... This may take a few minutes depending on your inbox size."):
-            try:
-                email_count = st.session_state.rag_engine.index_emails(limit=100)  # Index the most recent 100 emails
-                st.session_state.email_count = email_count
-                
-                if email_count > 0:
-                    st.session_state.messages.append(
-                        {"role": "assistant", "content": f"Indexed {email_count} emails. You can now ask questions about your emails!"}
-                    )
-                else:
-                    st.session_state.messages.append(
-                        {"role": "assistant", "content": "No emails were found or indexed. Please check your Gmail account and try again."}
-                    )
-            except Exception as e:
-                st.error(f"Error indexing emails: {str(e)}")
-                import traceback
-                st.code(traceback.format_exc())
-                st.session_state.messages.append(
-                    {"role": "assistant", "content": f"There was an error indexing your emails: {str(e)}. You may still try asking questions, but results might be limited."}
-                )
+        # Index the most recent 100 emails without blocking the UI; an
+        # interrupted earlier run picks up from its last checkpoint
+        st.session_state.indexing_job = get_index_manager().start_indexing(
+            st.session_state.account, st.session_state.gmail_service, limit=100)
         
         st.rerun()
     except Exception as e:
@@ -73,6 +114,104 @@ def authenticate_gmail():
         import traceback
         st.code(traceback.format_exc())
 
+def show_metrics():
+    """Show stage timings, token use, Gmail quota and cache hit rates for this server process"""
+    stages = metrics.snapshot()['histograms'].get('stage_seconds', {})
+    if not stages:
+        return
+    
+    with st.expander("Performance metrics"):
+        st.table([
+            {
+                "stage": dict(labels).get('stage'),
+                "calls": summary['count'],
+                "p50 ms": round(summary['p50'] * 1000, 1),
+                "p99 ms": round(summary['p99'] * 1000, 1),
+                "total s": round(summary['sum'], 1)
+            }
+            for labels, summary in sorted(stages.items())
+        ])
+        st.caption(f"OpenAI tokens: {metrics.counter('openai_tokens_total', type='prompt'):.0f} prompt, "
+                   f"{metrics.counter('openai_tokens_total', type='completion'):.0f} completion")
+        st.caption(f"Gmail quota units: {metrics.counter('gmail_quota_units_total'):.0f}, "
+                   f"rate limit waits: {metrics.counter('rate_limit_wait_seconds_total'):.1f}s")
+        for cache in ('embedding', 'query_embedding', 'answer'):
+            hits = metrics.counter('cache_lookups_total', cache=cache, result='hit')
+            lookups = hits + metrics.counter('cache_lookups_total', cache=cache, result='miss')
+            if lookups:
+                st.caption(f"{cache.replace('_', ' ').capitalize()} cache hit rate: {hits / lookups:.0%} of {lookups:.0f}")
+
+@st.fragment(run_every=2)
+def show_indexing_progress():
+    """Show the background indexing job's progress, refreshing until it finishes"""
+    job = st.session_state.indexing_job
+    if job is None:
+        return
+    
+    progress = job.progress.snapshot()
+    st.session_state.email_count = len(job.rag_engine.store)
+    if job.running:
+        text = "Refreshing email index..." if job.sync else "Indexing emails..."
+        if job.limit:
+            st.progress(min(progress['indexed'] / job.limit, 1.0), text=text)
+        else:
+            st.write(text)
+        st.caption(f"Fetched {progress['fetched']}, parsed {progress['parsed']}, "
+                   f"embedded {progress['embedded']}, indexed {progress['indexed']} "
+                   f"in {progress['elapsed']:.0f}s")
+        return
+    
+    # Report how the job ended once, then refresh the whole page
+    st.session_state.indexing_job = None
+    if job.status == 'failed':
+        content = f"There was an error indexing your emails: {str(job.error)}. You may still try asking questions, but results might be limited."
+    elif job.status == 'cancelled':
+        content = f"Indexing paused with {st.session_state.email_count} emails indexed. It will resume where it stopped next time."
+    elif job.sync:
+        content = f"Refreshed index with {st.session_state.email_count} emails."
+    elif st.session_state.email_count > 0:
+        content = f"Indexed {st.session_state.email_count} emails. You can now ask questions about your emails!"
+    else:
+        content = "No emails were found or indexed. Please check your Gmail account and try again."
+    st.session_state.messages.append({"role": "assistant", "content": content})
+    st.rerun()
+
+def format_sources(emails):
+    """Describe the emails an answer is based on in one line"""
+    return "Based on: " + "; ".join(f"{email['subject']} ({email['sender']})" for email in emails)
+
+def answer_question(question):
+    """Show a question in the chat and stream its answer in as it is generated"""
+    with st.chat_message("user"):
+        st.write(question)
+    
+    with st.chat_message("assistant"):
+        try:
+            sources_placeholder = st.empty()
+            sources = []
+            
+            def tokens(rag_engine):
+                for kind, value in rag_engine.query_stream(question):
+                    if kind == 'sources':
+                        # Shown as soon as retrieval finishes, before the first token
+                        sources.extend(value)
+                        sources_placeholder.caption(format_sources(value))
+                    else:
+                        yield value
+            
+            with engine_in_use() as rag_engine:
+                response = st.write_stream(tokens(rag_engine))
+            message = {"role": "assistant", "content": response}
+            if sources:
+                message["sources"] = format_sources(sources)
+            st.session_state.messages.append(message)
+        except Exception as e:
+            error_msg = f"Error processing query: {str(e)}"
+            st.error(error_msg)
+            import traceback
+            st.code(traceback.format_exc())
+            st.session_state.messages.append({"role": "assistant", "content": error_msg})
+
 # Main app layout
 st.title("📬 Gmail RAG Assistant")
 
@@ -99,11 +238,10 @@ with st.sidebar:
                     # Get sample emails and set up RAG engine directly
                     try:
                         sample_emails = get_sample_emails()
-                        st.session_state.rag_engine = RAGEngine(None)  # No Gmail service in demo mode
-                        st.session_state.rag_engine.emails = sample_emails
+                        st.session_state.demo_engine = RAGEngine(None)  # No Gmail service in demo mode
                         
                         # Create a FAISS index with the sample emails
-                        email_count = st.session_state.rag_engine._create_index_from_samples(sample_emails)
+                        email_count = st.session_state.demo_engine._create_index_from_samples(sample_emails)
                         st.session_state.email_count = email_count
                         st.success(f"Successfully loaded {email_count} sample emails for demo mode")
                     except Exception as e:
@@ -124,23 +262,51 @@ with st.sidebar:
     else:
         st.success(f"✅ Connected to Gmail")
         st.write(f"Indexed emails: {st.session_state.email_count}")
+        show_indexing_progress()
+        rag_engine = current_engine()
+        if rag_engine:
+            cache_stats = rag_engine.embedding_cache.stats()
+            st.caption(f"Embedding cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
+            answer_stats = rag_engine.answer_cache.stats()
+            st.caption(f"Answer cache: {answer_stats['hits']} hits, {answer_stats['misses']} misses")
+            dedup_stats = rag_engine.near_duplicates.stats()
+            st.caption(f"Near-duplicates skipped: {dedup_stats['duplicates']} ({dedup_stats['dedup_ratio']:.0%})")
+            if rag_engine.index_quality is not None:
+                quality = rag_engine.index_quality
+                st.caption(f"Vector index: {quality['compression']:.1f}x compressed, "
+                           f"recall@{quality['k']} {quality['recall']:.3f}")
+        if st.session_state.account is not None:
+            manager_stats = get_index_manager().stats()
+            st.caption(f"Loaded indexes: {manager_stats['accounts']} using {manager_stats['memory_mb']:.0f} "
+                       f"of {manager_stats['budget_mb']:.0f} MB")
+        show_metrics()
         
-        if st.button("Refresh Email Index"):
-            with st.spinner("Refreshing email index..."):
-                email_count = st.session_state.rag_engine.index_emails(limit=100, force_refresh=True)
-                st.session_state.email_count = email_count
+        # Another session signed in to the same account may be indexing it
+        indexing = st.session_state.indexing_job is not None or (
+            st.session_state.account is not None and get_index_manager().job(st.session_state.account) is not None)
+        if st.button("Refresh Email Index", disabled=indexing):
+            if st.session_state.account is not None:
+                # Sync in the background like the first indexing run, since
+                # an expired history ID means re-indexing the whole mailbox
+                st.session_state.indexing_job = get_index_manager().start_indexing(
+                    st.session_state.account, st.session_state.gmail_service, limit=100, sync=True)
+            else:
+                # Demo mode has nothing to sync
                 st.session_state.messages.append(
-                    {"role": "assistant", "content": f"Refreshed index with {email_count} emails."}
+                    {"role": "assistant", "content": f"Refreshed index with {st.session_state.email_count} emails."}
                 )
-                st.rerun()
+            st.rerun()
                 
         if st.button("Logout"):
-            # Clear session state and remove token file
+            # Clear session state and remove token file; the account's index
+            # stays loaded for other sessions until it is evicted
             if os.path.exists("token.json"):
                 os.remove("token.json")
             st.session_state.authenticated = False
             st.session_state.gmail_service = None
-            st.session_state.rag_engine = None
+            st.session_state.account = None
+            st.session_state.demo_engine = None
+            st.session_state.indexing_job = None
             st.session_state.messages = [
                 {"role": "assistant", "content": "You've been logged out. Upload your credentials again to reconnect."}
             ]
@@ -157,19 +323,11 @@ with st.sidebar:
     
     for q in sample_questions:
         if st.button(q):
-            st.session_state.messages.append({"role": "user", "content": q})
-            if st.session_state.authenticated and st.session_state.rag_engine:
-                try:
-                    with st.spinner("Thinking..."):
-                        response = st.session_state.rag_engine.query(q)
-                    st.session_state.messages.append({"role": "assistant", "content": response})
-                except Exception as e:
-                    error_msg = f"Error processing query: {str(e)}"
-                    st.error(error_msg)
-                    import traceback
-                    st.code(traceback.format_exc())
-                    st.session_state.messages.append({"role": "assistant", "content": error_msg})
+            if st.session_state.authenticated and current_engine():
+                # Answered in the chat area below so the reply can stream in there
+                st.session_state.pending_question = q
             else:
+                st.session_state.messages.append({"role": "user", "content": q})
                 st.session_state.messages.append(
                     {"role": "assistant", "content": "Please connect to Gmail first!"}
                 )
@@ -181,24 +339,24 @@ st.header("Chat with your Gmail")
 # Display chat messages
 for message in st.session_state.messages:
     with st.chat_message(message["role"]):
+        if message.get("sources"):
+            st.caption(message["sources"])
         st.write(message["content"])
 
+# Answer a sample question picked in the sidebar
+if st.session_state.pending_question:
+    question = st.session_state.pending_question
+    st.session_state.pending_question = None
+    st.session_state.messages.append({"role": "user", "content": question})
+    answer_question(question)
+
 # Chat input
 if prompt := st.chat_input("Ask a question about your emails..."):
     st.session_state.messages.append({"role": "user", "content": prompt})
     
     # Only process if authenticated
-    if st.session_state.authenticated and st.session_state.rag_engine:
-        try:
-            with st.spinner("Searching your emails..."):
-                response = st.session_state.rag_engine.query(prompt)
-            st.session_state.messages.append({"role": "assistant", "content": response})
-        except Exception as e:
-            error_msg = f"Error processing query: {str(e)}"
-            st.error(error_msg)
-            import traceback
-            st.code(traceback.format_exc())
-            st.session_state.messages.append({"role": "assistant", "content": error_msg})
+    if st.session_state.authenticated and current_engine():
+        answer_question(prompt)
     else:
         st.session_state.messages.append(
             {"role": "assistant", "content": "Please connect to Gmail first by uploading your credentials.json file in the sidebar!"}
@@ -0,0 +1,31 @@
+import asyncio
+import threading
+import weakref
+
+class LoopLocal:
+    def __init__(self, factory):
+        """Initialize a holder that keeps one factory() object per event loop.
+        
+        Async HTTP clients and semaphores belong to the event loop they are
+        first used on, while Streamlit sessions and worker threads each run
+        their own loop. Each loop gets its own instance, dropped when the
+        loop is garbage collected.
+        """
+        self.factory = factory
+        self._values = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+    
+    def get(self):
+        """Return the object for the running event loop, creating it on first use."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            value = self._values.get(loop)
+            if value is None:
+                value = self._values[loop] = self.factory()
+            return value
+    
+    def pop(self):
+        """Forget and return the running loop's object, or None if it has none."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            return self._values.pop(loop, None)
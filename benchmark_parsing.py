@@ -0,0 +1,123 @@
+import argparse
+import base64
+import glob
+import os
+import random
+import time
+from email import message_from_bytes, policy
+from fake_apis import WORDS
+from gmail_service import GmailService
+from html_text import fast_html_to_text, soup_html_to_text, html_to_text
+from parse_pool import ParsePool
+
+def synthetic_html(size_kb, seed):
+    """Build a newsletter-style HTML email of roughly size_kb kilobytes."""
+    rng = random.Random(seed)
+    rows = []
+    while sum(len(row) for row in rows) < size_kb * 1024:
+        words = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(8, 40)))
+        rows.append(
+            f'<tr><td style="padding:8px;font-family:Arial,sans-serif;color:#333333">'
+            f'<a href="https://example.com/{rng.randint(0, 10**6)}">{words.title()}</a>'
+            f'<p>{words} &amp; {rng.choice(WORDS)} &#8211; ${rng.randint(1, 999)}.00</p></td></tr>')
+    return (
+        '<!DOCTYPE html><html><head><title>Newsletter</title>'
+        '<style>td { padding: 0 } .hidden { display: none }</style></head><body>'
+        '<!--[if mso]><table><tr><td><![endif]-->'
+        f'<table width="600" cellpadding="0" cellspacing="0">{"".join(rows)}</table>'
+        '<script>var tracking = "pixel";</script></body></html>')
+
+def load_corpus(path):
+    """Read HTML bodies from .html files and the HTML parts of .eml files under path."""
+    bodies = []
+    for file_path in sorted(glob.glob(os.path.join(path, '**', '*'), recursive=True)):
+        if file_path.endswith(('.html', '.htm')):
+            with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
+                bodies.append(f.read())
+        elif file_path.endswith('.eml'):
+            with open(file_path, 'rb') as f:
+                message = message_from_bytes(f.read(), policy=policy.default)
+            part = message.get_body(preferencelist=('html',))
+            if part is not None:
+                bodies.append(part.get_content())
+    return bodies
+
+def gmail_message(index, html_content):
+    """Wrap an HTML body the way the Gmail API returns it, nested in multipart/mixed."""
+    data = base64.urlsafe_b64encode(html_content.encode('utf-8')).decode('ascii').rstrip('=')
+    return {
+        'id': f'bench{index}',
+        'threadId': f'bench{index}',
+        'snippet': '',
+        'labelIds': ['INBOX'],
+        'payload': {
+            'mimeType': 'multipart/mixed',
+            'headers': [{'name': 'Subject', 'value': f'Benchmark {index}'}],
+            'parts': [
+                {'mimeType': 'multipart/alternative', 'parts': [
+                    {'mimeType': 'text/html',
+                     'headers': [{'name': 'Content-Type', 'value': 'text/html; charset="utf-8"'}],
+                     'body': {'data': data}}
+                ]},
+                {'mimeType': 'application/pdf', 'filename': 'invoice.pdf',
+                 'body': {'attachmentId': 'att1', 'size': 1024}}
+            ]
+        }
+    }
+
+def time_function(func, items, repeat):
+    """Return the best wall-clock time in seconds of running func over every item."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in items:
+            func(item)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark HTML email parsing.")
+    parser.add_argument('corpus', nargs='?',
+                        help="Directory of .html or .eml files; synthetic emails are used if omitted")
+    parser.add_argument('--count', type=int, default=200, help="Number of synthetic emails")
+    parser.add_argument('--size-kb', type=int, default=100, help="Size of each synthetic email")
+    parser.add_argument('--repeat', type=int, default=3, help="Timing runs, the best is reported")
+    parser.add_argument('--processes', type=int, nargs='*', default=[],
+                        help="Also time parsing in a pool of this many worker processes")
+    args = parser.parse_args()
+    
+    if args.corpus:
+        bodies = load_corpus(args.corpus)
+        if not bodies:
+            print(f"No HTML emails found in {args.corpus}")
+            return
+    else:
+        bodies = [synthetic_html(args.size_kb, seed) for seed in range(args.count)]
+    
+    total_mb = sum(len(body) for body in bodies) / (1024 * 1024)
+    fallbacks = sum(1 for body in bodies if fast_html_to_text(body) is None)
+    print(f"{len(bodies)} emails, {total_mb:.1f} MB of HTML, {fallbacks} need the BeautifulSoup fallback")
+    
+    # get_message_content doesn't touch the Gmail connection, so skip authentication
+    service = GmailService.__new__(GmailService)
+    messages = [gmail_message(i, body) for i, body in enumerate(bodies)]
+    
+    results = [
+        ('BeautifulSoup', time_function(soup_html_to_text, bodies, args.repeat)),
+        ('fast path', time_function(fast_html_to_text, bodies, args.repeat)),
+        ('html_to_text', time_function(html_to_text, bodies, args.repeat)),
+        ('get_message_content', time_function(service.get_message_content, messages, args.repeat))
+    ]
+    for processes in args.processes:
+        pool = ParsePool(processes)
+        # Start the workers before timing
+        list(pool.imap(messages[:processes * pool.chunk_size]))
+        results.append((f'{processes} processes', time_function(lambda batch: list(pool.imap(batch)), [messages], args.repeat)))
+        pool.close()
+    
+    baseline = results[0][1]
+    for name, seconds in results:
+        print(f"{name:>20}: {seconds:8.3f}s  {total_mb / seconds:8.1f} MB/s  {baseline / seconds:6.1f}x")
+
+if __name__ == "__main__":
+    main()
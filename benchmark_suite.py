@@ -0,0 +1,249 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from fake_apis import FakeGmailServer, FakeOpenAIServer, SyntheticMailbox, TOPIC_WORDS
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Report figures compared by --baseline, and whether a higher value is better
+REGRESSION_METRICS = (
+    ('messages_per_second', True),
+    ('query_p50_ms', False),
+    ('query_p99_ms', False),
+    ('peak_rss_mb', False),
+)
+
+def benchmark_gmail_service(api_root, rate_limiter, parse_processes=0):
+    """A GmailService that talks to a fake Gmail server at api_root without OAuth."""
+    import httplib2
+    from googleapiclient.discovery import build_from_document
+    from googleapiclient.discovery_cache import get_static_doc
+    from gmail_service import GmailService
+    
+    # Batch requests go to the document's rootUrl, so point the whole document at the fake server
+    document = json.loads(get_static_doc('gmail', 'v1'))
+    document['rootUrl'] = document['mtlsRootUrl'] = f"{api_root}/"
+    document['baseUrl'] = f"{api_root}/{document['servicePath']}"
+    
+    class BenchmarkGmailService(GmailService):
+        def authenticate(self):
+            self.creds = None
+            return self._build_service()
+        
+        def _build_service(self):
+            return build_from_document(document, http=httplib2.Http(timeout=60))
+    
+    return BenchmarkGmailService(None, rate_limiter=rate_limiter, parse_processes=parse_processes)
+
+def synthetic_queries(count, seed):
+    """Questions about the synthetic mailbox, mixing topics with sender and date filters."""
+    rng = random.Random(seed)
+    templates = (
+        "What did people say about the {0} {1}?",
+        "Find emails about {0} and {1} from last month",
+        "Summarize the latest {0} updates",
+        "Any emails from acme.io about {0}?",
+        "When is the next {0} {1}?",
+    )
+    return [rng.choice(templates).format(rng.choice(TOPIC_WORDS), rng.choice(TOPIC_WORDS)) for _ in range(count)]
+
+def run_benchmark(size, gmail_url, openai_url, options):
+    """Index a mailbox of size emails and time queries against it; runs in a fresh process.
+    
+    Runs in a temporary working directory so the embedding cache and index
+    files from earlier runs can't make this one faster.
+    """
+    os.environ['OPENAI_API_KEY'] = "benchmark"
+    os.environ['OPENAI_BASE_URL'] = f"{openai_url}/v1"
+    from metrics import metrics
+    from rag_engine import RAGEngine
+    from rate_limiter import RateLimiter
+    
+    rate_limiter = RateLimiter(
+        gmail_units_per_second=options['gmail_units_per_second'],
+        openai_requests_per_minute=options['openai_requests_per_minute'],
+        openai_tokens_per_minute=options['openai_tokens_per_minute'],
+        base_delay=0.5)
+    with tempfile.TemporaryDirectory(prefix="rag-benchmark-") as work_dir:
+        os.chdir(work_dir)
+        gmail_service = benchmark_gmail_service(gmail_url, rate_limiter, options['parse_processes'])
+        engine = RAGEngine(gmail_service, rate_limiter=rate_limiter, data_dir=work_dir,
+                           index_type=options['index_type'], quantization=options['quantization'])
+        
+        start = time.perf_counter()
+        indexed = engine.index_emails(limit=size)
+        index_seconds = time.perf_counter() - start
+        
+        latencies = []
+        for question in synthetic_queries(options['queries'], options['seed']):
+            start = time.perf_counter()
+            engine.query(question)
+            latencies.append((time.perf_counter() - start) * 1000)
+        
+        # Change the mailbox after the queries, then time the incremental sync that applies it
+        changes = (
+            ('messages', options['sync_count'], ''),
+            ('deletions', options['sync_deletes'], ''),
+            ('labels', options['sync_relabels'], '&add=IMPORTANT&remove=CATEGORY_PROMOTIONS'),
+        )
+        sync_seconds = None
+        synced = None
+        if any(count for _, count, _ in changes):
+            for endpoint, count, extra in changes:
+                if count:
+                    request = urllib.request.Request(
+                        f"{gmail_url}/benchmark/{endpoint}?count={count}{extra}", data=b'', method='POST')
+                    urllib.request.urlopen(request).close()
+            start = time.perf_counter()
+            synced = engine.sync_emails(limit=size)
+            sync_seconds = time.perf_counter() - start
+        
+        result = {
+            'emails': size,
+            'indexed': indexed,
+            'index_seconds': round(index_seconds, 3),
+            'messages_per_second': round(indexed / index_seconds, 1) if index_seconds else None,
+            'queries': len(latencies),
+            'query_p50_ms': round(float(np.percentile(latencies, 50)), 2) if latencies else None,
+            'query_p99_ms': round(float(np.percentile(latencies, 99)), 2) if latencies else None,
+            'sync_seconds': round(sync_seconds, 3) if sync_seconds is not None else None,
+            'synced': synced,
+            'index_memory_mb': round(engine.memory_usage() / (1024 * 1024), 1),
+            # ru_maxrss is in kilobytes on Linux
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1) if resource else None,
+            'openai_tokens': metrics.counter('openai_tokens_total'),
+            'gmail_quota_units': metrics.counter('gmail_quota_units_total'),
+            # Where the time went, from the engine's own instrumentation
+            'stages': {
+                dict(labels)['stage']: {field: round(value, 4) for field, value in summary.items()}
+                for labels, summary in sorted(metrics.snapshot()['histograms'].get('stage_seconds', {}).items())
+            }
+        }
+        engine.close()
+        if gmail_service.parse_pool is not None:
+            gmail_service.parse_pool.close()
+        os.chdir(tempfile.gettempdir())
+    return result
+
+def compare_reports(report, baseline, tolerance):
+    """Print how report differs from baseline and return the metrics that got worse than tolerance."""
+    previous = {result['emails']: result for result in baseline.get('results', [])}
+    regressions = []
+    for result in report['results']:
+        before = previous.get(result['emails'])
+        if before is None:
+            continue
+        for metric, higher_is_better in REGRESSION_METRICS:
+            old, new = before.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = -change if higher_is_better else change
+            flag = "  REGRESSION" if worse > tolerance else ""
+            print(f"{result['emails']:>8} {metric:>20}: {old:10.1f} -> {new:10.1f} ({change:+.0%}){flag}")
+            if worse > tolerance:
+                regressions.append((result['emails'], metric))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark indexing and querying against local fake Gmail and OpenAI APIs.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help="Mailbox sizes to benchmark, each indexed in a fresh process")
+    parser.add_argument('--queries', type=int, default=50, help="Questions asked after indexing")
+    parser.add_argument('--sync-count', type=int, default=0,
+                        help="Deliver this many new emails after the queries and time an incremental sync")
+    parser.add_argument('--sync-deletes', type=int, default=0,
+                        help="Delete this many emails before the incremental sync")
+    parser.add_argument('--sync-relabels', type=int, default=0,
+                        help="Relabel this many emails before the incremental sync")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for the synthetic mailbox and questions")
+    parser.add_argument('--gmail-latency', type=float, default=0.02, help="Seconds added to each Gmail request")
+    parser.add_argument('--openai-latency', type=float, default=0.05, help="Seconds added to each OpenAI request")
+    parser.add_argument('--gmail-server-rps', type=int, default=None,
+                        help="Fake Gmail calls allowed per second before answering 429")
+    parser.add_argument('--openai-server-rps', type=int, default=None,
+                        help="Fake OpenAI requests allowed per second before answering 429")
+    parser.add_argument('--gmail-units-per-second', type=float, default=1e9,
+                        help="Client-side Gmail quota; unlimited by default so the code, not the quota, is measured")
+    parser.add_argument('--openai-requests-per-minute', type=float, default=1e9, help="Client-side OpenAI quota")
+    parser.add_argument('--openai-tokens-per-minute', type=float, default=1e12, help="Client-side OpenAI quota")
+    parser.add_argument('--parse-processes', type=int, default=0, help="GmailService parse_processes")
+    parser.add_argument('--index-type', default='auto', help="RAGEngine index_type")
+    parser.add_argument('--quantization', default=None, help="RAGEngine quantization")
+    parser.add_argument('--output', default="benchmark_report.json", help="Where to write the JSON report")
+    parser.add_argument('--baseline', help="Earlier report to compare with; exits non-zero on regressions")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="Fraction a metric may get worse than the baseline before it counts as a regression")
+    args = parser.parse_args()
+    
+    options = {
+        'queries': args.queries,
+        'sync_count': args.sync_count,
+        'sync_deletes': args.sync_deletes,
+        'sync_relabels': args.sync_relabels,
+        'seed': args.seed,
+        'gmail_units_per_second': args.gmail_units_per_second,
+        'openai_requests_per_minute': args.openai_requests_per_minute,
+        'openai_tokens_per_minute': args.openai_tokens_per_minute,
+        'parse_processes': args.parse_processes,
+        'index_type': args.index_type,
+        'quantization': args.quantization
+    }
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'config': vars(args),
+        'results': []
+    }
+    
+    # The fake APIs run in this process so they don't compete with the benchmark for its GIL
+    openai_server = FakeOpenAIServer(latency=args.openai_latency, requests_per_second=args.openai_server_rps).start()
+    for size in args.sizes:
+        mailbox = SyntheticMailbox(size, seed=args.seed)
+        gmail_server = FakeGmailServer(mailbox, latency=args.gmail_latency,
+                                       requests_per_second=args.gmail_server_rps).start()
+        openai_server.reset_counts()
+        print(f"Benchmarking {size} emails")
+        try:
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                result = executor.submit(run_benchmark, size, gmail_server.url, openai_server.url, options).result()
+        finally:
+            gmail_server.stop()
+        result['gmail_api'] = gmail_server.stats()
+        result['openai_api'] = openai_server.stats()
+        report['results'].append(result)
+        print(f"{size:>8} emails: {result['messages_per_second']} messages/s, "
+              f"query p50 {result['query_p50_ms']} ms, p99 {result['query_p99_ms']} ms, "
+              f"peak RSS {result['peak_rss_mb']} MB, {result['gmail_api']['total']} Gmail and "
+              f"{result['openai_api']['total']} OpenAI calls")
+    openai_server.stop()
+    
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.output}")
+    
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare_reports(report, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} metrics regressed by more than {args.tolerance:.0%}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
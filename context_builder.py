@@ -0,0 +1,148 @@
+import re
+
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+CONTEXT_INTRO = "Here are the most relevant emails for your query:\n\n"
+
+class ContextBuilder:
+    def __init__(self, count_tokens, truncate_tokens, token_budget=3000):
+        """Initialize a prompt context builder that stays within a token budget.
+        
+        count_tokens(text) returns the number of tokens in text and
+        truncate_tokens(text, n) cuts text down to at most n tokens; both
+        count with the model's tokenizer locally, without an API call.
+        """
+        self.count_tokens = count_tokens
+        self.truncate_tokens = truncate_tokens
+        self.token_budget = token_budget
+        self.separator_tokens = count_tokens(" ... ")
+        self.intro_tokens = count_tokens(CONTEXT_INTRO)
+        self.thread_label_tokens = count_tokens("\nEMAIL THREAD 10:\n")
+        self.body_label_tokens = count_tokens("Body: ...\n")
+    
+    def build(self, emails, bodies):
+        """Build the context for a question from the retrieved emails.
+        
+        emails are in retrieval order and each carries 'passages', a list of
+        (start, end, rank) body spans where rank is the span's position in
+        the overall ranking. Emails from the same thread are merged under one
+        heading, and every email's subject, sender and date are always listed.
+        Passages are then added best-ranked first while they fit in the
+        budget, skipping any whose text was already quoted, for example in a
+        reply that quotes an earlier message. Emails left without a passage
+        are shown with their snippet instead.
+        
+        Returns (context, tokens) where tokens is the context's token count.
+        """
+        # Threads are ordered by their best-ranked email
+        threads = {}
+        for email in emails:
+            threads.setdefault(self._thread_key(email), []).append(email)
+        
+        # Every retrieved email is listed with its headers, even one with no quotable body
+        used = self.intro_tokens
+        for thread_emails in threads.values():
+            used += self.count_tokens(self._thread_header(thread_emails[0])) + self.thread_label_tokens
+            for email in thread_emails:
+                used += self.count_tokens(self._message_header(email, thread_emails[0]))
+        
+        candidates = sorted(
+            (rank, email['doc_id'], start, end)
+            for email in emails for start, end, rank in email['passages'])
+        
+        included = {}
+        seen_text = []
+        for rank, doc_id, start, end in candidates:
+            text = bodies.get(doc_id, '')[start:end]
+            normalized = WHITESPACE_PATTERN.sub(' ', text).strip().lower()
+            if not normalized or any(normalized in quoted for quoted in seen_text):
+                continue
+            
+            cost = self.count_tokens(text) + self.separator_tokens
+            if doc_id not in included:
+                cost += self.body_label_tokens
+            
+            if used + cost > self.token_budget:
+                if included:
+                    # Something smaller further down the ranking may still fit
+                    continue
+                # Always quote at least the best passage, cut to fit
+                available = self.token_budget - used - (cost - self.count_tokens(text))
+                if available <= 0:
+                    break
+                text = self.truncate_tokens(text, available)
+                end = start + len(text)
+                cost = self.token_budget - used
+            
+            used += cost
+            included.setdefault(doc_id, []).append((start, end))
+            seen_text.append(normalized)
+        
+        # Emails with no quoted passage, such as subject-only or attachment-only mail, fall back to their snippet
+        snippets = set()
+        for email in emails:
+            if email['doc_id'] in included or not email.get('snippet'):
+                continue
+            cost = self.count_tokens(self._snippet_line(email))
+            if used + cost <= self.token_budget:
+                used += cost
+                snippets.add(email['doc_id'])
+        
+        return self._render(threads, included, snippets, bodies), used
+    
+    def _render(self, threads, included, snippets, bodies):
+        """Lay out every retrieved email thread by thread, with its included passages or snippet."""
+        sections = []
+        for thread_emails in threads.values():
+            section = self._thread_header(thread_emails[0])
+            for email in thread_emails:
+                section += self._message_header(email, thread_emails[0])
+                if email['doc_id'] in included:
+                    section += f"Body: {self._preview(bodies.get(email['doc_id'], ''), included[email['doc_id']])}\n"
+                elif email['doc_id'] in snippets:
+                    section += self._snippet_line(email)
+            sections.append(section)
+        
+        return CONTEXT_INTRO + "\n".join(
+            f"EMAIL THREAD {i + 1}:\n{section}" for i, section in enumerate(sections))
+    
+    @staticmethod
+    def _thread_key(email):
+        """Group messages by thread, treating a message without one as its own thread."""
+        return email['thread_id'] or email['id']
+    
+    @staticmethod
+    def _thread_header(first_email):
+        """Header shared by every message quoted from a thread."""
+        return f"Subject: {first_email['subject']}\n"
+    
+    @staticmethod
+    def _message_header(email, first_email):
+        """Header for one message, repeating the subject only if it changed within the thread."""
+        header = f"From: {email['sender']}\nDate: {email['date']}\n"
+        if email['subject'] != first_email['subject']:
+            header = f"Subject: {email['subject']}\n" + header
+        return header
+    
+    @staticmethod
+    def _snippet_line(email):
+        """Gmail's snippet of a message, quoted when none of its body is."""
+        return f"Snippet: {email['snippet']}\n"
+    
+    @staticmethod
+    def _preview(body_text, spans):
+        """Join body spans in reading order, marking omitted text with '...'."""
+        # Neighbouring chunks overlap, so merge spans that touch
+        merged = []
+        for start, end in sorted(spans):
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        spans = merged
+        preview = " ... ".join(body_text[start:end] for start, end in spans)
+        if spans[0][0] > 0:
+            preview = "..." + preview
+        if spans[-1][1] < len(body_text):
+            preview += "..."
+        return preview
@@ -0,0 +1,274 @@
+import json
+import sqlite3
+import threading
+
+# Columns returned for an email without its body
+METADATA_COLUMNS = ('doc_id', 'id', 'thread_id', 'subject', 'sender', 'date', 'snippet', 'labels', 'duplicate_of')
+
+class EmailStore:
+    def __init__(self, path="emails.db"):
+        """Initialize a SQLite-backed store of indexed email data.
+        
+        Emails are keyed by an integer document ID, and each of their chunks
+        by the integer ID its vector is stored under in the FAISS index.
+        Writes are incremental and bodies are only read when asked for, so
+        neither saving nor loading scales with total body size.
+        Pass ":memory:" for a store that is not persisted.
+        """
+        self.path = path
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS emails ("
+            "doc_id INTEGER PRIMARY KEY, id TEXT NOT NULL UNIQUE, thread_id TEXT, subject TEXT, "
+            "sender TEXT, date TEXT, snippet TEXT, labels TEXT, body_text TEXT, "
+            "simhash INTEGER, duplicate_of INTEGER)")
+        # Near-duplicate tracking was added later; older stores get the columns here
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(emails)")}
+        for column in ('simhash', 'duplicate_of'):
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE emails ADD COLUMN {column} INTEGER")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS emails_duplicate_of ON emails (duplicate_of)")
+        # Each email is embedded as one or more chunks of its body; the chunk
+        # ID is the ID its vector is stored under
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            "chunk_id INTEGER PRIMARY KEY, doc_id INTEGER NOT NULL, start INTEGER NOT NULL, end INTEGER NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS chunks_doc_id ON chunks (doc_id)")
+        
+        # BM25 full-text index over each chunk's subject, sender and body
+        # span, keyed by chunk ID. It is contentless because the text is
+        # already stored in the emails table.
+        has_text_index = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'chunk_text'").fetchone() is not None
+        self.conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS chunk_text USING fts5(subject, sender, body, content='')")
+        if not has_text_index:
+            # Stores created before the full-text index existed get it filled in once
+            self._index_chunk_text()
+        self.conn.commit()
+    
+    def __len__(self):
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM emails").fetchone()[0]
+    
+    def add_many(self, doc_ids, emails):
+        """Insert or replace emails under the given IDs.
+        
+        Storing a message again under a different ID would leave the old ID's
+        chunks behind, so callers reuse the stored ID (see doc_ids_for).
+        An email's optional 'simhash' and 'duplicate_of' keys record its
+        fingerprint and, for a near-duplicate, the ID of the email whose
+        vectors stand in for it.
+        """
+        rows = [
+            (doc_id, email['id'], email['thread_id'], email['subject'], email['sender'], email['date'],
+             email['snippet'], json.dumps(email['labels']), email['body_text'],
+             email.get('simhash'), email.get('duplicate_of'))
+            for doc_id, email in zip(doc_ids, emails)
+        ]
+        with self._lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO emails "
+                "(doc_id, id, thread_id, subject, sender, date, snippet, labels, body_text, simhash, duplicate_of) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    
+    def add_chunks(self, chunks):
+        """Record (chunk_id, doc_id, start, end) rows mapping vectors to body spans.
+        
+        The emails the chunks belong to must already be stored; their text is
+        added to the full-text index at the same time.
+        """
+        with self._lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO chunks (chunk_id, doc_id, start, end) VALUES (?, ?, ?, ?)", chunks)
+            self._index_chunk_text([chunk[0] for chunk in chunks])
+    
+    def search_text(self, match_query, limit=20, chunk_ids=None):
+        """Return (chunk_id, score) pairs for an FTS5 MATCH query, best first.
+        
+        Scores are BM25 with subject matches weighted double; lower is better.
+        Pass chunk_ids to rank only within those chunks.
+        """
+        sql = ("SELECT rowid, bm25(chunk_text, 2.0, 1.0, 1.0) AS score FROM chunk_text "
+               "WHERE chunk_text MATCH ?")
+        args = [match_query]
+        if chunk_ids is not None:
+            chunk_ids = list(chunk_ids)
+            sql += f" AND rowid IN ({','.join('?' * len(chunk_ids))})"
+            args.extend(chunk_ids)
+        with self._lock:
+            return self.conn.execute(sql + " ORDER BY score LIMIT ?", args + [limit]).fetchall()
+    
+    def get_chunks(self, chunk_ids):
+        """Return a dict mapping chunk IDs to (doc_id, start, end)."""
+        result = {}
+        chunk_ids = list(chunk_ids)
+        with self._lock:
+            for start in range(0, len(chunk_ids), 500):
+                chunk = chunk_ids[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                for chunk_id, doc_id, span_start, span_end in self.conn.execute(
+                        f"SELECT chunk_id, doc_id, start, end FROM chunks WHERE chunk_id IN ({placeholders})", chunk):
+                    result[chunk_id] = (doc_id, span_start, span_end)
+        return result
+    
+    def chunk_ids_for(self, doc_ids):
+        """Return the chunk IDs belonging to the given emails."""
+        chunk_ids = []
+        doc_ids = list(doc_ids)
+        with self._lock:
+            for start in range(0, len(doc_ids), 500):
+                chunk = doc_ids[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                chunk_ids.extend(row[0] for row in self.conn.execute(
+                    f"SELECT chunk_id FROM chunks WHERE doc_id IN ({placeholders})", chunk))
+        return chunk_ids
+    
+    def chunk_owners(self):
+        """Return (chunk_id, doc_id) pairs for every chunk."""
+        with self._lock:
+            return self.conn.execute("SELECT chunk_id, doc_id FROM chunks").fetchall()
+    
+    def max_chunk_id(self):
+        """Return the largest chunk ID, or -1 when there are no chunks."""
+        with self._lock:
+            value = self.conn.execute("SELECT MAX(chunk_id) FROM chunks").fetchone()[0]
+        return -1 if value is None else value
+    
+    def get_many(self, doc_ids, with_body=False):
+        """Return emails for the given IDs in the same order, skipping unknown IDs."""
+        if not doc_ids:
+            return []
+        
+        columns = METADATA_COLUMNS + (('body_text',) if with_body else ())
+        found = {}
+        with self._lock:
+            for start in range(0, len(doc_ids), 500):
+                chunk = list(doc_ids[start:start + 500])
+                placeholders = ','.join('?' * len(chunk))
+                for row in self.conn.execute(
+                        f"SELECT {', '.join(columns)} FROM emails WHERE doc_id IN ({placeholders})", chunk):
+                    found[row[0]] = self._to_email(columns, row)
+        return [found[doc_id] for doc_id in doc_ids if doc_id in found]
+    
+    def get_bodies(self, doc_ids):
+        """Return a dict of body text for the given IDs."""
+        return {email['doc_id']: email['body_text'] for email in self.get_many(doc_ids, with_body=True)}
+    
+    def doc_ids_for(self, msg_ids):
+        """Map Gmail message IDs to stored IDs, leaving out messages not in the store."""
+        result = {}
+        msg_ids = list(msg_ids)
+        with self._lock:
+            for start in range(0, len(msg_ids), 500):
+                chunk = msg_ids[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                for msg_id, doc_id in self.conn.execute(
+                        f"SELECT id, doc_id FROM emails WHERE id IN ({placeholders})", chunk):
+                    result[msg_id] = doc_id
+        return result
+    
+    def iter_emails(self, with_body=False, batch_size=1000):
+        """Yield every stored email in ID order, reading batch_size rows at a time."""
+        columns = METADATA_COLUMNS + (('body_text',) if with_body else ())
+        last_doc_id = -1
+        while True:
+            with self._lock:
+                rows = self.conn.execute(
+                    f"SELECT {', '.join(columns)} FROM emails WHERE doc_id > ? ORDER BY doc_id LIMIT ?",
+                    (last_doc_id, batch_size)).fetchall()
+            if not rows:
+                break
+            for row in rows:
+                yield self._to_email(columns, row)
+            last_doc_id = rows[-1][0]
+    
+    def duplicates_of(self, doc_ids):
+        """Return a dict mapping each given ID to the IDs of emails stored as its near-duplicates."""
+        result = {}
+        doc_ids = list(doc_ids)
+        with self._lock:
+            for start in range(0, len(doc_ids), 500):
+                chunk = doc_ids[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                for doc_id, duplicate_of in self.conn.execute(
+                        f"SELECT doc_id, duplicate_of FROM emails WHERE duplicate_of IN ({placeholders}) "
+                        "ORDER BY doc_id", chunk):
+                    result.setdefault(duplicate_of, []).append(doc_id)
+        return result
+    
+    def set_duplicate_of(self, doc_ids, duplicate_of):
+        """Point emails at a new representative, or pass None to make them stand alone."""
+        with self._lock:
+            self.conn.executemany(
+                "UPDATE emails SET duplicate_of = ? WHERE doc_id = ?", [(duplicate_of, doc_id) for doc_id in doc_ids])
+    
+    def iter_fingerprints(self):
+        """Yield (doc_id, sender, simhash) for every fingerprinted email that is not a duplicate."""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT doc_id, sender, simhash FROM emails "
+                "WHERE simhash IS NOT NULL AND duplicate_of IS NULL").fetchall()
+        yield from rows
+    
+    def update_labels(self, doc_id, labels):
+        """Replace the labels stored for an email."""
+        with self._lock:
+            self.conn.execute("UPDATE emails SET labels = ? WHERE doc_id = ?", (json.dumps(labels), doc_id))
+    
+    def remove_many(self, doc_ids):
+        """Delete the emails with the given IDs along with their chunks."""
+        rows = [(doc_id,) for doc_id in doc_ids]
+        with self._lock:
+            # A contentless full-text index needs the original text to remove it
+            self.conn.executemany(
+                "INSERT INTO chunk_text (chunk_text, rowid, subject, sender, body) "
+                "SELECT 'delete', c.chunk_id, e.subject, e.sender, substr(e.body_text, c.start + 1, c.end - c.start) "
+                "FROM chunks c JOIN emails e ON e.doc_id = c.doc_id WHERE c.doc_id = ?", rows)
+            self.conn.executemany("DELETE FROM emails WHERE doc_id = ?", rows)
+            self.conn.executemany("DELETE FROM chunks WHERE doc_id = ?", rows)
+    
+    def max_doc_id(self):
+        """Return the largest stored ID, or -1 when the store is empty."""
+        with self._lock:
+            value = self.conn.execute("SELECT MAX(doc_id) FROM emails").fetchone()[0]
+        return -1 if value is None else value
+    
+    def clear(self):
+        """Delete every stored email."""
+        with self._lock:
+            self.conn.execute("DELETE FROM emails")
+            self.conn.execute("DELETE FROM chunks")
+            self.conn.execute("INSERT INTO chunk_text (chunk_text) VALUES ('delete-all')")
+    
+    def commit(self):
+        """Flush pending writes to disk."""
+        with self._lock:
+            self.conn.commit()
+    
+    def close(self):
+        """Close the underlying database connection."""
+        with self._lock:
+            self.conn.close()
+    
+    def _index_chunk_text(self, chunk_ids=None):
+        """Add chunks to the full-text index, or every chunk when chunk_ids is None."""
+        sql = ("INSERT INTO chunk_text (rowid, subject, sender, body) "
+               "SELECT c.chunk_id, e.subject, e.sender, substr(e.body_text, c.start + 1, c.end - c.start) "
+               "FROM chunks c JOIN emails e ON e.doc_id = c.doc_id")
+        if chunk_ids is None:
+            self.conn.execute(sql)
+            return
+        for start in range(0, len(chunk_ids), 500):
+            chunk = chunk_ids[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            self.conn.execute(f"{sql} WHERE c.chunk_id IN ({placeholders})", chunk)
+    
+    @staticmethod
+    def _to_email(columns, row):
+        """Build an email dict from a database row."""
+        email = dict(zip(columns, row))
+        email['labels'] = json.loads(email['labels']) if email['labels'] else []
+        return email
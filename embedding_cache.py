@@ -0,0 +1,146 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+from metrics import metrics
+
+class EmbeddingCache:
+    def __init__(self, path="embedding_cache.db", max_entries=200000):
+        """Initialize a disk-backed cache of embedding vectors.
+        
+        Vectors are stored as float32 blobs in SQLite, keyed by a hash of the
+        model name and the exact text that was embedded. When the cache grows
+        past max_entries the least recently used entries are evicted.
+        Lookups don't write: the access times of hits are batched and
+        written along with the next put or once touch_batch_size have
+        accumulated.
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.touch_batch_size = 1000
+        self.hits = 0
+        self.misses = 0
+        self._touched = {}  # key -> last access time not yet written
+        self._lock = threading.Lock()
+        
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self.conn.commit()
+        self._size = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+    
+    @staticmethod
+    def make_key(text, model):
+        """Build the cache key for a text embedded with the given model."""
+        return hashlib.sha256(f"{model}\0{text}".encode('utf-8')).hexdigest()
+    
+    def get_many(self, keys):
+        """Look up vectors for keys, returning a list with None for misses."""
+        if not keys:
+            return []
+        
+        found = {}
+        with self._lock:
+            unique_keys = list(set(keys))
+            # Stay well under SQLite's bound-parameter limit
+            for start in range(0, len(unique_keys), 500):
+                chunk = unique_keys[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self.conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+            
+            if found:
+                now = time.time()
+                self._touched.update((key, now) for key in found)
+                if len(self._touched) >= self.touch_batch_size:
+                    self._write_touched()
+                    self.conn.commit()
+        
+        results = [found.get(key) for key in keys]
+        hits = sum(1 for vector in results if vector is not None)
+        self.hits += hits
+        self.misses += len(keys) - hits
+        metrics.increment('cache_lookups_total', hits, cache='embedding', result='hit')
+        metrics.increment('cache_lookups_total', len(keys) - hits, cache='embedding', result='miss')
+        return results
+    
+    def put_many(self, keys, vectors):
+        """Store vectors under their keys, evicting old entries if over the cap."""
+        if not keys:
+            return
+        
+        now = time.time()
+        rows = [(key, np.asarray(vector, dtype=np.float32).tobytes(), now)
+                for key, vector in zip(keys, vectors)]
+        with self._lock:
+            self._write_touched()
+            before = self.conn.total_changes
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)", rows)
+            self._size += self.conn.total_changes - before
+            
+            if self._size > self.max_entries:
+                # Other processes may have added or evicted entries, so count before evicting
+                self._size = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            if self._size > self.max_entries:
+                # Evict down to 90% of the cap so eviction does not run on every insert
+                excess = self._size - int(self.max_entries * 0.9)
+                self.conn.execute(
+                    "DELETE FROM embeddings WHERE key IN "
+                    "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)", (excess,))
+                self._size -= excess
+            self.conn.commit()
+    
+    def stats(self):
+        """Return hit and miss counters along with the current cache size."""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': self._size
+        }
+    
+    def flush(self):
+        """Write any pending access times to disk."""
+        with self._lock:
+            self._write_touched()
+            self.conn.commit()
+    
+    def close(self):
+        """Write pending access times and close the underlying database connection."""
+        with self._lock:
+            self._write_touched()
+            self.conn.commit()
+            self.conn.close()
+    
+    def _write_touched(self):
+        """Write the batched access times of cache hits; the caller holds the lock and commits."""
+        if self._touched:
+            self.conn.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                [(now, key) for key, now in self._touched.items()])
+            self._touched = {}
+
+_shared_caches = {}
+_shared_caches_lock = threading.Lock()
+
+def shared_embedding_cache(path="embedding_cache.db"):
+    """Return the process-wide cache for the database at path, opening it on first use.
+    
+    Every engine using the same file shares one connection, so the size cap
+    is enforced across accounts instead of per engine.
+    """
+    key = os.path.abspath(path)
+    with _shared_caches_lock:
+        cache = _shared_caches.get(key)
+        if cache is None:
+            cache = _shared_caches[key] = EmbeddingCache(path)
+        return cache
@@ -0,0 +1,584 @@
+import base64
+import bisect
+import json
+import random
+import re
+import threading
+import time
+import uuid
+import zlib
+from datetime import datetime, timedelta, timezone
+from email import message_from_bytes
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import numpy as np
+
+# Everyday email vocabulary for synthetic bodies and answers
+WORDS = ("invoice order shipped meeting agenda project deadline quarterly report review budget "
+         "account payment receipt travel itinerary flight hotel update newsletter offer team").split()
+
+# Extra vocabulary so synthetic emails don't all look alike to search and deduplication
+TOPIC_WORDS = ("renewal contract shipment warehouse invoice refund subscription webinar conference "
+               "interview candidate onboarding security password login alert statement mortgage "
+               "insurance claim appointment dentist school recital soccer practice birthday dinner "
+               "reservation tickets concert lease apartment repair plumber quote proposal launch "
+               "release roadmap sprint incident outage postmortem migration database kubernetes "
+               "analytics dashboard forecast revenue hiring offsite workshop training certificate").split()
+
+SENDER_NAMES = ("alice bob carol dave erin frank grace heidi ivan judy mallory niaj olivia peggy "
+                "rupert sybil trent victor walter yvonne").split()
+
+SENDER_DOMAINS = ("example.com acme.io globex.net initech.com umbrella.org hooli.com "
+                  "newsletters.example.org shop.example.net bank.example.com travel.example.io").split()
+
+# Share of messages of each MIME layout, with the median and spread of their body sizes in KB
+MESSAGE_LAYOUTS = (
+    ('plain', 0.3, 2, 0.8),
+    ('alternative', 0.4, 30, 0.7),
+    ('html', 0.2, 45, 0.8),
+    ('attachment', 0.1, 20, 0.7),
+)
+
+GMAIL_PATH_PATTERN = re.compile(r"^/gmail/v1/users/me/(profile|labels|history|messages)(?:/([^/]+))?$")
+
+def _encode(text):
+    """Base64url-encode a body the way the Gmail API does."""
+    return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii').rstrip('=')
+
+def hashed_embedding(text, dimension):
+    """Deterministic unit vector for text, built by hashing its words into dimensions.
+    
+    Texts sharing words get similar vectors, so retrieval over the fake
+    embeddings behaves like a (crude) semantic search.
+    """
+    words = re.findall(r"[a-z0-9]+", text.lower())
+    vector = np.zeros(dimension, dtype=np.float32)
+    if words:
+        hashes = np.array([zlib.crc32(word.encode('utf-8')) for word in words], dtype=np.int64)
+        signs = np.where(hashes & (1 << 16), 1.0, -1.0)
+        vector += np.bincount(hashes % dimension, weights=signs, minlength=dimension).astype(np.float32)
+    norm = np.linalg.norm(vector)
+    if norm == 0:
+        vector[0] = 1.0
+        return vector
+    return vector / norm
+
+class SyntheticMailbox:
+    def __init__(self, size, seed=0, paragraphs=4096):
+        """Initialize a deterministic mailbox of size generated Gmail messages.
+        
+        Messages are generated on request from their index, so even large
+        mailboxes take no memory. They mix plain-text, multipart/alternative,
+        HTML-only and attachment-bearing layouts with log-normal body sizes,
+        and bodies are assembled from a shared pool of paragraphs so each
+        message is distinct without generating text per request. Messages
+        can then be added, deleted and relabelled, and each change is
+        recorded in the mailbox history.
+        """
+        self.seed = seed
+        self.size = 0
+        self.history = []  # Gmail history records of changes made after creation
+        self.base_history_id = 1000
+        self.deleted = set()  # Indexes of deleted messages
+        self._labels = {}  # Index -> labels of relabelled messages
+        # The initial messages span the months up to now, 37 minutes apart
+        self.created = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+        self.initial_size = size
+        self._lock = threading.Lock()
+        rng = random.Random(seed)
+        vocabulary = WORDS + TOPIC_WORDS
+        self._paragraphs = [
+            ' '.join(rng.choice(vocabulary) for _ in range(rng.randint(20, 60))).capitalize() + '.'
+            for _ in range(paragraphs)]
+        self.add(size, record_history=False)
+    
+    @property
+    def history_id(self):
+        """Current mailbox history ID."""
+        return self.base_history_id + len(self.history)
+    
+    @property
+    def live_size(self):
+        """Number of messages that have not been deleted."""
+        return self.size - len(self.deleted)
+    
+    def add(self, count, record_history=True):
+        """Deliver count new messages, recording them in the mailbox history."""
+        with self._lock:
+            first = self.size
+            self.size += count
+            if record_history:
+                for index in range(first, self.size):
+                    self._record('messagesAdded', {'message': self._history_message(index)})
+    
+    def delete(self, count):
+        """Permanently delete count messages picked across the mailbox, returning their IDs."""
+        with self._lock:
+            indexes = self._pick(count)
+            for index in indexes:
+                self.deleted.add(index)
+                self._record('messagesDeleted', {'message': {
+                    'id': self.message_id(index), 'threadId': self.message_id(index - index % 3)}})
+        return [self.message_id(index) for index in indexes]
+    
+    def relabel(self, count, add=(), remove=()):
+        """Add and remove labels on count messages picked across the mailbox, returning their IDs.
+        
+        Adding TRASH or SPAM moves a message out of the mailbox the way the
+        Gmail UI does, without deleting it.
+        """
+        with self._lock:
+            indexes = self._pick(count)
+            for index in indexes:
+                labels = self.labels(index)
+                added = [label for label in add if label not in labels]
+                removed = [label for label in remove if label in labels]
+                self._labels[index] = [label for label in labels if label not in removed] + added
+                if added:
+                    self._record('labelsAdded', {'message': self._history_message(index), 'labelIds': added})
+                if removed:
+                    self._record('labelsRemoved', {'message': self._history_message(index), 'labelIds': removed})
+        return [self.message_id(index) for index in indexes]
+    
+    def message_id(self, index):
+        """Gmail-style hexadecimal ID of the message at index."""
+        return f"{index + 1:016x}"
+    
+    def index_of(self, msg_id):
+        """Index of the message with the given ID, or None if there is none or it was deleted."""
+        try:
+            index = int(msg_id, 16) - 1
+        except ValueError:
+            return None
+        return index if 0 <= index < self.size and index not in self.deleted else None
+    
+    def list_ids(self, offset, count):
+        """IDs of up to count messages starting at offset, newest first, skipping deleted ones."""
+        with self._lock:
+            deleted = sorted(self.deleted)
+        # Step back past deleted messages until offset live ones are newer than the page
+        newest = self.size - 1 - offset
+        while newest >= 0:
+            newer_deleted = len(deleted) - bisect.bisect_right(deleted, newest)
+            if (self.size - 1 - newest) - newer_deleted >= offset:
+                break
+            newest -= 1
+        ids = []
+        for index in range(newest, -1, -1):
+            if len(ids) >= count:
+                break
+            if index not in self.deleted:
+                ids.append(self.message_id(index))
+        return ids
+    
+    def labels(self, index):
+        """Current labels of the message at index."""
+        if index in self._labels:
+            return list(self._labels[index])
+        rng = random.Random(self.seed * 1000003 + index)
+        return self._generate(rng)[5]
+    
+    def message(self, index, message_format='full'):
+        """The Gmail API representation of the message at index."""
+        rng = random.Random(self.seed * 1000003 + index)
+        layout, size_kb, name, domain, subject, labels = self._generate(rng)
+        labels = self._labels.get(index, labels)
+        date = self.created - timedelta(minutes=37 * (self.initial_size - index))
+        headers = [
+            {'name': 'From', 'value': f"{name.title()} <{name}@{domain}>"},
+            {'name': 'To', 'value': "bench@example.com"},
+            {'name': 'Subject', 'value': subject},
+            {'name': 'Date', 'value': date.strftime('%a, %d %b %Y %H:%M:%S +0000')},
+        ]
+        text = self._text(rng, size_kb)
+        message = {
+            'id': self.message_id(index),
+            'threadId': self.message_id(index - index % 3),
+            'labelIds': labels,
+            'snippet': text[:120],
+            'historyId': str(self.base_history_id),
+            'internalDate': str(int(date.timestamp() * 1000)),
+            'sizeEstimate': int(size_kb * 1024),
+        }
+        if message_format == 'minimal':
+            return message
+        
+        message['payload'] = self._payload(layout, headers, text, rng)
+        if message_format == 'metadata':
+            message['payload'] = {'mimeType': message['payload']['mimeType'], 'headers': headers}
+        return message
+    
+    def _generate(self, rng):
+        """Draw a message's layout, body size, sender, subject and labels from its generator."""
+        layout, size_kb = self._layout(rng)
+        name = rng.choice(SENDER_NAMES)
+        domain = rng.choice(SENDER_DOMAINS)
+        subject = ' '.join(rng.choice(TOPIC_WORDS) for _ in range(rng.randint(3, 7))).capitalize()
+        labels = ['INBOX', rng.choice(['CATEGORY_PERSONAL', 'CATEGORY_UPDATES', 'CATEGORY_PROMOTIONS'])]
+        if rng.random() < 0.1:
+            labels.append('IMPORTANT')
+        return layout, size_kb, name, domain, subject, labels
+    
+    def _pick(self, count):
+        """Pick up to count live messages spread across the mailbox; the caller holds the lock."""
+        rng = random.Random(self.seed * 7919 + len(self.history))
+        live = self.live_size
+        if live == 0:
+            return []
+        indexes = set()
+        while len(indexes) < min(count, live):
+            index = rng.randrange(self.size)
+            if index not in self.deleted:
+                indexes.add(index)
+        return sorted(indexes)
+    
+    def _history_message(self, index):
+        """The message as a history record lists it, with its current labels."""
+        return {'id': self.message_id(index), 'threadId': self.message_id(index - index % 3),
+                'labelIds': self.labels(index)}
+    
+    def _record(self, kind, item):
+        """Append a history record of one change; the caller holds the lock."""
+        self.history.append({'id': str(self.base_history_id + len(self.history) + 1), kind: [item]})
+    
+    def _layout(self, rng):
+        """Pick a MIME layout and body size in KB for one message."""
+        roll = rng.random()
+        for layout, share, median_kb, sigma in MESSAGE_LAYOUTS:
+            roll -= share
+            if roll <= 0:
+                break
+        return layout, min(300, median_kb * rng.lognormvariate(0, sigma))
+    
+    def _text(self, rng, size_kb):
+        """Join random pool paragraphs until the text reaches about size_kb kilobytes."""
+        parts = []
+        length = 0
+        while length < size_kb * 1024:
+            paragraph = self._paragraphs[rng.randrange(len(self._paragraphs))]
+            parts.append(paragraph)
+            length += len(paragraph) + 2
+        return '\n\n'.join(parts)
+    
+    def _html(self, text, rng):
+        """Render text as newsletter-style table HTML."""
+        rows = ''.join(
+            f'<tr><td style="padding:8px;font-family:Arial,sans-serif;color:#333333">'
+            f'<a href="https://example.com/{rng.randint(0, 10**6)}">{paragraph[:40]}</a>'
+            f'<p>{paragraph}</p></td></tr>'
+            for paragraph in text.split('\n\n'))
+        return ('<!DOCTYPE html><html><head><style>td { padding: 0 }</style></head><body>'
+                f'<table width="600" cellpadding="0" cellspacing="0">{rows}</table></body></html>')
+    
+    def _payload(self, layout, headers, text, rng):
+        """Build the MIME tree for a message body in the given layout."""
+        plain = {'mimeType': 'text/plain',
+                 'headers': [{'name': 'Content-Type', 'value': 'text/plain; charset="UTF-8"'}],
+                 'body': {'size': len(text), 'data': _encode(text)}}
+        if layout == 'plain':
+            return dict(plain, headers=headers + plain['headers'])
+        
+        html = self._html(text, rng)
+        html_part = {'mimeType': 'text/html',
+                     'headers': [{'name': 'Content-Type', 'value': 'text/html; charset="UTF-8"'}],
+                     'body': {'size': len(html), 'data': _encode(html)}}
+        if layout == 'html':
+            return dict(html_part, headers=headers + html_part['headers'])
+        
+        alternative = {'mimeType': 'multipart/alternative', 'headers': [], 'body': {'size': 0},
+                       'parts': [plain, html_part]}
+        if layout == 'alternative':
+            return dict(alternative, headers=headers)
+        
+        attachment = {'mimeType': 'application/pdf', 'filename': 'document.pdf', 'headers': [],
+                      'body': {'attachmentId': f"att{rng.randint(0, 10**9)}", 'size': rng.randint(20000, 2000000)}}
+        return {'mimeType': 'multipart/mixed', 'headers': headers, 'body': {'size': 0},
+                'parts': [alternative, attachment]}
+
+class FakeAPIServer:
+    def __init__(self, latency=0.0, requests_per_second=None):
+        """Initialize a local HTTP server standing in for a remote API.
+        
+        Every request waits latency seconds before being answered. With
+        requests_per_second set, requests beyond that many in a second are
+        answered with 429 Too Many Requests and a Retry-After header. Calls
+        are counted per endpoint in calls, and throttled ones in throttled.
+        """
+        self.latency = latency
+        self.requests_per_second = requests_per_second
+        self.calls = {}
+        self.throttled = 0
+        self._window = (0, 0)  # (second, requests seen in it)
+        self._lock = threading.Lock()
+        self._httpd = None
+    
+    @property
+    def url(self):
+        """Base URL the server listens on."""
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+    
+    def start(self):
+        """Start serving on a free local port in a background thread and return the server."""
+        api = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            
+            def do_GET(self):
+                api._handle(self, 'GET')
+            
+            def do_POST(self):
+                api._handle(self, 'POST')
+            
+            def log_message(self, format, *args):
+                pass
+        
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._httpd.daemon_threads = True
+        threading.Thread(target=self._httpd.serve_forever, name="fake-api", daemon=True).start()
+        return self
+    
+    def stop(self):
+        """Stop the server."""
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+    
+    def reset_counts(self):
+        """Zero the call counters."""
+        with self._lock:
+            self.calls = {}
+            self.throttled = 0
+    
+    def stats(self):
+        """Return the call counts per endpoint and the number of throttled calls."""
+        with self._lock:
+            return {'calls': dict(self.calls), 'total': sum(self.calls.values()), 'throttled': self.throttled}
+    
+    def route(self, method, path, query, body, headers):
+        """Answer one request, returning (status, headers, body bytes)."""
+        raise NotImplementedError
+    
+    def _count(self, endpoint):
+        """Count a call to an endpoint."""
+        with self._lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+    
+    def _admit(self):
+        """Return True if a request fits in the rate limit, counting it if not."""
+        if self.requests_per_second is None:
+            return True
+        second = int(time.monotonic())
+        with self._lock:
+            window, seen = self._window
+            seen = seen + 1 if window == second else 1
+            self._window = (second, seen)
+            if seen <= self.requests_per_second:
+                return True
+            self.throttled += 1
+            return False
+    
+    def _handle(self, handler, method):
+        """Read a request, answer it through route and write the response."""
+        length = int(handler.headers.get('Content-Length') or 0)
+        body = handler.rfile.read(length) if length else b''
+        parts = urlsplit(handler.path)
+        if self.latency:
+            time.sleep(self.latency)
+        try:
+            status, headers, content = self.route(
+                method, parts.path, parse_qs(parts.query), body, handler.headers)
+        except Exception as e:
+            print(f"Fake API error for {method} {handler.path}: {e}")
+            status, headers, content = _json_response(500, {'error': {'code': 500, 'message': str(e)}})
+        handler.send_response(status)
+        for name, value in headers.items():
+            handler.send_header(name, value)
+        handler.send_header('Content-Length', str(len(content)))
+        handler.end_headers()
+        handler.wfile.write(content)
+
+def _json_response(status, payload, headers=None):
+    """A JSON response tuple for FakeAPIServer.route."""
+    return status, dict({'Content-Type': 'application/json; charset=UTF-8'}, **(headers or {})), \
+        json.dumps(payload).encode('utf-8')
+
+def _error_response(status, message, headers=None):
+    """An error response in the Google API JSON error format."""
+    return _json_response(status, {'error': {'code': status, 'message': message}}, headers)
+
+class FakeGmailServer(FakeAPIServer):
+    def __init__(self, mailbox, latency=0.0, requests_per_second=None):
+        """Initialize a fake Gmail REST API serving a SyntheticMailbox.
+        
+        Supports getProfile, labels.list, messages.list, messages.get,
+        history.list and HTTP batch requests of those calls. The rate limit
+        applies to each call inside a batch. Partial-response field masks are
+        accepted but not applied. So incremental sync can be exercised,
+        POST /benchmark/messages?count=N delivers N new messages,
+        POST /benchmark/deletions?count=N deletes N messages and
+        POST /benchmark/labels?count=N&add=LABEL&remove=LABEL relabels N
+        messages; add and remove may be repeated.
+        """
+        super().__init__(latency, requests_per_second)
+        self.mailbox = mailbox
+    
+    def route(self, method, path, query, body, headers):
+        if method == 'POST' and path == '/batch':
+            return self._batch(body, headers)
+        if method == 'POST' and path.startswith('/benchmark/'):
+            count = int(query.get('count', ['1'])[0])
+            if path == '/benchmark/messages':
+                self.mailbox.add(count)
+            elif path == '/benchmark/deletions':
+                self.mailbox.delete(count)
+            elif path == '/benchmark/labels':
+                self.mailbox.relabel(count, add=query.get('add', []), remove=query.get('remove', []))
+            else:
+                return _error_response(404, f"Unknown endpoint {method} {path}")
+            return _json_response(200, {'historyId': str(self.mailbox.history_id)})
+        return self._call(method, path, query)
+    
+    def _call(self, method, path, query):
+        """Answer a single Gmail API call."""
+        match = GMAIL_PATH_PATTERN.match(path)
+        if method != 'GET' or match is None:
+            return _error_response(404, f"Unknown endpoint {method} {path}")
+        resource, msg_id = match.groups()
+        endpoint = 'getProfile' if resource == 'profile' else f"{resource}.get" if msg_id else f"{resource}.list"
+        self._count(endpoint)
+        if not self._admit():
+            return _error_response(429, "Rate limit exceeded", {'Retry-After': '1'})
+        
+        mailbox = self.mailbox
+        if resource == 'profile':
+            return _json_response(200, {'emailAddress': "bench@example.com", 'messagesTotal': mailbox.live_size,
+                                        'historyId': str(mailbox.history_id)})
+        if resource == 'labels':
+            labels = ['INBOX', 'IMPORTANT', 'SPAM', 'TRASH', 'CATEGORY_PERSONAL', 'CATEGORY_UPDATES',
+                      'CATEGORY_PROMOTIONS']
+            return _json_response(200, {'labels': [{'id': label, 'name': label} for label in labels]})
+        if resource == 'history':
+            start = int(query.get('startHistoryId', ['0'])[0])
+            if start < mailbox.base_history_id:
+                return _error_response(404, "Requested entity was not found.")
+            records = [record for record in list(mailbox.history) if int(record['id']) > start]
+            return _json_response(200, {'history': records, 'historyId': str(mailbox.history_id)})
+        if msg_id is None:
+            offset = int(query.get('pageToken', ['0'])[0])
+            count = min(int(query.get('maxResults', ['100'])[0]), 500)
+            ids = mailbox.list_ids(offset, count)
+            result = {'messages': [{'id': i, 'threadId': i} for i in ids], 'resultSizeEstimate': len(ids)}
+            if offset + count < mailbox.live_size:
+                result['nextPageToken'] = str(offset + count)
+            return _json_response(200, result)
+        
+        index = mailbox.index_of(msg_id)
+        if index is None:
+            return _error_response(404, "Requested entity was not found.")
+        return _json_response(200, mailbox.message(index, query.get('format', ['full'])[0]))
+    
+    def _batch(self, body, headers):
+        """Answer a multipart/mixed batch request, one part per call."""
+        self._count('batch')
+        request = message_from_bytes(
+            f"Content-Type: {headers.get('Content-Type')}\r\n\r\n".encode('utf-8') + body)
+        boundary = f"batch_{uuid.uuid4().hex}"
+        parts = []
+        for part in request.get_payload():
+            lines = part.get_payload().splitlines()
+            method, target = lines[0].split(' ')[:2]
+            target = urlsplit(target)
+            status, _, content = self._call(method, target.path, parse_qs(target.query))
+            reason = {200: 'OK', 404: 'Not Found', 429: 'Too Many Requests'}.get(status, 'Error')
+            content_id = part['Content-ID'].strip('<>')
+            parts.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json; charset=UTF-8\r\n"
+                f"Content-Length: {len(content)}\r\n\r\n{content.decode('utf-8')}\r\n")
+        content = (''.join(parts) + f"--{boundary}--\r\n").encode('utf-8')
+        return 200, {'Content-Type': f"multipart/mixed; boundary={boundary}"}, content
+
+class FakeOpenAIServer(FakeAPIServer):
+    def __init__(self, dimension=1536, latency=0.0, requests_per_second=None, answer_words=40):
+        """Initialize a fake OpenAI API with deterministic embeddings and answers.
+        
+        Embeddings come from hashed_embedding, returned as floats or base64
+        as the client asks. Chat completions answer with answer_words words,
+        streamed as server-sent events when requested. Point the OpenAI
+        client at it with OPENAI_BASE_URL set to url + '/v1'.
+        """
+        super().__init__(latency, requests_per_second)
+        self.dimension = dimension
+        self.answer_words = answer_words
+        self.embedded_texts = 0
+    
+    def reset_counts(self):
+        super().reset_counts()
+        with self._lock:
+            self.embedded_texts = 0
+    
+    def stats(self):
+        stats = super().stats()
+        with self._lock:
+            stats['embedded_texts'] = self.embedded_texts
+        return stats
+    
+    def route(self, method, path, query, body, headers):
+        if method != 'POST' or path not in ('/v1/embeddings', '/v1/chat/completions'):
+            return _error_response(404, f"Unknown endpoint {method} {path}")
+        endpoint = path.rsplit('/', 1)[-1] if path.endswith('embeddings') else 'chat.completions'
+        self._count(endpoint)
+        if not self._admit():
+            return _error_response(429, "Rate limit reached", {'Retry-After': '1'})
+        request = json.loads(body or b'{}')
+        if endpoint == 'embeddings':
+            return self._embeddings(request)
+        return self._chat(request)
+    
+    def _embeddings(self, request):
+        """Embed every input text."""
+        inputs = request.get('input', [])
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        with self._lock:
+            self.embedded_texts += len(inputs)
+        data = []
+        for position, text in enumerate(inputs):
+            vector = hashed_embedding(text if isinstance(text, str) else ' '.join(map(str, text)), self.dimension)
+            if request.get('encoding_format') == 'base64':
+                embedding = base64.b64encode(vector.astype('<f4').tobytes()).decode('ascii')
+            else:
+                embedding = vector.tolist()
+            data.append({'object': 'embedding', 'index': position, 'embedding': embedding})
+        tokens = sum(len(str(text)) // 4 + 1 for text in inputs)
+        return _json_response(200, {'object': 'list', 'data': data, 'model': request.get('model'),
+                                    'usage': {'prompt_tokens': tokens, 'total_tokens': tokens}})
+    
+    def _chat(self, request):
+        """Answer a chat completion, as one response or a stream of chunks."""
+        prompt = ' '.join(str(message.get('content', '')) for message in request.get('messages', []))
+        rng = random.Random(zlib.crc32(prompt.encode('utf-8')))
+        words = [rng.choice(WORDS + TOPIC_WORDS) for _ in range(self.answer_words)]
+        prompt_tokens = len(prompt) // 4 + 1
+        usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': len(words),
+                 'total_tokens': prompt_tokens + len(words)}
+        common = {'id': "chatcmpl-benchmark", 'created': int(time.time()), 'model': request.get('model')}
+        if not request.get('stream'):
+            return _json_response(200, dict(common, object='chat.completion', usage=usage, choices=[{
+                'index': 0, 'finish_reason': 'stop',
+                'message': {'role': 'assistant', 'content': ' '.join(words)}}]))
+        
+        events = []
+        for position, word in enumerate(words):
+            delta = {'content': word if position == 0 else ' ' + word}
+            events.append(dict(common, object='chat.completion.chunk', choices=[
+                {'index': 0, 'delta': delta, 'finish_reason': None}]))
+        events.append(dict(common, object='chat.completion.chunk', choices=[
+            {'index': 0, 'delta': {}, 'finish_reason': 'stop'}]))
+        if (request.get('stream_options') or {}).get('include_usage'):
+            events.append(dict(common, object='chat.completion.chunk', choices=[], usage=usage))
+        content = ''.join(f"data: {json.dumps(event)}\n\n" for event in events) + "data: [DONE]\n\n"
+        return 200, {'Content-Type': 'text/event-stream'}, content.encode('utf-8')
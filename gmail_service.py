@@ -1,22 +1,79 @@
 import os
+import asyncio
 import pickle
 import base64
-import html
+import codecs
 import re
+import threading
+import time
 from datetime import datetime, timedelta
 from google.auth.transport.requests import Request
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from email.mime.text import MIMEText
-from bs4 import BeautifulSoup
+import httpx
+from async_utils import LoopLocal
+from html_text import html_to_text, normalize_whitespace
+from metrics import metrics
+from parse_pool import ParsePool
+from rate_limiter import shared_rate_limiter, is_retryable
+
+# REST endpoint used by the async methods, which bypass the synchronous client library
+GMAIL_API_URL = "https://gmail.googleapis.com/gmail/v1/users/me"
+
+CHARSET_PATTERN = re.compile(r'charset\s*=\s*"?([^";\s]+)', re.IGNORECASE)
+
+def _payload_fields(depth):
+    """Partial-response mask for a MIME part and its children down to depth levels.
+    
+    The fields syntax has no recursion, so each level of nesting is spelled out.
+    """
+    fields = "mimeType,filename,headers,body/data"
+    if depth > 1:
+        fields += f",parts({_payload_fields(depth - 1)})"
+    return fields
+
+# Request parameters for messages.get, from most to least data returned
+MESSAGE_PROFILES = {
+    # Everything Gmail has on the message
+    'full': {'format': 'full'},
+    # Only what get_message_content reads: labels, headers and inline bodies. Sizes,
+    # attachment IDs, part IDs and internal dates are left out, and five levels
+    # of MIME nesting covers real-world mail.
+    'content': {'format': 'full', 'fields': f"id,threadId,labelIds,snippet,payload({_payload_fields(5)})"},
+    # Headers only, without downloading any body
+    'metadata': {
+        'format': 'metadata',
+        'metadataHeaders': ['Subject', 'From', 'Date'],
+        'fields': "id,threadId,labelIds,snippet,payload(mimeType,headers)"
+    }
+}
 
 class GmailService:
-    def __init__(self, credentials_path):
-        """Initialize the Gmail service with OAuth authentication."""
+    def __init__(self, credentials_path, rate_limiter=None, max_concurrency=10, parse_processes=0):
+        """Initialize the Gmail service with OAuth authentication.
+        
+        max_concurrency caps the requests the async methods have in flight
+        at once on each event loop. When parse_processes is non-zero, fetched
+        messages are parsed in a pool of that many worker processes instead
+        of on the calling thread; None uses one per CPU.
+        """
+        self.rate_limiter = rate_limiter or shared_rate_limiter
+        self.max_concurrency = max_concurrency
+        self.parse_pool = ParsePool(parse_processes) if parse_processes != 0 else None
+        self._async_clients = LoopLocal(lambda: httpx.AsyncClient(timeout=30.0))
+        self._async_limits = LoopLocal(lambda: asyncio.Semaphore(self.max_concurrency))
+        self._creds_lock = threading.Lock()
         self.SCOPES = ['https://www.googleapis.com/auth/gmail.readonly', 'https://www.googleapis.com/auth/gmail.metadata']
         self.credentials_path = credentials_path
+        # Gmail accepts at most 100 calls in a single batch request
+        self.MAX_BATCH_SIZE = 100
+        # messages.list returns at most 500 messages per page
+        self.MAX_PAGE_SIZE = 500
+        self._local = threading.local()
         self.service = self.authenticate()
-        
+        self._service_thread = threading.get_ident()
+    
     def authenticate(self):
         """Authenticate with Gmail API using OAuth."""
         creds = None
@@ -70,30 +127,151 @@ class GmailService:
                 pickle.dump(creds, token)
         
         # Build the Gmail service
-        return build('gmail', 'v1', credentials=creds)
+        self.creds = creds
+        return self._build_service()
+    
+    def _build_service(self):
+        """Build a Gmail API client from the stored credentials."""
+        return build('gmail', 'v1', credentials=self.creds)
+    
+    def _get_service(self):
+        """Return a Gmail API client that is safe to use from the calling thread.
+        
+        The underlying httplib2 connection is not thread-safe, so each worker
+        thread gets its own client built from the shared credentials.
+        """
+        if threading.get_ident() == self._service_thread:
+            return self.service
+        if getattr(self._local, 'service', None) is None:
+            self._local.service = self._build_service()
+        return self._local.service
     
     def get_user_profile(self):
         """Get the user's Gmail profile information."""
-        return self.service.users().getProfile(userId='me').execute()
+        return self.rate_limiter.call_gmail(
+            'getProfile', self._get_service().users().getProfile(userId='me').execute)
     
     def list_labels(self):
         """List all available Gmail labels."""
-        results = self.service.users().labels().list(userId='me').execute()
+        results = self.rate_limiter.call_gmail(
+            'labels.list', self._get_service().users().labels().list(userId='me').execute)
         return results.get('labels', [])
     
     def list_messages(self, query='', max_results=100):
         """List messages matching the given query."""
-        result = self.service.users().messages().list(
-            userId='me', q=query, maxResults=max_results).execute()
-        messages = result.get('messages', [])
-        return messages
-    
-    def get_message(self, msg_id):
-        """Get full message details by message ID."""
-        message = self.service.users().messages().get(userId='me', id=msg_id).execute()
+        return list(self.iter_messages(query=query, max_results=max_results))
+    
+    def iter_messages(self, query='', max_results=None, page_size=500):
+        """Yield message references matching the query, one page at a time.
+        
+        Pages are requested lazily by following nextPageToken, so callers can
+        walk mailboxes of any size. max_results=None lists every match.
+        """
+        page_size = max(1, min(page_size, self.MAX_PAGE_SIZE))
+        remaining = max_results
+        page_token = None
+        
+        while remaining is None or remaining > 0:
+            request_size = page_size if remaining is None else min(page_size, remaining)
+            result = self.rate_limiter.call_gmail('messages.list', self._get_service().users().messages().list(
+                userId='me', q=query, maxResults=request_size, pageToken=page_token).execute)
+            
+            for message in result.get('messages', []):
+                yield message
+            
+            if remaining is not None:
+                remaining -= len(result.get('messages', []))
+            page_token = result.get('nextPageToken')
+            if not page_token:
+                break
+    
+    def iter_history(self, start_history_id, page_size=500):
+        """Yield mailbox history records recorded after start_history_id.
+        
+        Raises googleapiclient.errors.HttpError with status 404 when the
+        start ID is too old for Gmail to return history for it.
+        """
+        page_token = None
+        while True:
+            result = self.rate_limiter.call_gmail('history.list', self._get_service().users().history().list(
+                userId='me', startHistoryId=start_history_id,
+                maxResults=page_size, pageToken=page_token).execute)
+            
+            for record in result.get('history', []):
+                yield record
+            
+            page_token = result.get('nextPageToken')
+            if not page_token:
+                break
+    
+    def get_message(self, msg_id, profile='full'):
+        """Get message details by message ID.
+        
+        profile is a key of MESSAGE_PROFILES: 'full' returns everything,
+        'content' only what get_message_content needs, and 'metadata' only
+        the Subject, From and Date headers.
+        """
+        message = self.rate_limiter.call_gmail(
+            'messages.get', self._get_service().users().messages().get(
+                userId='me', id=msg_id, **MESSAGE_PROFILES[profile]).execute)
         return message
     
-    def get_message_content(self, message):
+    def get_messages_batch(self, msg_ids, batch_size=100, profile='content'):
+        """Get message details for many message IDs using batch requests.
+        
+        Each message is fetched with the given MESSAGE_PROFILES profile,
+        which by default skips everything get_message_content doesn't read.
+        
+        Requests are grouped into Gmail HTTP batches of up to 100 calls. A
+        failure for one message does not affect the others in its batch, and
+        messages that hit rate limits or server errors are retried in a later
+        batch after a backoff. Returns a list aligned with msg_ids, holding
+        None for messages that could not be fetched.
+        """
+        batch_size = max(1, min(batch_size, self.MAX_BATCH_SIZE))
+        results = [None] * len(msg_ids)
+        pending = list(range(len(msg_ids)))
+        service = self._get_service()
+        
+        for attempt in range(self.rate_limiter.max_retries + 1):
+            retry = []
+            
+            def handle_response(request_id, response, exception):
+                position = int(request_id)
+                if exception is None:
+                    results[position] = response
+                elif is_retryable(exception) and attempt < self.rate_limiter.max_retries:
+                    retry.append((position, exception))
+                else:
+                    print(f"Error fetching message {msg_ids[position]}: {exception}")
+            
+            def send_batch(positions):
+                batch = service.new_batch_http_request(callback=handle_response)
+                for position in positions:
+                    # Positions are used as request IDs so duplicate message IDs stay distinct
+                    batch.add(
+                        service.users().messages().get(userId='me', id=msg_ids[position], **MESSAGE_PROFILES[profile]),
+                        request_id=str(position))
+                batch.execute()
+            
+            for start in range(0, len(pending), batch_size):
+                positions = pending[start:start + batch_size]
+                # Every call inside a batch is charged against the quota separately
+                self.rate_limiter.call_gmail(
+                    'messages.get', lambda: send_batch(positions), calls=len(positions), stage='gmail.batch')
+            
+            if not retry:
+                break
+            
+            pending = sorted(position for position, _ in retry)
+            delay = self.rate_limiter.backoff_delay(attempt, retry[0][1])
+            print(f"Retrying {len(pending)} rate-limited messages in {delay:.1f}s")
+            time.sleep(delay)
+        
+        return results
+    
+    @staticmethod
+    def get_message_content(message):
         """Extract and decode email content from a message."""
         try:
             if 'payload' not in message:
@@ -124,7 +302,7 @@ class GmailService:
             }
         
         # Extract headers
-        headers = message['payload']['headers']
+        headers = message['payload'].get('headers', [])
         subject = ''
         sender = ''
         date = ''
@@ -137,34 +315,14 @@ class GmailService:
             elif header['name'].lower() == 'date':
                 date = header['value']
         
-        # Extract body content
-        body_text = ''
-        body_html = ''
-        
-        if 'parts' in message['payload']:
-            for part in message['payload']['parts']:
-                if part['mimeType'] == 'text/plain' and 'data' in part['body']:
-                    body_data = part['body']['data']
-                    body_text = base64.urlsafe_b64decode(body_data).decode('utf-8')
-                elif part['mimeType'] == 'text/html' and 'data' in part['body']:
-                    body_data = part['body']['data']
-                    body_html = base64.urlsafe_b64decode(body_data).decode('utf-8')
-        elif 'body' in message['payload'] and 'data' in message['payload']['body']:
-            body_data = message['payload']['body']['data']
-            decoded_data = base64.urlsafe_b64decode(body_data).decode('utf-8')
-            if message['payload']['mimeType'] == 'text/html':
-                body_html = decoded_data
-            else:
-                body_text = decoded_data
+        # Extract body content, preferring plain text over HTML
+        text_part, html_part = GmailService._find_body_parts(message['payload'])
+        body_text = normalize_whitespace(GmailService._decode_part(text_part)) if text_part else ''
+        body_html = GmailService._decode_part(html_part) if html_part else ''
         
         # If we have HTML but no plain text, extract text from HTML
         if body_html and not body_text:
-            soup = BeautifulSoup(body_html, 'html.parser')
-            body_text = soup.get_text(separator=' ', strip=True)
-        
-        # Clean up the text content
-        body_text = html.unescape(body_text)
-        body_text = re.sub(r'\s+', ' ', body_text).strip()
+            body_text = html_to_text(body_html)
         
         return {
             'id': message['id'],
@@ -178,6 +336,107 @@ class GmailService:
             'labels': message.get('labelIds', [])
         }
     
+    @staticmethod
+    def _find_body_parts(payload):
+        """Return the first text/plain and text/html parts in a MIME tree, or None for each.
+        
+        The tree is walked depth-first in document order with an explicit
+        stack, so nesting such as multipart/alternative inside
+        multipart/mixed is handled at any depth. Attachments and parts whose
+        content is not inline are skipped, and the walk stops as soon as a
+        plain text body is found.
+        """
+        text_part = None
+        html_part = None
+        stack = [payload]
+        while stack:
+            part = stack.pop()
+            mime_type = part.get('mimeType', '').lower()
+            if mime_type.startswith('multipart/'):
+                # Reversed so the first child is popped first
+                stack.extend(reversed(part.get('parts', [])))
+                continue
+            if part.get('filename') or 'data' not in part.get('body', {}):
+                continue
+            if mime_type == 'text/plain' and text_part is None:
+                text_part = part
+                break
+            if mime_type == 'text/html' and html_part is None:
+                html_part = part
+        return text_part, html_part
+    
+    @staticmethod
+    def _decode_part(part):
+        """Decode a MIME part's body using the charset from its Content-Type header."""
+        data = part['body']['data']
+        # Gmail sometimes drops the base64 padding
+        raw = base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+        
+        charset = 'utf-8'
+        for header in part.get('headers', []):
+            if header['name'].lower() == 'content-type':
+                match = CHARSET_PATTERN.search(header['value'])
+                if match:
+                    charset = match.group(1).lower()
+                break
+        try:
+            codecs.lookup(charset)
+        except LookupError:
+            charset = 'utf-8'
+        return raw.decode(charset, errors='replace')
+    
+    def _fetch_emails(self, msg_ids):
+        """Fetch and parse messages in batches, skipping any that fail."""
+        return self._parse_messages(msg_ids, self.get_messages_batch(msg_ids))
+    
+    def _parse_messages(self, msg_ids, full_messages):
+        """Parse fetched messages, skipping any that are None or fail to parse."""
+        with metrics.timer('parse'):
+            if self.parse_pool is not None:
+                messages = [full_msg for full_msg in full_messages if full_msg is not None]
+                emails = [email for email in self.parse_pool.imap(messages) if email is not None]
+            else:
+                emails = []
+                for msg_id, full_msg in zip(msg_ids, full_messages):
+                    if full_msg is None:
+                        continue
+                    try:
+                        emails.append(self.get_message_content(full_msg))
+                    except Exception as e:
+                        print(f"Error processing message {msg_id}: {e}")
+                        # Continue with other messages rather than failing completely
+                        continue
+        metrics.increment('messages_parsed_total', len(emails))
+        return emails
+    
+    def iter_emails(self, query='', count=None, batch_size=100):
+        """Yield parsed emails matching the query as their batches arrive.
+        
+        Message IDs are consumed from the paginated listing in groups of
+        batch_size, so only one batch of full messages is held in memory.
+        """
+        if self.parse_pool is not None:
+            # Later batches are fetched while the workers parse earlier ones
+            messages = (message for _, batch in self._iter_message_batches(query, count, batch_size)
+                        for message in batch if message is not None)
+            yield from (email for email in self.parse_pool.imap(messages) if email is not None)
+            return
+        
+        for batch_ids, batch in self._iter_message_batches(query, count, batch_size):
+            yield from self._parse_messages(batch_ids, batch)
+    
+    def _iter_message_batches(self, query, count, batch_size):
+        """Yield (message IDs, full messages) for each batch_size IDs, with None for failed messages."""
+        batch_ids = []
+        for message in self.iter_messages(query=query, max_results=count):
+            batch_ids.append(message['id'])
+            if len(batch_ids) >= batch_size:
+                yield batch_ids, self.get_messages_batch(batch_ids)
+                batch_ids = []
+        
+        if batch_ids:
+            yield batch_ids, self.get_messages_batch(batch_ids)
+    
     def get_recent_emails(self, count=100):
         """Get the most recent emails with full content."""
         try:
@@ -187,18 +446,9 @@ class GmailService:
             if not messages:
                 print("No messages found in the inbox")
                 return []
-                
-            # Fetch full content for each message
-            emails = []
-            for msg in messages:
-                try:
-                    full_msg = self.get_message(msg['id'])
-                    email_content = self.get_message_content(full_msg)
-                    emails.append(email_content)
-                except Exception as e:
-                    print(f"Error processing message {msg.get('id', 'unknown')}: {e}")
-                    # Continue with other messages rather than failing completely
-                    continue
+            
+            # Fetch full content for all messages in batches
+            emails = self._fetch_emails([msg['id'] for msg in messages])
             
             print(f"Successfully processed {len(emails)} out of {len(messages)} messages")
             return emails
@@ -216,18 +466,9 @@ class GmailService:
             if not messages:
                 print(f"No messages found matching query: {query}")
                 return []
-                
-            # Fetch full content for each message
-            emails = []
-            for msg in messages:
-                try:
-                    full_msg = self.get_message(msg['id'])
-                    email_content = self.get_message_content(full_msg)
-                    emails.append(email_content)
-                except Exception as e:
-                    print(f"Error processing message {msg.get('id', 'unknown')}: {e}")
-                    # Continue with other messages rather than failing completely
-                    continue
+            
+            # Fetch full content for all messages in batches
+            emails = self._fetch_emails([msg['id'] for msg in messages])
             
             print(f"Successfully processed {len(emails)} out of {len(messages)} messages for query: {query}")
             return emails
@@ -235,3 +476,87 @@ class GmailService:
             print(f"Error searching emails with query '{query}': {e}")
             # Return empty list rather than failing
             return []
+    
+    async def aget_user_profile(self):
+        """Async counterpart of get_user_profile."""
+        return await self.rate_limiter.acall_gmail('getProfile', lambda: self._arequest('profile'))
+    
+    async def aiter_messages(self, query='', max_results=None, page_size=500):
+        """Async counterpart of iter_messages."""
+        page_size = max(1, min(page_size, self.MAX_PAGE_SIZE))
+        remaining = max_results
+        page_token = None
+        
+        while remaining is None or remaining > 0:
+            params = {'q': query, 'maxResults': page_size if remaining is None else min(page_size, remaining)}
+            if page_token:
+                params['pageToken'] = page_token
+            result = await self.rate_limiter.acall_gmail(
+                'messages.list', lambda: self._arequest('messages', params))
+            
+            for message in result.get('messages', []):
+                yield message
+            
+            if remaining is not None:
+                remaining -= len(result.get('messages', []))
+            page_token = result.get('nextPageToken')
+            if not page_token:
+                break
+    
+    async def aget_message(self, msg_id, profile='full'):
+        """Async counterpart of get_message."""
+        return await self.rate_limiter.acall_gmail(
+            'messages.get', lambda: self._arequest(f'messages/{msg_id}', MESSAGE_PROFILES[profile]))
+    
+    async def aget_messages_batch(self, msg_ids, profile='content'):
+        """Fetch many messages concurrently with the given MESSAGE_PROFILES profile.
+        
+        Up to max_concurrency requests are in flight at once, each retried
+        under the shared quota. Returns a list aligned with msg_ids, holding
+        None for messages that could not be fetched.
+        """
+        async def fetch(msg_id):
+            try:
+                return await self.aget_message(msg_id, profile)
+            except Exception as e:
+                print(f"Error fetching message {msg_id}: {e}")
+                return None
+        
+        return list(await asyncio.gather(*(fetch(msg_id) for msg_id in msg_ids)))
+    
+    async def afetch_emails(self, msg_ids):
+        """Async counterpart of _fetch_emails; parsing runs in a worker thread."""
+        full_messages = await self.aget_messages_batch(msg_ids)
+        return await asyncio.to_thread(self._parse_messages, msg_ids, full_messages)
+    
+    async def aclose(self):
+        """Close the running event loop's HTTP client."""
+        client = self._async_clients.pop()
+        if client is not None:
+            await client.aclose()
+    
+    async def _arequest(self, path, params=None):
+        """GET a Gmail REST resource and return the decoded JSON response.
+        
+        Raises httpx.HTTPStatusError for error responses so the rate
+        limiter can tell temporary failures from permanent ones.
+        """
+        headers = await self._aauth_headers()
+        async with self._async_limits.get():
+            response = await self._async_clients.get().get(f"{GMAIL_API_URL}/{path}", params=params, headers=headers)
+        response.raise_for_status()
+        return response.json()
+    
+    async def _aauth_headers(self):
+        """Return OAuth headers, refreshing an expired token in a worker thread."""
+        if not self.creds.valid:
+            await asyncio.to_thread(self._refresh_credentials)
+        headers = {}
+        self.creds.apply(headers)
+        return headers
+    
+    def _refresh_credentials(self):
+        """Refresh the access token once, however many coroutines notice it expired."""
+        with self._creds_lock:
+            if not self.creds.valid:
+                self.creds.refresh(Request())
@@ -0,0 +1,43 @@
+import html
+import re
+from bs4 import BeautifulSoup
+
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+# Elements whose content is never visible text, and comments (including
+# Outlook's conditional comments)
+HTML_HIDDEN_PATTERN = re.compile(
+    r"<(script|style|head|title|noscript|template)\b[^>]*>.*?</\1\s*>|<!--.*?-->", re.IGNORECASE | re.DOTALL)
+HTML_TAG_PATTERN = re.compile(r"<[^>]*>")
+# A '<' that starts a tag but never closes means the markup is too broken for the regex path
+HTML_BROKEN_TAG_PATTERN = re.compile(r"<[A-Za-z/!]")
+
+def normalize_whitespace(text):
+    """Collapse runs of whitespace to single spaces and trim the ends."""
+    return WHITESPACE_PATTERN.sub(' ', text).strip()
+
+def html_to_text(html_content):
+    """Extract the visible text of an HTML email body as a single line of words.
+    
+    Well-formed markup, which is nearly all email, is handled by a few
+    precompiled regular expressions. BeautifulSoup is only used when that
+    leaves something that looks like an unparsed tag behind.
+    """
+    text = fast_html_to_text(html_content)
+    if text is None:
+        text = soup_html_to_text(html_content)
+    return text
+
+def fast_html_to_text(html_content):
+    """Strip tags with regular expressions, returning None if the markup looks broken."""
+    stripped = HTML_TAG_PATTERN.sub(' ', HTML_HIDDEN_PATTERN.sub(' ', html_content))
+    if HTML_BROKEN_TAG_PATTERN.search(stripped):
+        return None
+    return normalize_whitespace(html.unescape(stripped))
+
+def soup_html_to_text(html_content):
+    """Extract text with BeautifulSoup, which tolerates any markup but is much slower."""
+    soup = BeautifulSoup(html_content, 'html.parser')
+    for element in soup(['script', 'style', 'head', 'title', 'noscript', 'template']):
+        element.decompose()
+    return normalize_whitespace(soup.get_text(separator=' ', strip=True))
@@ -0,0 +1,180 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from indexing_job import IndexingJob
+from rag_engine import RAGEngine
+
+# Characters allowed in an account's index directory name
+UNSAFE_PATH_PATTERN = re.compile(r"[^A-Za-z0-9._@-]")
+
+class IndexManager:
+    def __init__(self, root="indexes", memory_budget_mb=1024, idle_seconds=60, engine_options=None):
+        """Initialize a process-wide registry of loaded per-account indexes.
+        
+        Each account's index files live in their own directory under root,
+        and one RAGEngine per account is shared by every session signed in
+        to it. Whenever an account is loaded and the engines' estimated
+        memory use exceeds memory_budget_mb, the least recently used ones are
+        closed, skipping any used in the last idle_seconds, still indexing or
+        held through use(); they are loaded from disk again on next use.
+        engine_options are passed to every RAGEngine, such as its
+        quantization settings.
+        """
+        self.root = root
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self.idle_seconds = idle_seconds
+        self.engine_options = engine_options or {}
+        self.evictions = 0
+        self._engines = OrderedDict()  # account -> RAGEngine, least recently used first
+        self._last_used = {}
+        self._in_use = {}  # account -> number of use() blocks holding its engine
+        self._jobs = {}
+        self._loading = {}
+        self._lock = threading.Lock()
+    
+    def get(self, account, gmail_service):
+        """Return the shared engine for an account, loading its index if needed.
+        
+        gmail_service is only used when the engine has to be created, so the
+        engine keeps the service of the session that loaded it.
+        """
+        # Gmail addresses are case-insensitive
+        return self._get(account.lower(), gmail_service, hold=False)
+    
+    @contextmanager
+    def use(self, account, gmail_service):
+        """Return an account's engine as get does, keeping it from being evicted until the block ends."""
+        account = account.lower()
+        engine = self._get(account, gmail_service, hold=True)
+        try:
+            yield engine
+        finally:
+            with self._lock:
+                self._in_use[account] -= 1
+                if not self._in_use[account]:
+                    del self._in_use[account]
+    
+    def _get(self, account, gmail_service, hold):
+        """Return an account's engine, loading it if needed and holding it for use() if hold is set."""
+        with self._lock:
+            engine = self._touch(account, hold)
+            if engine is not None:
+                return engine
+            account_lock = self._loading.setdefault(account, threading.Lock())
+        
+        # Loading an index can take a while, so only sessions for the same account wait on it
+        with account_lock:
+            with self._lock:
+                engine = self._touch(account, hold)
+                if engine is not None:
+                    return engine
+            engine = RAGEngine(gmail_service, data_dir=self.account_dir(account), **self.engine_options)
+            with self._lock:
+                self._engines[account] = engine
+                self._touch(account, hold)
+        self._evict()
+        return engine
+    
+    def start_indexing(self, account, gmail_service, limit=100, sync=False):
+        """Start indexing an account in the background, or return its job if one is running.
+        
+        With sync set the job applies mailbox changes since the last run
+        instead; see IndexingJob.
+        """
+        account = account.lower()
+        engine = self.get(account, gmail_service)
+        with self._lock:
+            job = self._jobs.get(account)
+            if job is None or not job.running:
+                job = self._jobs[account] = IndexingJob(engine, limit=limit, sync=sync).start()
+            return job
+    
+    def job(self, account):
+        """Return the account's running indexing job, or None."""
+        with self._lock:
+            job = self._jobs.get(account.lower())
+            return job if job is not None and job.running else None
+    
+    def account_dir(self, account):
+        """Directory holding an account's index files."""
+        return os.path.join(self.root, UNSAFE_PATH_PATTERN.sub('_', account.lower()))
+    
+    def memory_usage(self):
+        """Approximate number of bytes held by all loaded engines."""
+        with self._lock:
+            engines = list(self._engines.values())
+        return sum(engine.memory_usage() for engine in engines)
+    
+    def stats(self):
+        """Return how many accounts are loaded, their memory use against the budget, and evictions."""
+        return {
+            'accounts': len(self._engines),
+            'memory_mb': self.memory_usage() / (1024 * 1024),
+            'budget_mb': self.memory_budget / (1024 * 1024),
+            'evictions': self.evictions
+        }
+    
+    def close(self):
+        """Stop any indexing jobs and close every loaded engine."""
+        with self._lock:
+            jobs = list(self._jobs.values())
+            engines = list(self._engines.values())
+            self._jobs.clear()
+            self._engines.clear()
+            self._last_used.clear()
+        for job in jobs:
+            job.cancel()
+            job.wait()
+        for engine in engines:
+            engine.close()
+    
+    def _touch(self, account, hold=False):
+        """Mark an account as just used and return its engine, or None; the caller holds the lock.
+        
+        With hold set, the engine is also counted as in use by a use() block.
+        """
+        engine = self._engines.get(account)
+        if engine is not None:
+            self._engines.move_to_end(account)
+            self._last_used[account] = time.monotonic()
+            if hold:
+                self._in_use[account] = self._in_use.get(account, 0) + 1
+        return engine
+    
+    def _evict(self):
+        """Close least recently used idle engines until the rest fit the budget.
+        
+        Each engine reports its memory use under its own index lock, so that
+        is measured before taking the manager lock, and engines are closed
+        after releasing it.
+        """
+        with self._lock:
+            engines = list(self._engines.items())
+        usage = {account: engine.memory_usage() for account, engine in engines}
+        total = sum(usage.values())
+        evicted = []
+        with self._lock:
+            now = time.monotonic()
+            for account, engine in engines:
+                if total <= self.memory_budget:
+                    break
+                # Skip engines evicted meanwhile, answering a question or indexing
+                if self._engines.get(account) is not engine or self._in_use.get(account):
+                    continue
+                job = self._jobs.get(account)
+                if job is not None and job.running:
+                    continue
+                if now - self._last_used[account] < self.idle_seconds:
+                    continue
+                del self._engines[account]
+                del self._last_used[account]
+                self._jobs.pop(account, None)
+                evicted.append(engine)
+                total -= usage[account]
+                self.evictions += 1
+                print(f"Evicted index for {account} to stay within the memory budget")
+        for engine in evicted:
+            engine.close()
@@ -0,0 +1,83 @@
+import threading
+import time
+
+# Pipeline stages in order, each counting the messages that have finished it
+STAGES = ('fetched', 'parsed', 'embedded', 'indexed')
+
+class IndexingProgress:
+    def __init__(self):
+        """Initialize thread-safe counters of messages through each indexing stage."""
+        self.started_at = time.time()
+        self._counts = dict.fromkeys(STAGES, 0)
+        self._lock = threading.Lock()
+    
+    def add(self, stage, count):
+        """Record count more messages as having finished stage."""
+        with self._lock:
+            self._counts[stage] += count
+    
+    def snapshot(self):
+        """Return the current counts along with the seconds elapsed."""
+        with self._lock:
+            counts = dict(self._counts)
+        counts['elapsed'] = time.time() - self.started_at
+        return counts
+
+class IndexingJob:
+    def __init__(self, rag_engine, limit=100, force_refresh=False, sync=False):
+        """Initialize a job that runs index_emails on a background thread.
+        
+        With sync set it runs sync_emails instead, which may fall back to a
+        full re-index. The engine answers queries from whatever has been
+        indexed so far while the job runs. Cancelling stops after the
+        current batch and leaves a checkpoint, so running index_emails again
+        resumes it.
+        """
+        self.rag_engine = rag_engine
+        self.limit = limit
+        self.force_refresh = force_refresh
+        self.sync = sync
+        self.progress = IndexingProgress()
+        self.status = 'pending'  # pending, running, done, cancelled or failed
+        self.email_count = None
+        self.error = None
+        self._stop = threading.Event()
+        self._thread = None
+    
+    @property
+    def running(self):
+        """Whether the job has been started and has not finished yet."""
+        return self.status in ('pending', 'running') and self._thread is not None
+    
+    def start(self):
+        """Start indexing on a daemon thread and return the job."""
+        self.status = 'running'
+        self._thread = threading.Thread(target=self._run, name="index-job", daemon=True)
+        self._thread.start()
+        return self
+    
+    def cancel(self):
+        """Ask the job to stop after the batch it is indexing."""
+        self._stop.set()
+    
+    def wait(self, timeout=None):
+        """Wait for the job to finish, returning False if it is still running after timeout seconds."""
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return not self.running
+    
+    def _run(self):
+        """Run index_emails or sync_emails and record how it ended."""
+        try:
+            if self.sync:
+                self.email_count = self.rag_engine.sync_emails(
+                    limit=self.limit, progress=self.progress, stop_event=self._stop)
+            else:
+                self.email_count = self.rag_engine.index_emails(
+                    limit=self.limit, force_refresh=self.force_refresh,
+                    progress=self.progress, stop_event=self._stop)
+            self.status = 'done' if self.rag_engine.indexing_complete else 'cancelled'
+        except Exception as e:
+            print(f"Error indexing emails: {e}")
+            self.error = e
+            self.status = 'failed'
@@ -0,0 +1,163 @@
+import queue
+import threading
+
+# Marks the end of a stage's output
+_DONE = object()
+
+class IndexingPipeline:
+    def __init__(self, gmail_service, rag_engine, fetch_workers=4, parse_workers=2,
+                 embed_workers=2, queue_size=8, batch_size=100, progress=None):
+        """Initialize a staged fetch, parse and embed pipeline for indexing.
+        
+        Each stage runs in its own pool of threads and hands work to the next
+        through a bounded queue, so a slow stage applies backpressure instead
+        of letting earlier stages buffer the whole mailbox in memory.
+        progress, an IndexingProgress, counts the messages each stage finishes.
+        """
+        self.gmail_service = gmail_service
+        self.rag_engine = rag_engine
+        self.fetch_workers = fetch_workers
+        self.parse_workers = parse_workers
+        self.embed_workers = embed_workers
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.progress = progress
+        
+        self._stop = threading.Event()
+        self._error = None
+        self._threads = []
+    
+    def run(self, limit=None):
+        """Yield (emails, chunks, embeddings) batches for up to limit messages.
+        
+        The caller consumes the batches on its own thread and appends them to
+        the index, which makes it the final stage of the pipeline.
+        """
+        self._stop.clear()
+        self._error = None
+        self._threads = []
+        
+        id_queue = queue.Queue(self.queue_size)
+        message_queue = queue.Queue(self.queue_size)
+        email_queue = queue.Queue(self.queue_size)
+        result_queue = queue.Queue(self.queue_size)
+        
+        self._start_stage('list', lambda _: self._list_ids(limit, id_queue), None, id_queue, 1)
+        self._start_stage('fetch', self._fetch, id_queue, message_queue, self.fetch_workers)
+        self._start_stage('parse', self._parse, message_queue, email_queue, self.parse_workers)
+        self._start_stage('embed', self._embed, email_queue, result_queue, self.embed_workers)
+        
+        try:
+            while True:
+                item = self._get(result_queue)
+                if item is _DONE:
+                    break
+                yield item
+        finally:
+            # Stops the workers if the consumer fails or abandons the generator
+            self._stop.set()
+            for thread in self._threads:
+                thread.join()
+        
+        if self._error is not None:
+            raise self._error
+    
+    def _list_ids(self, limit, id_queue):
+        """Group the paginated message listing into batches of IDs not yet in the index."""
+        batch_ids = []
+        for message in self.gmail_service.iter_messages(max_results=limit):
+            batch_ids.append(message['id'])
+            if len(batch_ids) >= self.batch_size:
+                if not self._put_unindexed(id_queue, batch_ids):
+                    return None
+                batch_ids = []
+        
+        if batch_ids:
+            self._put_unindexed(id_queue, batch_ids)
+        return None
+    
+    def _put_unindexed(self, id_queue, batch_ids):
+        """Queue the IDs in a batch that are not indexed yet, returning False if the pipeline stopped."""
+        # Messages indexed before an interrupted run stopped are skipped
+        known = self.rag_engine.store.doc_ids_for(batch_ids)
+        batch_ids = [msg_id for msg_id in batch_ids if msg_id not in known]
+        if not batch_ids:
+            return not self._stop.is_set()
+        return self._put(id_queue, batch_ids)
+    
+    def _fetch(self, msg_ids):
+        """Download a batch of full messages, dropping any that failed."""
+        messages = [message for message in self.gmail_service.get_messages_batch(msg_ids) if message is not None]
+        self._advance('fetched', len(messages))
+        return messages
+    
+    def _parse(self, messages):
+        """Extract email content from a batch of raw messages."""
+        emails = self.gmail_service._parse_messages([message.get('id', 'unknown') for message in messages], messages)
+        self._advance('parsed', len(emails))
+        return emails or None
+    
+    def _embed(self, emails):
+        """Embed every chunk of a batch of parsed emails."""
+        chunks, embedding_array = self.rag_engine._embed_emails(emails)
+        self._advance('embedded', len(emails))
+        return emails, chunks, embedding_array
+    
+    def _advance(self, stage, count):
+        """Count messages that finished a stage, if progress is being reported."""
+        if self.progress is not None:
+            self.progress.add(stage, count)
+    
+    def _start_stage(self, name, func, in_queue, out_queue, workers):
+        """Start worker threads that apply func to items from in_queue."""
+        remaining = [workers]
+        lock = threading.Lock()
+        
+        def worker():
+            try:
+                while not self._stop.is_set():
+                    # Source stages have no input and run func exactly once
+                    item = self._get(in_queue) if in_queue is not None else None
+                    if item is _DONE:
+                        # Let sibling workers see the end of input too
+                        self._put(in_queue, _DONE)
+                        break
+                    result = func(item)
+                    if result is not None and not self._put(out_queue, result):
+                        break
+                    if in_queue is None:
+                        break
+            except Exception as e:
+                print(f"Error in {name} stage: {e}")
+                self._error = self._error or e
+                self._stop.set()
+            finally:
+                with lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                if last:
+                    self._put(out_queue, _DONE)
+        
+        for i in range(workers):
+            thread = threading.Thread(target=worker, name=f"index-{name}-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+    
+    def _put(self, q, item):
+        """Put an item on a bounded queue, giving up if the pipeline stops."""
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+    
+    def _get(self, q):
+        """Take an item from a queue, returning _DONE if the pipeline stops."""
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
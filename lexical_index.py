@@ -0,0 +1,56 @@
+import re
+
+# Words that appear in most emails and questions and carry no ranking signal
+STOPWORDS = {
+    'a', 'about', 'all', 'an', 'and', 'any', 'are', 'as', 'at', 'be', 'by', 'did', 'do', 'does',
+    'email', 'emails', 'find', 'for', 'from', 'get', 'have', 'i', 'in', 'is', 'it', 'me', 'message',
+    'messages', 'my', 'of', 'on', 'or', 'show', 'that', 'the', 'this', 'to', 'was', 'what', 'when',
+    'where', 'which', 'who', 'with', 'you', 'your'
+}
+
+# Runs of letters and digits, keeping joined identifiers like INV-567 or amazon.com together
+TOKEN_PATTERN = re.compile(r"#?[A-Za-z0-9]+(?:[-_./@][A-Za-z0-9]+)*")
+PART_PATTERN = re.compile(r"[A-Za-z0-9]+")
+
+def tokenize(text):
+    """Split text into lowercase search terms, dropping stopwords."""
+    return [token.lower() for token in TOKEN_PATTERN.findall(text) if token.lower().lstrip('#') not in STOPWORDS]
+
+def exact_tokens(query):
+    """Return identifier-like terms in a query, such as order numbers or confirmation codes.
+    
+    These are terms with a leading '#', terms mixing letters and digits, or
+    long runs of digits; an embedding captures them poorly while an exact
+    lexical match finds them reliably.
+    """
+    identifiers = []
+    for token in tokenize(query):
+        has_digit = any(c.isdigit() for c in token)
+        has_alpha = any(c.isalpha() for c in token)
+        if (token.startswith('#') and has_digit) or (has_digit and has_alpha) or (has_digit and len(token) >= 5):
+            identifiers.append(token)
+    return identifiers
+
+def build_match_query(terms):
+    """Build an SQLite FTS5 MATCH expression that matches any of the terms.
+    
+    Each term becomes a phrase of its alphanumeric parts, so "inv-567"
+    matches the adjacent tokens "inv" and "567" the full-text index stores.
+    Returns None when there is nothing to search for.
+    """
+    phrases = []
+    for term in terms:
+        parts = PART_PATTERN.findall(term)
+        if parts:
+            phrase = '"' + ' '.join(parts) + '"'
+            if phrase not in phrases:
+                phrases.append(phrase)
+    return ' OR '.join(phrases) if phrases else None
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """Fuse ranked ID lists, scoring each ID by the sum of 1 / (k + rank)."""
+    scores = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=lambda item: scores[item], reverse=True)
@@ -0,0 +1,232 @@
+import re
+import time
+from email.utils import parsedate_to_datetime
+import numpy as np
+
+# Gmail label IDs for the label words utils.extract_query_parameters recognizes
+LABEL_IDS = {
+    'inbox': 'INBOX',
+    'sent': 'SENT',
+    'draft': 'DRAFT',
+    'spam': 'SPAM',
+    'trash': 'TRASH',
+    'important': 'IMPORTANT',
+    'primary': 'CATEGORY_PERSONAL',
+    'social': 'CATEGORY_SOCIAL',
+    'promotions': 'CATEGORY_PROMOTIONS',
+    'updates': 'CATEGORY_UPDATES',
+    'forums': 'CATEGORY_FORUMS',
+}
+
+# Label bitmasks are 64 bits wide; later labels are not filterable
+MAX_LABEL_BITS = 64
+
+DOMAIN_PATTERN = re.compile(r"@([A-Za-z0-9.-]+)")
+
+class MetadataIndex:
+    def __init__(self):
+        """Initialize columnar email metadata used to filter searches.
+        
+        Each email's date (epoch seconds, -1 when unparseable), label bitmask
+        and sender domain ID are held in NumPy arrays indexed by document ID,
+        and each chunk's document ID in an array indexed by chunk ID. A
+        near-duplicate email also records the ID of the representative whose
+        vectors stand in for it, or -1. A filter
+        becomes a boolean mask over chunk IDs with a few vectorized
+        comparisons, which the vector index can search within directly.
+        """
+        self.label_bits = {}
+        self.domain_ids = {}
+        self.dates = np.zeros(0, dtype=np.int64)
+        self.labels = np.zeros(0, dtype=np.uint64)
+        self.domains = np.zeros(0, dtype=np.int32)
+        self.present = np.zeros(0, dtype=bool)
+        self.duplicate_of = np.zeros(0, dtype=np.int64)
+        self.chunk_docs = np.zeros(0, dtype=np.int64)
+    
+    def __len__(self):
+        return int(np.count_nonzero(self.present))
+    
+    def memory_usage(self):
+        """Number of bytes held by the metadata arrays."""
+        return sum(array.nbytes for array in (
+            self.dates, self.labels, self.domains, self.present, self.duplicate_of, self.chunk_docs))
+    
+    def add(self, doc_ids, emails):
+        """Record the metadata of emails stored under the given IDs."""
+        if not doc_ids:
+            return
+        self._reserve(max(doc_ids) + 1)
+        for doc_id, email in zip(doc_ids, emails):
+            self.dates[doc_id] = self._parse_date(email.get('date'))
+            self.labels[doc_id] = self._label_mask(email.get('labels', []), create=True)
+            self.domains[doc_id] = self._domain_id(email.get('sender'))
+            self.present[doc_id] = True
+            duplicate_of = email.get('duplicate_of')
+            self.duplicate_of[doc_id] = -1 if duplicate_of is None else duplicate_of
+    
+    def add_chunks(self, chunk_ids, doc_ids):
+        """Record which email each chunk ID belongs to."""
+        chunk_ids = np.asarray(chunk_ids, dtype=np.int64)
+        if len(chunk_ids) == 0:
+            return
+        needed = int(chunk_ids.max()) + 1
+        if needed > len(self.chunk_docs):
+            grown = np.full(max(needed, 2 * len(self.chunk_docs)), -1, dtype=np.int64)
+            grown[:len(self.chunk_docs)] = self.chunk_docs
+            self.chunk_docs = grown
+        self.chunk_docs[chunk_ids] = np.asarray(doc_ids, dtype=np.int64)
+    
+    def update_labels(self, doc_id, labels):
+        """Replace the label bitmask of an email."""
+        if doc_id < len(self.labels):
+            self.labels[doc_id] = self._label_mask(labels, create=True)
+    
+    def set_duplicate_of(self, doc_ids, duplicate_of):
+        """Point emails at a new representative, or pass None to make them stand alone."""
+        doc_ids = [doc_id for doc_id in doc_ids if doc_id < len(self.duplicate_of)]
+        self.duplicate_of[doc_ids] = -1 if duplicate_of is None else duplicate_of
+    
+    def representative(self, doc_id):
+        """Return the ID of the email whose vectors stand in for doc_id."""
+        if doc_id < len(self.duplicate_of) and self.duplicate_of[doc_id] >= 0:
+            return int(self.duplicate_of[doc_id])
+        return doc_id
+    
+    def newest_member(self, representative, doc_mask):
+        """Return the newest email set in doc_mask that representative stands in for, or None."""
+        members = np.flatnonzero((self.duplicate_of == representative) & doc_mask)
+        if len(members) == 0:
+            return None
+        return int(members[np.argmax(self.dates[members])])
+    
+    def remove(self, doc_ids):
+        """Drop emails; their chunks stop matching any filter."""
+        doc_ids = [doc_id for doc_id in doc_ids if doc_id < len(self.present)]
+        self.present[doc_ids] = False
+    
+    def clear(self):
+        """Forget every email."""
+        self.__init__()
+    
+    def filter_for(self, params, now=None):
+        """Turn utils.extract_query_parameters output into a filter, or None.
+        
+        The filter is a dict with any of 'after' (epoch seconds), 'labels'
+        (a bitmask every match must have) and 'domains' (allowed domain IDs).
+        Parameters that match nothing known about the mailbox, such as a
+        sender whose domain has never been seen, are left out rather than
+        filtering everything away.
+        """
+        now = time.time() if now is None else now
+        query_filter = {}
+        
+        if params.get('time_period'):
+            query_filter['after'] = int(now - params['time_period'] * 86400)
+        
+        label_names = []
+        if params.get('is_unread'):
+            label_names.append('UNREAD')
+        if params.get('label') in LABEL_IDS:
+            label_names.append(LABEL_IDS[params['label']])
+        # A label no email has ever carried cannot be filtered on
+        if label_names and all(name in self.label_bits for name in label_names):
+            query_filter['labels'] = self._label_mask(label_names)
+        
+        sender = params.get('sender')
+        if sender:
+            term = sender.lower().split('@')[-1].strip('.')
+            # Match whole labels, so "amazon" finds amazon.com and mail.amazon.co.uk but not "a" everything
+            domains = [domain_id for domain, domain_id in self.domain_ids.items() if f".{term}." in f".{domain}."]
+            if domains:
+                query_filter['domains'] = np.array(domains, dtype=np.int32)
+        
+        return query_filter or None
+    
+    def doc_mask(self, query_filter):
+        """Return a boolean array over document IDs of emails matching a filter."""
+        mask = self.present.copy()
+        if 'after' in query_filter:
+            mask &= self.dates >= query_filter['after']
+        if 'labels' in query_filter:
+            required = np.uint64(query_filter['labels'])
+            mask &= (self.labels & required) == required
+        if 'domains' in query_filter:
+            mask &= np.isin(self.domains, query_filter['domains'])
+        return mask
+    
+    def chunk_mask(self, query_filter):
+        """Return a boolean array over chunk IDs of chunks whose email matches a filter.
+        
+        Near-duplicates have no vectors of their own, so the chunks of their
+        representative are included when any of them match.
+        """
+        doc_mask = self.doc_mask(query_filter)
+        doc_mask[self.duplicate_of[doc_mask & (self.duplicate_of >= 0)]] = True
+        owned = self.chunk_docs >= 0
+        mask = np.zeros(len(self.chunk_docs), dtype=bool)
+        mask[owned] = doc_mask[self.chunk_docs[owned]]
+        return mask
+    
+    def save(self, path):
+        """Write the metadata arrays to an .npz file."""
+        with open(path, 'wb') as f:
+            np.savez(
+                f, dates=self.dates, labels=self.labels, domains=self.domains,
+                present=self.present, duplicate_of=self.duplicate_of, chunk_docs=self.chunk_docs,
+                label_names=np.array(sorted(self.label_bits, key=self.label_bits.get), dtype=str),
+                domain_names=np.array(sorted(self.domain_ids, key=self.domain_ids.get), dtype=str))
+    
+    def load(self, path):
+        """Read metadata previously written by save."""
+        with np.load(path) as data:
+            self.dates = data['dates']
+            self.labels = data['labels']
+            self.domains = data['domains']
+            self.present = data['present']
+            self.duplicate_of = (data['duplicate_of'] if 'duplicate_of' in data.files
+                                 else np.full(len(self.present), -1, dtype=np.int64))
+            self.chunk_docs = data['chunk_docs']
+            self.label_bits = {str(name): bit for bit, name in enumerate(data['label_names'])}
+            self.domain_ids = {str(name): domain_id for domain_id, name in enumerate(data['domain_names'])}
+    
+    def _reserve(self, size):
+        """Grow the per-email arrays to hold at least size IDs."""
+        if size <= len(self.present):
+            return
+        size = max(size, 2 * len(self.present))
+        extra = size - len(self.present)
+        self.dates = np.concatenate([self.dates, np.full(extra, -1, dtype=np.int64)])
+        self.labels = np.concatenate([self.labels, np.zeros(extra, dtype=np.uint64)])
+        self.domains = np.concatenate([self.domains, np.full(extra, -1, dtype=np.int32)])
+        self.present = np.concatenate([self.present, np.zeros(extra, dtype=bool)])
+        self.duplicate_of = np.concatenate([self.duplicate_of, np.full(extra, -1, dtype=np.int64)])
+    
+    def _label_mask(self, labels, create=False):
+        """Return the bitmask for a list of labels, assigning new bits if create is set."""
+        mask = 0
+        for label in labels:
+            bit = self.label_bits.get(label)
+            if bit is None and create and len(self.label_bits) < MAX_LABEL_BITS:
+                bit = self.label_bits[label] = len(self.label_bits)
+            if bit is not None:
+                mask |= 1 << bit
+        return np.uint64(mask)
+    
+    def _domain_id(self, sender):
+        """Return the ID of the sender's email domain, assigning one if it is new."""
+        match = DOMAIN_PATTERN.search(sender or '')
+        if not match:
+            return -1
+        domain = match.group(1).lower()
+        if domain not in self.domain_ids:
+            self.domain_ids[domain] = len(self.domain_ids)
+        return self.domain_ids[domain]
+    
+    @staticmethod
+    def _parse_date(date):
+        """Parse a Date header into epoch seconds, or -1 if it cannot be read."""
+        try:
+            return int(parsedate_to_datetime(date).timestamp())
+        except (TypeError, ValueError, IndexError, OverflowError):
+            return -1
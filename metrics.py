@@ -0,0 +1,277 @@
+import bisect
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds of the latency histogram buckets, spanning cache hits to slow API calls
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _label_key(labels):
+    """Hashable, order-independent form of a label dict."""
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+def _format_labels(key, extra=()):
+    """Render a label key in Prometheus text format, e.g. {stage="embed"}."""
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """Initialize a cumulative-bucket histogram of observed values."""
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+    
+    def observe(self, value):
+        """Record one value."""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+    
+    def quantile(self, q):
+        """Estimate the q-th quantile by interpolating within its bucket."""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for position, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[position - 1] if position > 0 else 0.0
+                upper = self.buckets[position] if position < len(self.buckets) else self.max
+                return min(self.max, lower + (upper - lower) * (rank - seen) / count)
+            seen += count
+        return self.max
+
+class InMemorySink:
+    def __init__(self, max_events=10000):
+        """Initialize a sink that aggregates counters and histograms in memory.
+        
+        The most recent max_events raw records are also kept in events.
+        """
+        self.events = deque(maxlen=max_events)
+        self._counters = {}  # (name, label key) -> total
+        self._histograms = {}  # (name, label key) -> Histogram
+        self._lock = threading.Lock()
+    
+    def record(self, kind, name, value, labels):
+        """Add a 'counter' increment or 'histogram' observation."""
+        key = (name, _label_key(labels))
+        with self._lock:
+            self.events.append((kind, name, value, dict(labels)))
+            if kind == 'counter':
+                self._counters[key] = self._counters.get(key, 0) + value
+            else:
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = Histogram()
+                histogram.observe(value)
+    
+    def counter(self, name, **labels):
+        """Total of a counter over every label set that includes the given labels."""
+        wanted = set(_label_key(labels))
+        with self._lock:
+            return sum(value for (counter_name, key), value in self._counters.items()
+                       if counter_name == name and wanted <= set(key))
+    
+    def histogram(self, name, **labels):
+        """Summary of a histogram's observations for the given labels, or None."""
+        with self._lock:
+            histogram = self._histograms.get((name, _label_key(labels)))
+            return self._summary(histogram) if histogram is not None else None
+    
+    def snapshot(self):
+        """Return every counter and histogram summary, keyed by name and then by label set."""
+        counters = {}
+        histograms = {}
+        with self._lock:
+            for (name, key), value in self._counters.items():
+                counters.setdefault(name, {})[key] = value
+            for (name, key), histogram in self._histograms.items():
+                histograms.setdefault(name, {})[key] = self._summary(histogram)
+        return {'counters': counters, 'histograms': histograms}
+    
+    def clear(self):
+        """Forget everything recorded so far."""
+        with self._lock:
+            self.events.clear()
+            self._counters.clear()
+            self._histograms.clear()
+    
+    def _summary(self, histogram):
+        """Count, total, mean and estimated percentiles of a histogram; the caller holds the lock."""
+        return {
+            'count': histogram.count,
+            'sum': histogram.sum,
+            'mean': histogram.sum / histogram.count if histogram.count else 0.0,
+            'p50': histogram.quantile(0.5),
+            'p99': histogram.quantile(0.99),
+            'max': histogram.max
+        }
+
+class PrometheusSink(InMemorySink):
+    def __init__(self, namespace="gmail_rag"):
+        """Initialize a sink that renders its totals in the Prometheus text exposition format."""
+        super().__init__(max_events=0)
+        self.namespace = namespace
+        self._httpd = None
+    
+    def render(self):
+        """Return the current counters and histograms as Prometheus exposition text."""
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(
+                ((key, (list(histogram.counts), histogram.sum, histogram.count, histogram.buckets))
+                 for key, histogram in self._histograms.items()), key=lambda item: item[0])
+        
+        for name in sorted({name for (name, _), _ in counters}):
+            full_name = f"{self.namespace}_{name}"
+            lines.append(f"# TYPE {full_name} counter")
+            for (counter_name, key), value in counters:
+                if counter_name == name:
+                    lines.append(f"{full_name}{_format_labels(key)} {value}")
+        
+        for name in sorted({name for (name, _), _ in histograms}):
+            full_name = f"{self.namespace}_{name}"
+            lines.append(f"# TYPE {full_name} histogram")
+            for (histogram_name, key), (counts, total, count, buckets) in histograms:
+                if histogram_name != name:
+                    continue
+                cumulative = 0
+                for bound, bucket_count in zip(list(buckets) + [math.inf], counts):
+                    cumulative += bucket_count
+                    le = '+Inf' if bound == math.inf else repr(bound)
+                    lines.append(f"{full_name}_bucket{_format_labels(key, [('le', le)])} {cumulative}")
+                lines.append(f"{full_name}_sum{_format_labels(key)} {total}")
+                lines.append(f"{full_name}_count{_format_labels(key)} {count}")
+        return '\n'.join(lines) + '\n'
+    
+    def serve(self, port, host="0.0.0.0"):
+        """Serve render() at /metrics on a background thread for Prometheus to scrape."""
+        sink = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                content = sink.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+            
+            def log_message(self, format, *args):
+                pass
+        
+        self._httpd = ThreadingHTTPServer((host, port), Handler)
+        self._httpd.daemon_threads = True
+        threading.Thread(target=self._httpd.serve_forever, name="metrics-http", daemon=True).start()
+        print(f"Serving metrics at http://{host}:{port}/metrics")
+        return self
+    
+    def stop(self):
+        """Stop serving metrics."""
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+class LogSink:
+    def __init__(self, min_seconds=0.0, counters=False):
+        """Initialize a sink that prints stage timings of at least min_seconds.
+        
+        Counter increments are printed too when counters is True.
+        """
+        self.min_seconds = min_seconds
+        self.counters = counters
+    
+    def record(self, kind, name, value, labels):
+        if kind == 'counter' and not self.counters:
+            return
+        if kind == 'histogram' and value < self.min_seconds:
+            return
+        label_text = ' '.join(f"{label}={label_value}" for label, label_value in sorted(labels.items()))
+        amount = f"{value:.3f}s" if kind == 'histogram' else f"+{value}"
+        print(f"[metrics] {name} {label_text} {amount}".replace('  ', ' '))
+
+class Metrics:
+    def __init__(self, sinks=None):
+        """Initialize a recorder that forwards counters and timings to sinks.
+        
+        Each sink has a record(kind, name, value, labels) method. By default
+        an InMemorySink aggregates everything for snapshot(). Recording is a
+        dictionary update under a lock, cheap enough for every API call.
+        """
+        self.sinks = list(sinks) if sinks is not None else [InMemorySink()]
+    
+    def add_sink(self, sink):
+        """Start sending records to sink and return it."""
+        self.sinks.append(sink)
+        return sink
+    
+    def remove_sink(self, sink):
+        """Stop sending records to sink."""
+        if sink in self.sinks:
+            self.sinks.remove(sink)
+    
+    def increment(self, name, value=1, **labels):
+        """Add value to a counter."""
+        if value:
+            self._record('counter', name, value, labels)
+    
+    def observe(self, name, value, **labels):
+        """Record a value in a histogram."""
+        self._record('histogram', name, value, labels)
+    
+    @contextmanager
+    def timer(self, stage, **labels):
+        """Time the body of a with block into the stage_seconds histogram under the given stage.
+        
+        Blocks that raise are counted in stage_errors_total instead.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.increment('stage_errors_total', stage=stage, **labels)
+            raise
+        self.observe('stage_seconds', time.perf_counter() - start, stage=stage, **labels)
+    
+    def counter(self, name, **labels):
+        """Total of a counter in the first InMemorySink over label sets including labels, or 0."""
+        sink = self._memory_sink()
+        return sink.counter(name, **labels) if sink is not None else 0
+    
+    def snapshot(self):
+        """Return the first InMemorySink's snapshot, or empty totals if there is none."""
+        sink = self._memory_sink()
+        return sink.snapshot() if sink is not None else {'counters': {}, 'histograms': {}}
+    
+    def _memory_sink(self):
+        """The first InMemorySink, which queries read from, or None."""
+        for sink in self.sinks:
+            if isinstance(sink, InMemorySink):
+                return sink
+        return None
+    
+    def _record(self, kind, name, value, labels):
+        """Send a record to every sink, so one failing sink doesn't stop the others or the caller."""
+        for sink in list(self.sinks):
+            try:
+                sink.record(kind, name, value, labels)
+            except Exception as e:
+                print(f"Error recording metric {name}: {e}")
+
+# Recorder shared by every GmailService and RAGEngine in the process
+metrics = Metrics()
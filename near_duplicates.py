@@ -0,0 +1,134 @@
+import hashlib
+import re
+import threading
+import numpy as np
+from metadata_index import DOMAIN_PATTERN
+
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+DIGITS_PATTERN = re.compile(r"[0-9]+")
+
+class NearDuplicateIndex:
+    def __init__(self, max_distance=3, shingle_size=3, min_words=20):
+        """Initialize a SimHash index for spotting near-duplicate emails.
+        
+        Each email gets a 64-bit SimHash of its subject and body word
+        shingles, with digits folded together so receipts and notifications
+        that differ only in order numbers, amounts or dates still collide.
+        Two emails from the same sender domain are near-duplicates when their
+        fingerprints differ in at most max_distance bits. Fingerprints are
+        split into max_distance + 1 bands, so any near-duplicate shares at
+        least one band exactly and only those candidates are compared.
+        
+        Emails shorter than min_words words are never treated as duplicates;
+        they are cheap to embed and too short to fingerprint reliably.
+        """
+        self.max_distance = max_distance
+        self.shingle_size = shingle_size
+        self.min_words = min_words
+        self.band_bits = 64 // (max_distance + 1)
+        self.checked = 0
+        self.duplicates = 0
+        self._bands = {}
+        self._fingerprints = {}
+        self._lock = threading.Lock()
+    
+    def fingerprint(self, email):
+        """Return the SimHash of an email as a signed 64-bit int, or None if it is too short."""
+        text = DIGITS_PATTERN.sub('0', f"{email['subject']} {email['body_text']}".lower())
+        words = WORD_PATTERN.findall(text)
+        if len(words) < self.min_words:
+            return None
+        
+        shingles = {' '.join(words[i:i + self.shingle_size]) for i in range(len(words) - self.shingle_size + 1)}
+        hashes = np.array(
+            [int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'little')
+             for shingle in shingles], dtype=np.uint64)
+        # Each bit of the fingerprint is the majority vote of that bit across shingle hashes
+        bits = np.unpackbits(hashes.view(np.uint8).reshape(-1, 8), axis=1, bitorder='little')
+        votes = bits.sum(axis=0, dtype=np.int64) * 2 > len(hashes)
+        return int(np.packbits(votes, bitorder='little').view(np.int64)[0])
+    
+    def find_or_add(self, doc_id, email, fingerprint):
+        """Return the ID of an indexed near-duplicate of email, or register it as a new representative.
+        
+        Returns None when email has no near-duplicate, in which case it is
+        added under doc_id for later emails to match against.
+        """
+        if fingerprint is None:
+            return None
+        domain = self._domain(email)
+        with self._lock:
+            self.checked += 1
+            for band in self._band_keys(domain, fingerprint):
+                for candidate in self._bands.get(band, ()):
+                    if self._distance(fingerprint, self._fingerprints[candidate][1]) <= self.max_distance:
+                        self.duplicates += 1
+                        return candidate
+            self._add(doc_id, domain, fingerprint)
+            return None
+    
+    def add(self, doc_id, email, fingerprint):
+        """Register an indexed email as a representative without checking for duplicates."""
+        if fingerprint is None:
+            return
+        with self._lock:
+            self._add(doc_id, self._domain(email), fingerprint)
+    
+    def remove(self, doc_ids):
+        """Stop matching new emails against the given representatives."""
+        with self._lock:
+            for doc_id in doc_ids:
+                entry = self._fingerprints.pop(doc_id, None)
+                if entry is None:
+                    continue
+                for band in self._band_keys(*entry):
+                    members = self._bands.get(band)
+                    if members is not None:
+                        members.discard(doc_id)
+                        if not members:
+                            del self._bands[band]
+    
+    def clear(self):
+        """Forget every representative and reset the counters."""
+        with self._lock:
+            self._bands = {}
+            self._fingerprints = {}
+            self.checked = 0
+            self.duplicates = 0
+    
+    def stats(self):
+        """Return how many emails were checked and how many were near-duplicates."""
+        return {
+            'checked': self.checked,
+            'duplicates': self.duplicates,
+            'dedup_ratio': self.duplicates / self.checked if self.checked else 0.0,
+            'representatives': len(self._fingerprints)
+        }
+    
+    def memory_usage(self):
+        """Approximate number of bytes held by the fingerprint and band tables."""
+        # A dict entry and tuple per representative, and a set entry in each band
+        return len(self._fingerprints) * (200 + (self.max_distance + 1) * 100)
+    
+    def _add(self, doc_id, domain, fingerprint):
+        """Index a representative's bands; the caller holds the lock."""
+        self._fingerprints[doc_id] = (domain, fingerprint)
+        for band in self._band_keys(domain, fingerprint):
+            self._bands.setdefault(band, set()).add(doc_id)
+    
+    def _band_keys(self, domain, fingerprint):
+        """Return the (domain, band number, band value) keys of a fingerprint."""
+        value = fingerprint & 0xFFFFFFFFFFFFFFFF
+        mask = (1 << self.band_bits) - 1
+        return [(domain, i, (value >> (i * self.band_bits)) & mask) for i in range(self.max_distance + 1)]
+    
+    @staticmethod
+    def _distance(a, b):
+        """Number of differing bits between two fingerprints."""
+        return bin((a ^ b) & 0xFFFFFFFFFFFFFFFF).count('1')
+    
+    @staticmethod
+    def _domain(email):
+        """The sender's email domain, so only mail from the same sender is grouped."""
+        match = DOMAIN_PATTERN.search(email.get('sender') or '')
+        return match.group(1).lower() if match else ''
@@ -0,0 +1,96 @@
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import CancelledError, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+def _parse_chunk(messages):
+    """Parse a chunk of raw Gmail messages in a worker process, using None for failures."""
+    from gmail_service import GmailService
+    
+    emails = []
+    for message in messages:
+        try:
+            emails.append(GmailService.get_message_content(message))
+        except Exception as e:
+            print(f"Error processing message {message.get('id', 'unknown')}: {e}")
+            emails.append(None)
+    return emails
+
+class ParsePool:
+    def __init__(self, processes=None, chunk_size=25):
+        """Initialize a pool of worker processes that parse raw Gmail messages.
+        
+        Decoding and HTML-to-text extraction are CPU-bound and would otherwise
+        share the GIL with the threads doing Gmail I/O. Messages are sent to
+        the workers in chunks of chunk_size so pickling and IPC overhead is
+        paid per chunk rather than per message. processes defaults to the
+        number of CPUs. The workers are started on first use.
+        """
+        self.processes = processes or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self._executor = None
+        self._lock = threading.Lock()
+    
+    def imap(self, messages):
+        """Yield the parsed email for each raw message, or None if it failed, in input order.
+        
+        messages may be any iterable, including a generator. At most two
+        chunks per worker are in flight, so results stream back as soon as
+        the chunks ahead of them are done instead of after the whole input.
+        """
+        pending = deque()
+        chunk = []
+        for message in messages:
+            chunk.append(message)
+            if len(chunk) >= self.chunk_size:
+                pending.append(self._submit(chunk))
+                chunk = []
+                if len(pending) >= self.processes * 2:
+                    yield from self._result(pending.popleft())
+        if chunk:
+            pending.append(self._submit(chunk))
+        while pending:
+            yield from self._result(pending.popleft())
+    
+    def close(self):
+        """Shut down the worker processes; they are restarted if the pool is used again."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+    
+    def _submit(self, chunk):
+        """Send a chunk to the workers, returning what _result needs to collect or redo it."""
+        with self._lock:
+            if self._executor is None:
+                # Spawned rather than forked, since the parent runs I/O threads
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.processes, mp_context=multiprocessing.get_context('spawn'))
+            executor = self._executor
+        try:
+            return executor.submit(_parse_chunk, chunk), executor, chunk
+        except (BrokenProcessPool, RuntimeError) as e:
+            print(f"Parse pool unavailable, parsing in process: {e}")
+            self._discard(executor)
+            return None, None, chunk
+    
+    def _result(self, submitted):
+        """Return a chunk's parsed emails, parsing it in this process if its worker died."""
+        future, executor, chunk = submitted
+        if future is not None:
+            try:
+                return future.result()
+            except (BrokenProcessPool, CancelledError) as e:
+                print(f"Parse worker failed, parsing in process: {e}")
+                self._discard(executor)
+        return _parse_chunk(chunk)
+    
+    def _discard(self, executor):
+        """Drop a broken executor so the next chunk starts a fresh one."""
+        with self._lock:
+            if executor is not None and self._executor is executor:
+                self._executor = None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,137 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+from metrics import metrics
+
+class LRUCache:
+    def __init__(self, max_entries=1024, name='lru'):
+        """Initialize an in-memory least-recently-used cache; name labels its lookup metrics."""
+        self.max_entries = max_entries
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def get(self, key):
+        """Return the value stored under key, or None."""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        metrics.increment('cache_lookups_total', cache=self.name, result='miss' if value is None else 'hit')
+        return value
+    
+    def peek(self, key):
+        """Return the value stored under key without counting a lookup or refreshing it."""
+        with self._lock:
+            return self._entries.get(key)
+    
+    def put(self, key, value):
+        """Store value under key, evicting the least recently used entry if full."""
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def values(self):
+        """Return a list of the cached values, least recently used first."""
+        with self._lock:
+            return list(self._entries.values())
+    
+    def clear(self):
+        """Remove every entry."""
+        with self._lock:
+            self._entries.clear()
+    
+    def stats(self):
+        """Return hit and miss counters along with the current cache size."""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': len(self._entries)
+        }
+
+class SemanticAnswerCache:
+    def __init__(self, threshold=0.95, max_entries=256):
+        """Initialize a cache of answers keyed by question meaning.
+        
+        A stored answer is reused when a new question's normalized embedding
+        has cosine similarity of at least threshold with an earlier one and
+        retrieval picked exactly the same emails, so a rephrased question is
+        only answered from cache when it would get the same context. Questions
+        answered without an embedding only match the identical text.
+        Clear the cache whenever the index changes.
+        """
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = []  # (query, embedding or None, doc IDs, answer), oldest first
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def get(self, query, embedding, doc_ids):
+        """Return a cached answer for the question and retrieved emails, or None."""
+        doc_ids = tuple(doc_ids)
+        with self._lock:
+            best = None
+            best_similarity = self.threshold
+            for position, (cached_query, cached_embedding, cached_doc_ids, answer) in enumerate(self._entries):
+                if cached_doc_ids != doc_ids:
+                    continue
+                if cached_query == query:
+                    best = position
+                    break
+                if embedding is None or cached_embedding is None:
+                    continue
+                similarity = float(np.dot(cached_embedding, embedding))
+                if similarity >= best_similarity:
+                    best, best_similarity = position, similarity
+            
+            if best is None:
+                self.misses += 1
+                answer = None
+            else:
+                # Move the entry to the end so the least recently used is evicted first
+                entry = self._entries.pop(best)
+                self._entries.append(entry)
+                self.hits += 1
+                answer = entry[3]
+        metrics.increment('cache_lookups_total', cache='answer', result='miss' if answer is None else 'hit')
+        return answer
+    
+    def put(self, query, embedding, doc_ids, answer):
+        """Store the answer to a question along with the emails it was based on."""
+        if embedding is not None:
+            embedding = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        with self._lock:
+            self._entries.append((query, embedding, tuple(doc_ids), answer))
+            if len(self._entries) > self.max_entries:
+                self._entries.pop(0)
+    
+    def clear(self):
+        """Remove every entry."""
+        with self._lock:
+            self._entries = []
+    
+    def stats(self):
+        """Return hit and miss counters along with the current cache size."""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': len(self._entries)
+        }
@@ -1,32 +1,126 @@
 import os
+import asyncio
 import json
+import threading
 import faiss
 import numpy as np
 from datetime import datetime
 import time
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 from dotenv import load_dotenv
+from googleapiclient.errors import HttpError
+from async_utils import LoopLocal
+from embedding_cache import EmbeddingCache, shared_embedding_cache
+from indexing_pipeline import IndexingPipeline
+from rate_limiter import shared_rate_limiter
+from vector_index import VectorIndex
+from email_store import EmailStore
+from metadata_index import MetadataIndex
+from context_builder import ContextBuilder
+from near_duplicates import NearDuplicateIndex
+from query_cache import LRUCache, SemanticAnswerCache
+from metrics import metrics
+from lexical_index import tokenize, exact_tokens, build_match_query, reciprocal_rank_fusion
+from utils import extract_query_parameters
+
+try:
+    import tiktoken
+except ImportError:  # Fall back to a character-based estimate
+    tiktoken = None
 
 # Load environment variables
 load_dotenv()
 
 class RAGEngine:
-    def __init__(self, gmail_service=None):
-        """Initialize the RAG Engine with Gmail service and OpenAI integration."""
+    def __init__(self, gmail_service=None, rate_limiter=None, index_type='auto', ann_threshold=20000,
+                 data_dir=None, quantization=None, search_dimension=None):
+        """Initialize the RAG Engine with Gmail service and OpenAI integration.
+        
+        index_type selects the vector index ('flat', 'ivf', 'hnsw' or 'auto');
+        'auto' switches from exact to approximate search past ann_threshold
+        vectors. Each chunk of an email body has its own vector, so that is
+        reached at several times fewer emails.
+        quantization ('fp16', 'sq8' or 'pq') and search_dimension shrink the
+        vectors held in memory, re-ranking results at full precision.
+        The index files are kept in data_dir, one directory per account, or
+        in the working directory when it is None.
+        """
         self.gmail_service = gmail_service
+        self.rate_limiter = rate_limiter or shared_rate_limiter
         self.api_key = os.getenv('OPENAI_API_KEY')
         if not self.api_key:
             raise ValueError("OpenAI API key not found. Please set it in the .env file.")
         
-        self.client = OpenAI(api_key=self.api_key)
+        # Retries are handled by the rate limiter so they respect the shared quota
+        self.client = OpenAI(api_key=self.api_key, max_retries=0)
+        # The async methods use one client and concurrency limit per event loop
+        self.openai_concurrency = 16
+        self._async_clients = LoopLocal(lambda: AsyncOpenAI(api_key=self.api_key, max_retries=0))
+        self._openai_limits = LoopLocal(lambda: asyncio.Semaphore(self.openai_concurrency))
         
         # Initialize vector storage
         self.dimension = 1536  # OpenAI embeddings dimension
-        self.index = faiss.IndexFlatL2(self.dimension)
-        self.emails = []
-        self.index_file = "email_index.index"
-        self.emails_file = "emails_data.json"
+        self.embedding_model = "text-embedding-3-small"
+        # the newest OpenAI model is "gpt-4o" which was released May 13, 2024.
+        # do not change this unless explicitly requested by the user
+        self.chat_model = "gpt-4o"
+        self.embedding_batch_size = 256  # Max texts per embeddings request
+        self.embedding_batch_tokens = 100000  # Max tokens per embeddings request
+        # Shared by every engine in the process, so its size cap covers all accounts
+        self.embedding_cache = shared_embedding_cache("embedding_cache.db")
+        # Repeated questions skip the embedding call, and near-identical ones
+        # that retrieve the same emails skip the chat call too
+        self.query_embedding_cache = LRUCache(max_entries=1024, name='query_embedding')
+        self.answer_cache = SemanticAnswerCache(threshold=0.95, max_entries=256)
+        # Long bodies are embedded as overlapping chunks, one vector each
+        self.chunk_size = 800  # Characters of body text per chunk
+        self.chunk_overlap = 150
+        self.max_chunks_per_email = 32
+        # Worker threads per indexing stage and the queue size between stages
+        self.pipeline_workers = {'fetch': 4, 'parse': 2, 'embed': 2}
+        self.pipeline_queue_size = 8
+        # An interrupted indexing run resumes from its last checkpoint. Each
+        # checkpoint rewrites the whole index, so they grow further apart as
+        # it grows, keeping the total cost linear in the mailbox size
+        self.checkpoint_every = 1000  # Minimum emails indexed between checkpoints
+        self.checkpoint_growth = 0.5  # Emails between checkpoints as a fraction of those indexed
+        self.indexing_complete = True
+        # Each model's tokenizer, so budgets are counted the way the API counts them
+        self._encodings = {model: self._load_encoding(model) for model in (self.embedding_model, self.chat_model)}
+        # Email passages are quoted in the prompt until this many tokens are used
+        self.context_builder = ContextBuilder(self._count_tokens, self._truncate_tokens, token_budget=3000)
+        self.index_type = index_type
+        self.ann_threshold = ann_threshold
+        self.quantization = quantization
+        self.search_dimension = search_dimension
+        self.data_dir = data_dir or "."
         self.is_demo_mode = gmail_service is None
+        if not self.is_demo_mode:
+            os.makedirs(self.data_dir, exist_ok=True)
+        self.index_file = os.path.join(self.data_dir, "email_index.index")
+        self.vectors_file = os.path.join(self.data_dir, "email_vectors.f32")
+        self.index = self._new_index()
+        # Recall and compression of a quantized index, measured after each indexing run
+        self.index_quality = None
+        self.next_doc_id = 0
+        self.next_chunk_id = 0
+        self.emails_file = os.path.join(self.data_dir, "emails.db")
+        self.metadata_file = os.path.join(self.data_dir, "email_metadata.npz")
+        self.state_file = os.path.join(self.data_dir, "index_state.json")
+        self.history_id = None
+        # Email data keyed by the stable integer ID its vector is stored under;
+        # demo mode keeps it in memory so sample data never touches disk
+        self.store = EmailStore(":memory:" if self.is_demo_mode else self.emails_file)
+        # Dates, labels and sender domains as arrays for filtering searches
+        self.metadata = MetadataIndex()
+        # Near-duplicate emails are stored but share their representative's vectors
+        self.near_duplicates = NearDuplicateIndex()
+        self._doc_id_lock = threading.Lock()
+        # Held while the index, metadata and email data change, so queries can
+        # run against a partially built index while indexing goes on
+        self._index_lock = threading.RLock()
+        # Held for a whole indexing run or sync, so only one changes the index at a time
+        self._indexing_lock = threading.Lock()
         
         # Load existing index if available and not in demo mode
         if not self.is_demo_mode:
@@ -34,165 +128,1096 @@ class RAGEngine:
     
     def _get_embedding(self, text):
         """Generate embedding for text using OpenAI API."""
+        return self._get_embeddings([text])[0]
+    
+    def _get_embeddings(self, texts):
+        """Generate embeddings for many texts with as few API calls as possible.
+        
+        Texts already in the embedding cache are not sent again. The rest are
+        packed into requests holding at most embedding_batch_size items and
+        embedding_batch_tokens tokens. Embeddings are returned in the same
+        order as texts.
+        """
+        with metrics.timer('embed'):
+            texts, keys, embeddings, batches = self._plan_embeddings(texts)
+            for positions, tokens in batches:
+                self._fill_embeddings(embeddings, keys, texts, positions, tokens)
+        return embeddings
+    
+    async def _aget_embeddings(self, texts):
+        """Async counterpart of _get_embeddings; the requests are sent concurrently."""
+        with metrics.timer('embed'):
+            # Cache lookups and token counting block, so keep them off the event loop
+            texts, keys, embeddings, batches = await asyncio.to_thread(self._plan_embeddings, texts)
+            await asyncio.gather(*(
+                self._afill_embeddings(embeddings, keys, texts, positions, tokens)
+                for positions, tokens in batches))
+        return embeddings
+    
+    def _plan_embeddings(self, texts):
+        """Look texts up in the embedding cache and pack the misses into requests.
+        
+        Returns (texts, keys, embeddings, batches): the truncated texts, their
+        cache keys, a list holding cached vectors and None for misses, and a
+        (positions, tokens) pair for each request needed to fill the misses.
+        """
         # Limit text length to avoid token limits
-        if len(text) > 8000:
-            text = text[:8000]
+        texts = [text[:8000] if len(text) > 8000 else text for text in texts]
+        keys = [EmbeddingCache.make_key(text, self.embedding_model) for text in texts]
+        embeddings = self.embedding_cache.get_many(keys)
+        
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        batches = []
+        batch = []
+        batch_tokens = 0
+        
+        for i in missing:
+            tokens = self._count_tokens(texts[i], self.embedding_model)
+            
+            if batch and (len(batch) >= self.embedding_batch_size or
+                          batch_tokens + tokens > self.embedding_batch_tokens):
+                batches.append((batch, batch_tokens))
+                batch = []
+                batch_tokens = 0
             
-        response = self.client.embeddings.create(
-            model="text-embedding-3-small",
-            input=text
-        )
-        return response.data[0].embedding
+            batch.append(i)
+            batch_tokens += tokens
+        
+        if batch:
+            batches.append((batch, batch_tokens))
+        
+        return texts, keys, embeddings, batches
+    
+    def _fill_embeddings(self, embeddings, keys, texts, positions, tokens=0):
+        """Embed the texts at the given positions and cache the results."""
+        vectors = self._request_embeddings([texts[i] for i in positions], tokens)
+        for i, vector in zip(positions, vectors):
+            embeddings[i] = vector
+        self.embedding_cache.put_many([keys[i] for i in positions], vectors)
+    
+    async def _afill_embeddings(self, embeddings, keys, texts, positions, tokens=0):
+        """Async counterpart of _fill_embeddings."""
+        batch = [texts[i] for i in positions]
+        response = await self._acall_openai(
+            lambda client: client.embeddings.create(model=self.embedding_model, input=batch),
+            tokens=tokens, stage='openai.embeddings')
+        self._record_usage(response.usage, self.embedding_model)
+        vectors = [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+        for i, vector in zip(positions, vectors):
+            embeddings[i] = vector
+        await asyncio.to_thread(self.embedding_cache.put_many, [keys[i] for i in positions], vectors)
+    
+    async def _acall_openai(self, func, tokens=0, stage='openai'):
+        """Await func(client) with the running loop's async client, under the quota and concurrency limit."""
+        async def call():
+            async with self._openai_limits.get():
+                return await func(self._async_clients.get())
+        return await self.rate_limiter.acall_openai(call, tokens=tokens, stage=stage)
+    
+    def _record_usage(self, usage, model):
+        """Count the tokens an OpenAI response reports having used."""
+        if usage is None:
+            return
+        metrics.increment('openai_tokens_total', getattr(usage, 'prompt_tokens', 0) or 0, model=model, type='prompt')
+        metrics.increment('openai_tokens_total', getattr(usage, 'completion_tokens', 0) or 0,
+                          model=model, type='completion')
+    
+    def _request_embeddings(self, batch, tokens=0):
+        """Send one embeddings request for a batch of texts."""
+        response = self.rate_limiter.call_openai(lambda: self.client.embeddings.create(
+            model=self.embedding_model,
+            input=batch
+        ), tokens=tokens, stage='openai.embeddings')
+        self._record_usage(response.usage, self.embedding_model)
+        # The API tags each vector with its input position
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+    
+    @staticmethod
+    def _load_encoding(model):
+        """Return the tiktoken encoding for model, or None if it can't be loaded."""
+        if tiktoken is None:
+            print(f"tiktoken is not installed, estimating {model} token counts instead")
+            return None
+        try:
+            return tiktoken.encoding_for_model(model)
+        except Exception as e:
+            # The encoding is downloaded on first use and may be unavailable offline
+            print(f"Could not load the {model} tokenizer, estimating token counts instead: {e}")
+            return None
+    
+    def _count_tokens(self, text, model=None):
+        """Count the tokens in text for model, the chat model by default, estimating without a tokenizer."""
+        encoding = self._encodings.get(model or self.chat_model)
+        if encoding is not None:
+            return len(encoding.encode(text, disallowed_special=()))
+        # Roughly three characters per token errs on the side of smaller batches
+        return len(text) // 3 + 1
+    
+    def _truncate_tokens(self, text, max_tokens):
+        """Cut text down to at most max_tokens tokens of the chat model."""
+        encoding = self._encodings.get(self.chat_model)
+        if encoding is not None:
+            return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+        return text[:max(0, max_tokens - 1) * 3]
+    
+    def _embed_documents(self, texts):
+        """Embed texts and return them as an L2-normalized float32 matrix."""
+        return self._normalized_matrix(self._get_embeddings(texts))
+    
+    async def _aembed_documents(self, texts):
+        """Async counterpart of _embed_documents."""
+        return await asyncio.to_thread(self._normalized_matrix, await self._aget_embeddings(texts))
+    
+    def _normalized_matrix(self, embeddings):
+        """Stack embeddings into an L2-normalized float32 matrix."""
+        embedding_array = np.array(embeddings, dtype=np.float32).reshape(-1, self.dimension)
+        faiss.normalize_L2(embedding_array)
+        return embedding_array
+    
+    def _new_index(self):
+        """Create an empty vector index of the configured type."""
+        return VectorIndex(
+            self.dimension, index_type=self.index_type, ann_threshold=self.ann_threshold,
+            quantization=self.quantization, search_dimension=self.search_dimension,
+            vectors_path=None if self.is_demo_mode else self.vectors_file)
     
     def _save_index(self):
-        """Save the FAISS index and email data to disk."""
-        # Save FAISS index
-        faiss.write_index(self.index, self.index_file)
+        """Save the FAISS index and email data to disk.
         
-        # Save email data
-        with open(self.emails_file, 'w') as f:
-            json.dump(self.emails, f)
+        While indexing_complete is False the saved state is a checkpoint of
+        an unfinished indexing run, which index_emails resumes.
+        """
+        with self._index_lock, metrics.timer('index.save'):
+            # Save FAISS index
+            self.index.save(self.index_file)
+            
+            # Email data is written as it is indexed; commit it together with the index
+            self.store.commit()
+            self.metadata.save(self.metadata_file)
+            
+            # Save the mailbox history ID the index is in sync with
+            with open(self.state_file, 'w') as f:
+                json.dump({
+                    'history_id': self.history_id,
+                    'next_doc_id': self.next_doc_id,
+                    'next_chunk_id': self.next_chunk_id,
+                    'indexing_complete': self.indexing_complete
+                }, f)
     
     def _load_index(self):
         """Load the FAISS index and email data from disk if they exist."""
-        if os.path.exists(self.index_file) and os.path.exists(self.emails_file):
+        if os.path.exists(self.index_file) and len(self.store) > 0:
             try:
-                self.index = faiss.read_index(self.index_file)
-                with open(self.emails_file, 'r') as f:
-                    self.emails = json.load(f)
+                self.index.load(self.index_file)
+                if os.path.exists(self.state_file):
+                    with open(self.state_file, 'r') as f:
+                        state = json.load(f)
+                    self.history_id = state.get('history_id')
+                    self.next_doc_id = state.get('next_doc_id', 0)
+                    self.next_chunk_id = state.get('next_chunk_id', 0)
+                    self.indexing_complete = state.get('indexing_complete', True)
+                self.next_doc_id = max(self.next_doc_id, self.store.max_doc_id() + 1)
+                self.next_chunk_id = max(self.next_chunk_id, self.store.max_chunk_id() + 1)
+                if os.path.exists(self.metadata_file):
+                    self.metadata.load(self.metadata_file)
+                if len(self.metadata) != len(self.store):
+                    self._rebuild_metadata()
+                for doc_id, sender, simhash in self.store.iter_fingerprints():
+                    self.near_duplicates.add(doc_id, {'sender': sender}, simhash)
                 return True
             except Exception as e:
                 print(f"Error loading index: {e}")
+                self.index = self._new_index()
+                self.store.clear()
+                self.metadata.clear()
+                self.near_duplicates.clear()
                 return False
         return False
     
-    def index_emails(self, limit=100, force_refresh=False):
-        """Index emails for vector search."""
-        if len(self.emails) > 0 and not force_refresh:
-            return len(self.emails)
+    def _rebuild_metadata(self):
+        """Rebuild the metadata arrays from the stored emails, without reading bodies."""
+        print("Rebuilding email metadata for search filters")
+        self.metadata.clear()
+        batch = []
+        for email in self.store.iter_emails():
+            batch.append(email)
+            if len(batch) >= 1000:
+                self.metadata.add([e['doc_id'] for e in batch], batch)
+                batch = []
+        self.metadata.add([e['doc_id'] for e in batch], batch)
+        owners = self.store.chunk_owners()
+        self.metadata.add_chunks([chunk_id for chunk_id, _ in owners], [doc_id for _, doc_id in owners])
+    
+    def index_emails(self, limit=100, force_refresh=False, progress=None, stop_event=None):
+        """Index emails for vector search.
+        
+        Pass limit=None to index every message in the mailbox. The index is
+        checkpointed to disk every checkpoint_every emails, or every
+        checkpoint_growth times the number indexed once that is more; if the
+        run is interrupted, the next call continues from the last checkpoint,
+        skipping messages that are already indexed.
+        
+        progress, an IndexingProgress, is updated as batches move through
+        the pipeline. Setting stop_event stops the run after the current
+        batch and leaves a checkpoint to resume from. Indexing runs and syncs
+        of one engine wait for each other.
+        """
+        with self._indexing_lock:
+            return self._index_emails(limit, force_refresh, progress, stop_event)
+    
+    def _index_emails(self, limit, force_refresh, progress, stop_event):
+        """Run index_emails; the caller holds the indexing lock."""
+        if not self._start_indexing(force_refresh):
+            return len(self.store)
+        
+        if self.indexing_complete:
+            # Record the mailbox position before fetching so that changes made
+            # while indexing are picked up by the next incremental sync
+            self.history_id = self.gmail_service.get_user_profile().get('historyId')
+            self.indexing_complete = False
+        
+        parse_workers = self.pipeline_workers['parse']
+        if self.gmail_service.parse_pool is not None:
+            # Parse threads only wait on the worker processes, so run enough to keep every process busy
+            parse_workers = max(parse_workers, self.gmail_service.parse_pool.processes)
+        
+        # Fetch, parse and embed concurrently; batches are appended here as they arrive
+        pipeline = IndexingPipeline(
+            self.gmail_service, self,
+            fetch_workers=self.pipeline_workers['fetch'],
+            parse_workers=parse_workers,
+            embed_workers=self.pipeline_workers['embed'],
+            queue_size=self.pipeline_queue_size,
+            progress=progress)
+        first_doc_id = self.next_doc_id
+        appended = set()
+        since_checkpoint = 0
+        batches = pipeline.run(limit=limit)
+        try:
+            for emails, chunks, embedding_array in batches:
+                appended.update(self._append_emails(emails, chunks, embedding_array))
+                if progress is not None:
+                    progress.add('indexed', len(emails))
+                since_checkpoint += len(emails)
+                if stop_event is not None and stop_event.is_set():
+                    print(f"Indexing stopped with {len(self.store)} emails indexed")
+                    break
+                if self._checkpoint_due(since_checkpoint):
+                    self._save_index()
+                    since_checkpoint = 0
+            else:
+                self.indexing_complete = True
+        finally:
+            # Whether stopped or failed, batches still in the pipeline are dropped
+            batches.close()
+            self._discard_unappended(
+                [doc_id for doc_id in range(first_doc_id, self.next_doc_id) if doc_id not in appended])
+        if self.indexing_complete:
+            self._report_index_quality()
+        self._report_duplicates()
+        
+        # Save index and data
+        self._save_index()
         
+        return len(self.store)
+    
+    def _checkpoint_due(self, since_checkpoint):
+        """Whether enough emails were indexed since the last checkpoint to save another."""
+        return since_checkpoint >= max(self.checkpoint_every, self.checkpoint_growth * len(self.store))
+    
+    def _report_index_quality(self):
+        """Measure how well a compressed index finds the true nearest neighbours."""
+        with self._index_lock:
+            self.index_quality = self.index.measure_recall(queries=self.query_embedding_cache.values() or None)
+        if self.index_quality is not None:
+            print(f"Vector index is {self.index_quality['compression']:.1f}x smaller than full precision "
+                  f"with recall@{self.index_quality['k']} of {self.index_quality['recall']:.3f}")
+    
+    def _discard_unappended(self, doc_ids):
+        """Forget emails that were given IDs but never appended when indexing stopped early or failed."""
+        if not doc_ids:
+            return
+        with self._index_lock:
+            self.near_duplicates.remove(doc_ids)
+            orphans = list(self.store.duplicates_of(doc_ids).values())
+        # Appended near-duplicates of a dropped email need a representative of their own
+        for members in orphans:
+            try:
+                self._promote_representative(members)
+            except Exception as e:
+                # Don't hide the error that stopped indexing; a full refresh re-embeds these
+                print(f"Error re-embedding near-duplicates {members}: {e}")
+    
+    def _start_indexing(self, force_refresh):
+        """Prepare for a full indexing run, returning False if there is nothing to index."""
         # Don't proceed if in demo mode or if Gmail service is not available
         if self.is_demo_mode or self.gmail_service is None:
-            return len(self.emails)
+            return False
+        
+        if len(self.store) > 0 and self.indexing_complete and not force_refresh:
+            return False
         
         # Clear existing index if forcing refresh
         if force_refresh:
-            self.index = faiss.IndexFlatL2(self.dimension)
-            self.emails = []
+            with self._index_lock, self._doc_id_lock:
+                # Start the vectors file and IDs over rather than growing past the old ones
+                if os.path.exists(self.vectors_file):
+                    os.remove(self.vectors_file)
+                self.index = self._new_index()
+                self.store.clear()
+                self.metadata.clear()
+                self.near_duplicates.clear()
+                self.answer_cache.clear()
+                self.next_doc_id = 0
+                self.next_chunk_id = 0
+            self.indexing_complete = True
+        elif not self.indexing_complete:
+            print(f"Resuming interrupted indexing with {len(self.store)} emails already indexed")
+        return True
+    
+    async def aindex_emails(self, limit=100, force_refresh=False, progress=None, stop_event=None):
+        """Async counterpart of index_emails.
         
-        # Fetch recent emails
-        raw_emails = self.gmail_service.get_recent_emails(count=limit)
+        Batches of message IDs are fetched and embedded concurrently, up to
+        pipeline_queue_size batches at a time, and appended to the index as
+        they complete. Database, tokenizer and index work runs in worker
+        threads, so the event loop stays free to serve queries meanwhile.
+        progress, stop_event, checkpointing and waiting for other runs work
+        as in index_emails.
+        """
+        # Poll rather than block a worker thread, so a cancelled wait never leaves the lock taken
+        while not self._indexing_lock.acquire(blocking=False):
+            await asyncio.sleep(0.1)
+        try:
+            return await self._aindex_emails(limit, force_refresh, progress, stop_event)
+        finally:
+            self._indexing_lock.release()
+    
+    async def _aindex_emails(self, limit, force_refresh, progress, stop_event):
+        """Run aindex_emails; the caller holds the indexing lock."""
+        if not await asyncio.to_thread(self._start_indexing, force_refresh):
+            return len(self.store)
+        
+        if self.indexing_complete:
+            self.history_id = (await self.gmail_service.aget_user_profile()).get('historyId')
+            self.indexing_complete = False
+        
+        def count(stage, number):
+            if progress is not None:
+                progress.add(stage, number)
+        
+        async def process(msg_ids):
+            # Messages indexed before an interrupted run stopped are skipped
+            known = await asyncio.to_thread(self.store.doc_ids_for, msg_ids)
+            msg_ids = [msg_id for msg_id in msg_ids if msg_id not in known]
+            if not msg_ids:
+                return None
+            emails = await self.gmail_service.afetch_emails(msg_ids)
+            count('fetched', len(msg_ids))
+            count('parsed', len(emails))
+            if not emails:
+                return None
+            chunks, embedding_array = await self._aembed_emails(emails)
+            count('embedded', len(emails))
+            return emails, chunks, embedding_array
+        
+        async def append_finished(tasks):
+            nonlocal since_checkpoint
+            for task in tasks:
+                result = task.result()
+                if result is not None:
+                    # Index updates are CPU-bound, so keep them off the event loop
+                    appended.update(await asyncio.to_thread(self._append_emails, *result))
+                    count('indexed', len(result[0]))
+                    since_checkpoint += len(result[0])
+            if self._checkpoint_due(since_checkpoint):
+                await asyncio.to_thread(self._save_index)
+                since_checkpoint = 0
         
-        # Process and index each email
-        for email in raw_emails:
-            # Create document for indexing
-            email_text = f"Subject: {email['subject']}\nFrom: {email['sender']}\nDate: {email['date']}\n\n{email['body_text']}"
+        def stopped():
+            return stop_event is not None and stop_event.is_set()
+        
+        first_doc_id = self.next_doc_id
+        appended = set()
+        since_checkpoint = 0
+        pending = set()
+        batch_ids = []
+        batch_size = self.gmail_service.MAX_BATCH_SIZE
+        try:
+            async for message in self.gmail_service.aiter_messages(max_results=limit):
+                batch_ids.append(message['id'])
+                if len(batch_ids) < batch_size:
+                    continue
+                pending.add(asyncio.create_task(process(batch_ids)))
+                batch_ids = []
+                if len(pending) >= self.pipeline_queue_size:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    await append_finished(done)
+                if stopped():
+                    break
+            else:
+                if batch_ids:
+                    pending.add(asyncio.create_task(process(batch_ids)))
+                while pending and not stopped():
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    await append_finished(done)
+                self.indexing_complete = not stopped()
+            if stopped():
+                print(f"Indexing stopped with {len(self.store)} emails indexed")
+        finally:
+            # Whether stopped or failed, batches still in flight are dropped
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            await asyncio.to_thread(self._discard_unappended, [
+                doc_id for doc_id in range(first_doc_id, self.next_doc_id) if doc_id not in appended])
+        if self.indexing_complete:
+            await asyncio.to_thread(self._report_index_quality)
+        self._report_duplicates()
+        
+        await asyncio.to_thread(self._save_index)
+        
+        return len(self.store)
+    
+    def sync_emails(self, limit=100, progress=None, stop_event=None):
+        """Bring the index up to date with the mailbox using Gmail history.
+        
+        Only messages added, deleted or relabelled since the last saved
+        history ID are applied. Falls back to a full re-index when no history
+        ID is known or Gmail no longer has history that far back; progress
+        and stop_event are passed on to it. Sessions sharing the engine sync
+        one at a time, and never while it is being indexed.
+        """
+        with self._indexing_lock:
+            return self._sync_emails(limit, progress, stop_event)
+    
+    def _sync_emails(self, limit, progress, stop_event):
+        """Apply mailbox history to the index; the caller holds the indexing lock."""
+        if self.is_demo_mode or self.gmail_service is None:
+            return len(self.store)
+        
+        if not self.history_id or len(self.store) == 0:
+            return self._index_emails(limit, True, progress, stop_event)
+        
+        if not self.indexing_complete:
+            # Finish the interrupted run first; its history ID predates it
+            self._index_emails(limit, False, progress, stop_event)
+            if not self.indexing_complete:
+                return len(self.store)
+        
+        # Read the current position first; replaying a change twice is harmless
+        latest_history_id = self.gmail_service.get_user_profile().get('historyId')
+        
+        added = set()
+        deleted = set()
+        label_changes = {}
+        try:
+            for record in self.gmail_service.iter_history(self.history_id):
+                changes = (
+                    [('added', item) for item in record.get('messagesAdded', [])] +
+                    [('deleted', item) for item in record.get('messagesDeleted', [])] +
+                    [('labels', item) for item in record.get('labelsAdded', [])] +
+                    [('restored', item) for item in record.get('labelsRemoved', [])]
+                )
+                for change, item in changes:
+                    msg_id = item['message']['id']
+                    labels = item['message'].get('labelIds', [])
+                    
+                    # Moving a message to spam or trash removes it from the
+                    # index, and taking it back out restores it
+                    if change == 'deleted' or self._is_excluded(labels):
+                        deleted.add(msg_id)
+                        added.discard(msg_id)
+                        label_changes.pop(msg_id, None)
+                    elif change == 'added' or (change == 'restored' and self._is_excluded(item.get('labelIds', []))):
+                        added.add(msg_id)
+                        deleted.discard(msg_id)
+                    else:
+                        label_changes[msg_id] = labels
+        except HttpError as e:
+            if e.resp.status == 404:
+                print("Stored history ID has expired, re-indexing all emails")
+                return self._index_emails(limit, True, progress, stop_event)
+            raise
+        
+        doc_ids = self.store.doc_ids_for(added | deleted | set(label_changes))
+        
+        for msg_id, labels in label_changes.items():
+            if msg_id in doc_ids:
+                self.store.update_labels(doc_ids[msg_id], labels)
+                self.metadata.update_labels(doc_ids[msg_id], labels)
+        if label_changes:
+            self.answer_cache.clear()
+        
+        self._remove_emails([doc_ids[msg_id] for msg_id in deleted if msg_id in doc_ids])
+        
+        new_ids = [msg_id for msg_id in added if msg_id not in doc_ids]
+        if new_ids:
+            emails = self.gmail_service._fetch_emails(new_ids)
+            self._add_emails(emails)
+            if progress is not None:
+                progress.add('fetched', len(new_ids))
+                for stage in ('parsed', 'embedded', 'indexed'):
+                    progress.add(stage, len(emails))
+        
+        print(f"Synced index: {len(new_ids)} added, {len(deleted)} deleted, {len(label_changes)} relabelled")
+        
+        self.history_id = latest_history_id
+        self._save_index()
+        
+        return len(self.store)
+    
+    def _is_excluded(self, labels):
+        """Check whether a message lives in spam or trash and should not be indexed."""
+        return 'SPAM' in labels or 'TRASH' in labels
+    
+    def _email_document(self, email, start=0, end=None):
+        """Build the text that is embedded for an email or one chunk of its body."""
+        body_text = email['body_text'][start:end]
+        return f"Subject: {email['subject']}\nFrom: {email['sender']}\nDate: {email['date']}\n\n{body_text}"
+    
+    def _chunk_spans(self, text):
+        """Split text into overlapping (start, end) spans of about chunk_size characters."""
+        if len(text) <= self.chunk_size:
+            return [(0, len(text))]
+        
+        spans = []
+        start = 0
+        while len(spans) < self.max_chunks_per_email:
+            end = min(len(text), start + self.chunk_size)
+            if end < len(text):
+                # Prefer to end a chunk between words
+                boundary = text.rfind(' ', start + self.chunk_size // 2, end)
+                if boundary != -1:
+                    end = boundary
+            spans.append((start, end))
+            if end >= len(text):
+                break
             
-            # Get embedding
-            embedding = self._get_embedding(email_text)
+            # Start the next chunk a little before this one ended, on a word
+            start = end - self.chunk_overlap
+            space = text.find(' ', start, end)
+            if space != -1:
+                start = space + 1
+        return spans
+    
+    def _embed_emails(self, emails):
+        """Embed every chunk of the given emails that is not a near-duplicate.
+        
+        Emails are first given IDs and checked against the near-duplicate
+        index. Returns (chunks, embedding_array) where chunks holds an
+        (email position, start, end) tuple for every chunk, and the array a
+        row for each chunk of an email without 'duplicate_of', in order.
+        """
+        self._assign_doc_ids(emails)
+        chunks, documents = self._email_chunks(emails)
+        return chunks, self._embed_documents(documents)
+    
+    async def _aembed_emails(self, emails):
+        """Async counterpart of _embed_emails; fingerprinting and chunking run in a worker thread."""
+        await asyncio.to_thread(self._assign_doc_ids, emails)
+        chunks, documents = await asyncio.to_thread(self._email_chunks, emails)
+        return chunks, await self._aembed_documents(documents)
+    
+    def _assign_doc_ids(self, emails):
+        """Give each email its 'doc_id' and record any near-duplicate it has under 'duplicate_of'.
+        
+        IDs are assigned before embedding so that emails in batches still
+        being embedded can already be matched as representatives.
+        """
+        with self._doc_id_lock:
+            for email in emails:
+                email['doc_id'] = self.next_doc_id
+                self.next_doc_id += 1
+        for email in emails:
+            email['simhash'] = self.near_duplicates.fingerprint(email)
+            email['duplicate_of'] = self.near_duplicates.find_or_add(email['doc_id'], email, email['simhash'])
+    
+    def _email_chunks(self, emails):
+        """Return (chunks, documents) for every chunk, with documents only for emails to embed."""
+        chunks = []
+        documents = []
+        for position, email in enumerate(emails):
+            for start, end in self._chunk_spans(email['body_text']):
+                chunks.append((position, start, end))
+                if email.get('duplicate_of') is None:
+                    documents.append(self._email_document(email, start, end))
+        return chunks, documents
+    
+    def _report_duplicates(self):
+        """Print how many emails were stored as near-duplicates instead of being embedded."""
+        stats = self.near_duplicates.stats()
+        if stats['checked']:
+            print(f"Skipped embedding {stats['duplicates']} near-duplicate emails "
+                  f"({stats['dedup_ratio']:.0%} of {stats['checked']} fingerprinted)")
+    
+    def _add_emails(self, emails):
+        """Embed emails and append them to the index and email data.
+        
+        emails may be any iterable, including a generator; it is consumed in
+        batches so each batch costs one embedding pass and one index.add call.
+        """
+        batch = []
+        for email in emails:
+            batch.append(email)
+            if len(batch) >= self.embedding_batch_size:
+                self._add_email_batch(batch)
+                batch = []
+        
+        if batch:
+            self._add_email_batch(batch)
+    
+    def _add_email_batch(self, emails):
+        """Embed a list of emails together and add them to the index."""
+        appended = set()
+        try:
+            chunks, embedding_array = self._embed_emails(emails)
+            appended = self._append_emails(emails, chunks, embedding_array)
+        finally:
+            # The batch's IDs may already be near-duplicate representatives
+            self._discard_unappended(
+                [email['doc_id'] for email in emails if 'doc_id' in email and email['doc_id'] not in appended])
+    
+    def _append_emails(self, emails, chunks, embedding_array):
+        """Add embedded email chunks to the index and the email data.
+        
+        Chunks of near-duplicates are stored for full-text search but get
+        no vectors. Messages that are already stored, for example by a sync
+        that ran meanwhile, keep their existing ID and are not added again.
+        Returns the IDs of the emails that were added.
+        """
+        with self._index_lock:
+            stored = self.store.doc_ids_for([email['id'] for email in emails])
+            if stored:
+                emails, chunks, embedding_array = self._skip_stored(emails, chunks, embedding_array, stored)
+            doc_ids = [email['doc_id'] for email in emails]
+            embedded = np.array(
+                [emails[position].get('duplicate_of') is None for position, _, _ in chunks], dtype=bool)
             
-            # Add to FAISS index
-            embedding_array = np.array([embedding], dtype=np.float32)
-            faiss.normalize_L2(embedding_array)
-            self.index.add(embedding_array)
+            chunk_ids = np.arange(self.next_chunk_id, self.next_chunk_id + len(chunks), dtype=np.int64)
+            self.next_chunk_id += len(chunks)
+            with metrics.timer('index.add'):
+                self.index.add(embedding_array, chunk_ids[embedded])
             
             # Store email data without HTML content to save space
-            email_data = {
-                'id': email['id'],
-                'thread_id': email['thread_id'],
-                'subject': email['subject'],
-                'sender': email['sender'],
-                'date': email['date'],
-                'snippet': email['snippet'],
-                'body_text': email['body_text'],
-                'labels': email['labels']
-            }
-            self.emails.append(email_data)
+            self.store.add_many(doc_ids, emails)
+            self.store.add_chunks([
+                (chunk_id, doc_ids[position], start, end)
+                for chunk_id, (position, start, end) in zip(chunk_ids.tolist(), chunks)
+            ])
+            self.metadata.add(doc_ids, emails)
+            self.metadata.add_chunks(chunk_ids, [doc_ids[position] for position, _, _ in chunks])
+            # Cached answers may no longer reflect the mailbox
+            self.answer_cache.clear()
+        metrics.increment('emails_indexed_total', len(emails))
+        return set(doc_ids)
+    
+    def _skip_stored(self, emails, chunks, embedding_array, stored):
+        """Drop emails whose message is already stored from a batch about to be appended.
         
-        # Save index and data
-        self._save_index()
+        Emails in the batch that were matched as near-duplicates of a dropped
+        email are pointed at the stored copy's representative instead.
+        Returns the remaining (emails, chunks, embedding_array).
+        """
+        existing = {email['doc_id']: email for email in self.store.get_many(list(stored.values()))}
+        replacements = {}
+        for email in emails:
+            if email['id'] in stored:
+                kept = existing[stored[email['id']]]
+                replacements[email['doc_id']] = kept['duplicate_of'] if kept['duplicate_of'] is not None else kept['doc_id']
+        self.near_duplicates.remove(list(replacements))
+        
+        keep = [email['id'] not in stored for email in emails]
+        positions = np.cumsum(keep) - 1
+        rows = [keep[position] for position, _, _ in chunks if emails[position].get('duplicate_of') is None]
+        chunks = [(int(positions[position]), start, end) for position, start, end in chunks if keep[position]]
+        emails = [email for email, kept in zip(emails, keep) if kept]
+        for email in emails:
+            if email.get('duplicate_of') in replacements:
+                email['duplicate_of'] = replacements[email['duplicate_of']]
+        return emails, chunks, embedding_array[np.array(rows, dtype=bool)]
+    
+    def _remove_emails(self, doc_ids):
+        """Remove emails with the given IDs from the index and email data."""
+        if not doc_ids:
+            return
         
-        return len(self.emails)
+        with self._index_lock:
+            self.index.remove(np.array(self.store.chunk_ids_for(doc_ids), dtype=np.int64))
+            # Near-duplicates of a removed representative need new vectors to stand in for them
+            removed = set(doc_ids)
+            orphans = [
+                [doc_id for doc_id in members if doc_id not in removed]
+                for members in self.store.duplicates_of(doc_ids).values()
+            ]
+            self.store.remove_many(doc_ids)
+            self.metadata.remove(doc_ids)
+            self.near_duplicates.remove(doc_ids)
+            self.answer_cache.clear()
+        for members in orphans:
+            if members:
+                self._promote_representative(members)
+        if self.index.needs_compaction:
+            self._compact_index()
+    
+    def _compact_index(self):
+        """Rebuild the vector index without its removed vectors.
+        
+        Only the snapshot and the swap hold the index lock, so queries and
+        indexing carry on while the new graph is built.
+        """
+        with self._index_lock:
+            index = self.index
+            snapshot = index.begin_compaction()
+        compacted = index.build_compacted(snapshot)
+        with self._index_lock:
+            if self.index is index:
+                index.finish_compaction(snapshot, compacted)
+    
+    def _promote_representative(self, members):
+        """Embed the first of a group of near-duplicates and make it the others' representative.
+        
+        The embedding call is made before taking the index lock, so it must
+        not be held by the caller. If the email was removed or promoted
+        meanwhile, nothing changes.
+        """
+        representative, others = members[0], members[1:]
+        emails = self.store.get_many([representative], with_body=True)
+        if not emails:
+            return
+        email = emails[0]
+        spans = self.store.get_chunks(self.store.chunk_ids_for([representative]))
+        chunk_ids = sorted(spans)
+        embedding_array = self._embed_documents(
+            [self._email_document(email, spans[chunk_id][1], spans[chunk_id][2]) for chunk_id in chunk_ids])
+        
+        with self._index_lock:
+            if not self.store.doc_ids_for([email['id']]) or self.metadata.representative(representative) == representative:
+                return
+            self.index.add(embedding_array, np.array(chunk_ids, dtype=np.int64))
+            self.store.set_duplicate_of([representative], None)
+            self.store.set_duplicate_of(others, representative)
+            self.metadata.set_duplicate_of([representative], None)
+            self.metadata.set_duplicate_of(others, representative)
+            self.near_duplicates.add(representative, email, self.near_duplicates.fingerprint(email))
     
     def _create_index_from_samples(self, sample_emails):
         """Create FAISS index from sample emails for demo mode."""
         # Clear any existing index
-        self.index = faiss.IndexFlatL2(self.dimension)
+        with self._index_lock:
+            self.index = self._new_index()
+            self.store.clear()
+            self.metadata.clear()
+            self.near_duplicates.clear()
         
-        # Process and index each sample email
-        for email in sample_emails:
-            # Create document for indexing
-            email_text = f"Subject: {email['subject']}\nFrom: {email['sender']}\nDate: {email['date']}\n\n{email['body_text']}"
-            
-            # Get embedding
-            embedding = self._get_embedding(email_text)
-            
-            # Add to FAISS index
-            embedding_array = np.array([embedding], dtype=np.float32)
-            faiss.normalize_L2(embedding_array)
-            self.index.add(embedding_array)
+        # Embed all sample emails together and add them in one call
+        if sample_emails:
+            self._add_email_batch(sample_emails)
         
         return len(sample_emails)
     
-    def _search_similar_emails(self, query, top_k=5):
-        """Search for emails similar to the query."""
-        query_embedding = self._get_embedding(query)
-        query_embedding_normalized = np.array([query_embedding], dtype=np.float32)
-        faiss.normalize_L2(query_embedding_normalized)
+    def _query_filter(self, user_query):
+        """The metadata filter for the dates, labels or sender in a question, or None."""
+        params = extract_query_parameters(user_query)
+        # Indexing adds domains and labels to the metadata under the index lock
+        with self._index_lock:
+            return self.metadata.filter_for(params)
+    
+    def _search_similar_emails(self, query, top_k=5, query_filter=None):
+        """Search for emails similar to the query.
+        
+        Dense vector hits and BM25 full-text hits are fused by reciprocal
+        rank. Queries containing identifiers such as order numbers or
+        confirmation codes that appear verbatim in the mailbox are answered
+        from the full-text index alone, without an embedding call.
         
-        # Search the index
-        D, I = self.index.search(query_embedding_normalized, top_k)
+        query_filter, from MetadataIndex.filter_for, restricts both searches
+        to matching emails before ranking. When no email matches it, the
+        whole mailbox is searched instead.
         
-        # Get the corresponding emails
-        results = []
-        for idx in I[0]:
-            if idx < len(self.emails) and idx >= 0:
-                results.append(self.emails[idx])
+        Chunk hits are collapsed to unique emails in rank order, with one
+        email per near-duplicate group: the member whose own text matched
+        the query best, or the representative when none did. Each email
+        carries its matching body spans, best first, under 'passages' as
+        (start, end, rank) where rank is the chunk's position in the fused
+        ranking across all emails.
+        """
+        # Fetch extra chunks since several may belong to the same email
+        candidates = top_k * 4
         
-        return results
+        with self._index_lock:
+            chunk_mask = self.metadata.chunk_mask(query_filter) if query_filter else None
+            if chunk_mask is not None and not chunk_mask.any():
+                print(f"No emails match filter {query_filter}, searching all emails")
+                chunk_mask = None
+            
+            exact_match = build_match_query(exact_tokens(query))
+            exact_hits = self._lexical_search(exact_match, candidates, chunk_mask) if exact_match else []
+        
+        # Only embed when the identifiers aren't found, and not while holding the index lock
+        embedding = None if exact_hits else self._query_embedding(query)
+        
+        with self._index_lock:
+            lexical_hits = self._lexical_search(build_match_query(tokenize(query)), candidates, chunk_mask)
+            
+            if exact_hits:
+                # Verbatim identifier matches first, then the rest of the lexical ranking
+                chunk_ids = exact_hits + [chunk_id for chunk_id in lexical_hits if chunk_id not in exact_hits]
+            else:
+                chunk_ids = reciprocal_rank_fusion(
+                    [self._vector_search(embedding, candidates, chunk_mask), lexical_hits])
+            
+            owners = self.store.get_chunks(chunk_ids)
+            doc_mask = self.metadata.doc_mask(query_filter) if chunk_mask is not None else None
+            
+            # The best full-text hit in each near-duplicate group; only representatives
+            # have vectors, so a member matched by its own text must not be hidden by one
+            lexical_best = {}
+            for chunk_id in exact_hits + lexical_hits:
+                if chunk_id in owners:
+                    lexical_best.setdefault(self.metadata.representative(owners[chunk_id][0]), chunk_id)
+            
+            passages = {}
+            groups = set()
+            taken = set()
+            for rank, chunk_id in enumerate(chunk_ids):
+                if chunk_id not in owners or chunk_id in taken:
+                    continue
+                doc_id, start, end = owners[chunk_id]
+                if doc_mask is not None and not doc_mask[doc_id]:
+                    # A representative reached through a near-duplicate that matches the filter
+                    member = self.metadata.newest_member(doc_id, doc_mask)
+                    if member is None:
+                        continue
+                    doc_id, start, end = self._closest_span(member, start)
+                if doc_id not in passages:
+                    # Near-duplicates of an email already in the results add nothing
+                    group = self.metadata.representative(doc_id)
+                    if group in groups or len(passages) >= top_k:
+                        continue
+                    groups.add(group)
+                    best = lexical_best.get(group)
+                    if best is not None and owners[best][0] != doc_id:
+                        # The group's vectors found it, but another member matches the query text better
+                        chunk_id = best
+                        doc_id, start, end = owners[best]
+                    passages[doc_id] = []
+                taken.add(chunk_id)
+                passages[doc_id].append((start, end, rank))
+            
+            # Get the corresponding email metadata
+            results = self.store.get_many(list(passages))
+            for email in results:
+                email['passages'] = passages[email['doc_id']]
+            return results
+    
+    def _closest_span(self, doc_id, start):
+        """Return (doc_id, start, end) for the chunk of an email starting nearest to start."""
+        spans = self.store.get_chunks(self.store.chunk_ids_for([doc_id])).values()
+        _, span_start, span_end = min(spans, key=lambda span: abs(span[1] - start))
+        return doc_id, span_start, span_end
+    
+    def _vector_search(self, embedding, k, chunk_mask=None):
+        """Return the IDs of the k chunks whose embeddings are closest to a query embedding.
+        
+        chunk_mask optionally limits the search to chunk IDs set in it.
+        """
+        D, I = self.index.search(embedding[np.newaxis], k, id_mask=chunk_mask)
+        
+        # Missing results come back as -1
+        return [chunk_id for chunk_id in I[0].tolist() if chunk_id >= 0]
+    
+    def _query_embedding(self, query):
+        """Return the L2-normalized embedding of a query, from the LRU cache when possible."""
+        embedding = self.query_embedding_cache.get(query)
+        if embedding is None:
+            embedding = self._embed_documents([query])[0]
+            self.query_embedding_cache.put(query, embedding)
+        return embedding
+    
+    async def _aquery_embedding(self, query):
+        """Async counterpart of _query_embedding."""
+        embedding = self.query_embedding_cache.get(query)
+        if embedding is None:
+            embedding = (await self._aembed_documents([query]))[0]
+            self.query_embedding_cache.put(query, embedding)
+        return embedding
+    
+    def _lexical_search(self, match_query, k, chunk_mask=None):
+        """Return the IDs of the k chunks ranked best by BM25 for an FTS5 query.
+        
+        chunk_mask optionally limits the search to chunk IDs set in it.
+        """
+        if not match_query:
+            return []
+        if chunk_mask is None:
+            return [chunk_id for chunk_id, score in self.store.search_text(match_query, k)]
+        
+        allowed = np.flatnonzero(chunk_mask)
+        if len(allowed) <= 2000:
+            # A small subset is cheapest to rank directly in SQLite
+            return [chunk_id for chunk_id, score in self.store.search_text(match_query, k, allowed.tolist())]
+        # Otherwise rank over everything and keep the matches that pass the filter
+        hits = self.store.search_text(match_query, k * 10)
+        return [chunk_id for chunk_id, score in hits if chunk_id < len(chunk_mask) and chunk_mask[chunk_id]][:k]
     
     def query(self, user_query):
         """Process a natural language query about emails."""
+        return ''.join(value for kind, value in self.query_stream(user_query) if kind == 'token')
+    
+    def query_stream(self, user_query):
+        """Answer a natural language query about emails, yielding the answer as it is generated.
+        
+        Yields ('sources', emails) once retrieval is done, with the metadata
+        of the emails the answer is based on, followed by ('token', text)
+        pieces of the answer as they arrive. When there is nothing to search
+        or nothing relevant is found, the explanation is yielded as a single
+        token and no sources are sent.
+        """
         # Check if we have indexed emails
-        if len(self.emails) == 0:
-            return "No emails have been indexed yet. Please refresh the email index."
+        if len(self.store) == 0:
+            yield ('token', "No emails have been indexed yet. Please refresh the email index.")
+            return
         
-        # Search for relevant emails
-        relevant_emails = self._search_similar_emails(user_query)
+        # Search for relevant emails, narrowed by any dates, labels or sender in the question
+        with metrics.timer('query.retrieve'):
+            query_filter = self._query_filter(user_query)
+            relevant_emails = self._search_similar_emails(user_query, query_filter=query_filter)
         
         if not relevant_emails:
-            return "I couldn't find any relevant emails for your query."
+            yield ('token', "I couldn't find any relevant emails for your query.")
+            return
         
-        # Prepare context from relevant emails
-        context = "Here are the most relevant emails for your query:\n\n"
-        for i, email in enumerate(relevant_emails):
-            context += f"EMAIL {i+1}:\n"
-            context += f"Subject: {email['subject']}\n"
-            context += f"From: {email['sender']}\n"
-            context += f"Date: {email['date']}\n"
-            context += f"Snippet: {email['snippet']}\n"
-            
-            # Add truncated body if it's not too long
-            body_preview = email['body_text'][:500] + "..." if len(email['body_text']) > 500 else email['body_text']
-            context += f"Body: {body_preview}\n\n"
+        yield ('sources', relevant_emails)
+        
+        # Reuse the answer to an earlier question that meant the same thing and
+        # found the same emails; identifier lookups never embed the question
+        # and only match the identical text
+        query_embedding = self.query_embedding_cache.peek(user_query)
+        doc_ids = [email['doc_id'] for email in relevant_emails]
+        cached_answer = self.answer_cache.get(user_query, query_embedding, doc_ids)
+        if cached_answer is not None:
+            yield ('token', cached_answer)
+            return
         
         # Generate response with OpenAI
-        # the newest OpenAI model is "gpt-4o" which was released May 13, 2024.
-        # do not change this unless explicitly requested by the user
-        response = self.client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": (
-                    "You are an AI assistant specializing in helping users navigate their Gmail inbox. "
-                    "Answer the user's question based only on the provided email context. "
-                    "If you can't answer based on the provided emails, explain why and suggest "
-                    "how they might refine their query. Be concise, helpful, and direct. "
-                    "Don't reference yourself as an AI or mention the context beyond answering the query."
-                )},
-                {"role": "user", "content": f"Here is my question about my emails:\n{user_query}\n\nContext from my emails:\n{context}"}
-            ],
+        generate_start = time.perf_counter()
+        messages = self._build_messages(user_query, relevant_emails)
+        # Only opening the stream is retried; an error part way through is raised
+        stream = self.rate_limiter.call_openai(lambda: self.client.chat.completions.create(
+            model=self.chat_model,
+            messages=messages,
             temperature=0.3,
-            max_tokens=800
-        )
+            max_tokens=800,
+            stream=True,
+            # The last chunk then reports the tokens used
+            stream_options={'include_usage': True}
+        ), tokens=self._request_tokens(messages), stage='openai.chat')
+        
+        parts = []
+        for chunk in stream:
+            if getattr(chunk, 'usage', None) is not None:
+                self._record_usage(chunk.usage, self.chat_model)
+            if not chunk.choices:
+                continue
+            text = chunk.choices[0].delta.content
+            if text:
+                parts.append(text)
+                yield ('token', text)
+        # Timed by hand since the stream is read across yields
+        metrics.observe('stage_seconds', time.perf_counter() - generate_start, stage='query.generate')
+        
+        self.answer_cache.put(user_query, query_embedding, doc_ids, ''.join(parts))
+    
+    async def aquery(self, user_query):
+        """Async counterpart of query.
+        
+        The question embedding and answer use the async OpenAI client, and
+        local search runs in a worker thread, so many queries can be served
+        concurrently from one event loop.
+        """
+        if len(self.store) == 0:
+            return "No emails have been indexed yet. Please refresh the email index."
+        
+        # Embed up front so retrieval finds the embedding cached and makes no
+        # blocking call; identifier lookups may not need an embedding at all
+        if not exact_tokens(user_query):
+            await self._aquery_embedding(user_query)
+        with metrics.timer('query.retrieve'):
+            # The filter waits on the index lock while a batch is appended, so keep it off the event loop
+            query_filter = await asyncio.to_thread(self._query_filter, user_query)
+            relevant_emails = await asyncio.to_thread(
+                self._search_similar_emails, user_query, query_filter=query_filter)
+        
+        if not relevant_emails:
+            return "I couldn't find any relevant emails for your query."
+        
+        query_embedding = self.query_embedding_cache.peek(user_query)
+        doc_ids = [email['doc_id'] for email in relevant_emails]
+        cached_answer = self.answer_cache.get(user_query, query_embedding, doc_ids)
+        if cached_answer is not None:
+            return cached_answer
+        
+        with metrics.timer('query.generate'):
+            messages = await asyncio.to_thread(self._build_messages, user_query, relevant_emails)
+            response = await self._acall_openai(lambda client: client.chat.completions.create(
+                model=self.chat_model,
+                messages=messages,
+                temperature=0.3,
+                max_tokens=800
+            ), tokens=self._request_tokens(messages), stage='openai.chat')
+        self._record_usage(response.usage, self.chat_model)
         
-        return response.choices[0].message.content
+        answer = response.choices[0].message.content
+        self.answer_cache.put(user_query, query_embedding, doc_ids, answer)
+        return answer
+    
+    def memory_usage(self):
+        """Approximate number of bytes the engine holds in memory.
+        
+        Covers the vector index, the metadata arrays, the near-duplicate
+        tables and the cached question embeddings; email data lives in
+        SQLite on disk.
+        """
+        with self._index_lock:
+            usage = self.index.memory_usage() + self.metadata.memory_usage() + self.near_duplicates.memory_usage()
+        return usage + (len(self.query_embedding_cache) + len(self.answer_cache)) * self.dimension * 4
+    
+    def close(self):
+        """Release the email database connection; the engine can't be used afterwards.
+        
+        The shared embedding cache stays open for other engines.
+        """
+        with self._index_lock:
+            self.store.close()
+        self.embedding_cache.flush()
+    
+    async def aclose(self):
+        """Close the running event loop's async OpenAI client."""
+        client = self._async_clients.pop()
+        if client is not None:
+            await client.close()
+    
+    def _build_messages(self, user_query, relevant_emails):
+        """Build the chat messages asking the model to answer from the relevant emails."""
+        # Bodies are only loaded for the emails that go into the prompt
+        bodies = self.store.get_bodies([email['doc_id'] for email in relevant_emails])
+        
+        # Quote the best passages that fit the token budget, merging messages from the same thread
+        context, _ = self.context_builder.build(relevant_emails, bodies)
+        
+        messages = [
+            {"role": "system", "content": (
+                "You are an AI assistant specializing in helping users navigate their Gmail inbox. "
+                "Answer the user's question based only on the provided email context. "
+                "If you can't answer based on the provided emails, explain why and suggest "
+                "how they might refine their query. Be concise, helpful, and direct. "
+                "Don't reference yourself as an AI or mention the context beyond answering the query."
+            )},
+            {"role": "user", "content": f"Here is my question about my emails:\n{user_query}\n\nContext from my emails:\n{context}"}
+        ]
+        return messages
+    
+    def _request_tokens(self, messages):
+        """Quota to reserve for a chat request: the prompt plus the longest possible answer."""
+        return sum(self._count_tokens(message["content"]) for message in messages) + 800
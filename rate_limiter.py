@@ -0,0 +1,205 @@
+import asyncio
+import random
+import threading
+import time
+from metrics import metrics
+
+# Gmail API quota units charged per call, from the Gmail usage limits page
+GMAIL_QUOTA_UNITS = {
+    'getProfile': 1,
+    'labels.list': 1,
+    'history.list': 2,
+    'messages.list': 5,
+    'messages.get': 5,
+}
+
+# HTTP statuses that indicate a temporary failure worth retrying
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        """Initialize a token bucket refilled at rate tokens per second.
+        
+        Requests larger than the bucket are allowed to borrow against future
+        refills, so one large batch call waits in proportion to its cost
+        instead of being rejected.
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def acquire(self, amount=1):
+        """Take amount tokens, sleeping until the bucket can cover them."""
+        wait = self.reserve(amount)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+    
+    def reserve(self, amount=1):
+        """Take amount tokens and return how many seconds to wait before using them."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+class RateLimiter:
+    def __init__(self, gmail_units_per_second=250, openai_requests_per_minute=3000,
+                 openai_tokens_per_minute=1000000, max_retries=5, base_delay=1.0, max_delay=32.0):
+        """Initialize quota buckets for the Gmail and OpenAI APIs.
+        
+        Gmail is limited in quota units per second per user; OpenAI in
+        requests and tokens per minute. The defaults match Gmail's per-user
+        limit and a typical OpenAI usage tier and can be lowered to leave
+        headroom for other clients of the same quota.
+        """
+        self.gmail = TokenBucket(gmail_units_per_second)
+        self.openai_requests = TokenBucket(openai_requests_per_minute / 60.0, openai_requests_per_minute / 60.0)
+        self.openai_tokens = TokenBucket(openai_tokens_per_minute / 60.0, openai_tokens_per_minute / 60.0)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+    
+    def acquire_gmail(self, method, calls=1):
+        """Wait until the Gmail quota can cover calls to method."""
+        wait = self.reserve_gmail(method, calls)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+    
+    def reserve_gmail(self, method, calls=1):
+        """Charge calls to method against the Gmail quota and return how long to wait first."""
+        units = GMAIL_QUOTA_UNITS.get(method, 5) * calls
+        metrics.increment('gmail_quota_units_total', units, method=method)
+        wait = self.gmail.reserve(units)
+        metrics.increment('rate_limit_wait_seconds_total', wait, api='gmail')
+        return wait
+    
+    def acquire_openai(self, tokens=0):
+        """Wait until the OpenAI quota can cover one request of tokens tokens."""
+        waited = self.openai_requests.acquire(1)
+        if tokens:
+            waited += self.openai_tokens.acquire(tokens)
+        metrics.increment('rate_limit_wait_seconds_total', waited, api='openai')
+        return waited
+    
+    def backoff_delay(self, attempt, error=None):
+        """Return how long to sleep before retry number attempt.
+        
+        Uses the server's Retry-After hint when one is given, and otherwise
+        exponential backoff with full jitter.
+        """
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+    
+    def call_gmail(self, method, func, calls=1, stage=None):
+        """Call func under the Gmail quota, retrying temporary failures.
+        
+        Each attempt is timed as stage, by default 'gmail.' followed by method.
+        """
+        return self._call_with_retry(lambda: self.acquire_gmail(method, calls), func, stage or f"gmail.{method}")
+    
+    def call_openai(self, func, tokens=0, stage='openai'):
+        """Call func under the OpenAI quota, retrying temporary failures; attempts are timed as stage."""
+        return self._call_with_retry(lambda: self.acquire_openai(tokens), func, stage)
+    
+    async def acall_gmail(self, method, func, calls=1, stage=None):
+        """Await func() under the Gmail quota, retrying temporary failures.
+        
+        Waits for quota and backoff with asyncio.sleep, so other coroutines
+        keep running on the event loop meanwhile.
+        """
+        return await self._acall_with_retry(
+            lambda: self.reserve_gmail(method, calls), func, stage or f"gmail.{method}")
+    
+    async def acall_openai(self, func, tokens=0, stage='openai'):
+        """Await func() under the OpenAI quota, retrying temporary failures."""
+        def reserve():
+            wait = self.openai_requests.reserve(1)
+            if tokens:
+                wait = max(wait, self.openai_tokens.reserve(tokens))
+            metrics.increment('rate_limit_wait_seconds_total', wait, api='openai')
+            return wait
+        return await self._acall_with_retry(reserve, func, stage)
+    
+    def _call_with_retry(self, acquire, func, stage):
+        """Acquire quota and call func, backing off and retrying on retryable errors."""
+        for attempt in range(self.max_retries + 1):
+            acquire()
+            try:
+                with metrics.timer(stage):
+                    return func()
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable(e):
+                    raise
+                metrics.increment('api_retries_total', stage=stage)
+                delay = self.backoff_delay(attempt, e)
+                print(f"Retrying after {type(e).__name__} in {delay:.1f}s (attempt {attempt + 1} of {self.max_retries})")
+                time.sleep(delay)
+    
+    async def _acall_with_retry(self, reserve, func, stage):
+        """Async counterpart of _call_with_retry; reserve returns the quota wait in seconds."""
+        for attempt in range(self.max_retries + 1):
+            wait = reserve()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                with metrics.timer(stage):
+                    return await func()
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable(e):
+                    raise
+                metrics.increment('api_retries_total', stage=stage)
+                delay = self.backoff_delay(attempt, e)
+                print(f"Retrying after {type(e).__name__} in {delay:.1f}s (attempt {attempt + 1} of {self.max_retries})")
+                await asyncio.sleep(delay)
+
+def error_status(error):
+    """Return the HTTP status code carried by a Gmail or OpenAI error, if any."""
+    # googleapiclient.errors.HttpError
+    resp = getattr(error, 'resp', None)
+    if resp is not None and getattr(resp, 'status', None) is not None:
+        return int(resp.status)
+    # openai.APIStatusError
+    status = getattr(error, 'status_code', None)
+    if status is not None:
+        return int(status)
+    # httpx.HTTPStatusError from the async Gmail transport
+    status = getattr(getattr(error, 'response', None), 'status_code', None)
+    return int(status) if status is not None else None
+
+def is_retryable(error):
+    """Check whether an API error is temporary and the call should be retried."""
+    status = error_status(error)
+    if status in RETRYABLE_STATUSES:
+        return True
+    if status == 403:
+        # Gmail reports per-user rate limits as 403 with a rate limit reason
+        return 'rateLimitExceeded' in str(error) or 'userRateLimitExceeded' in str(error)
+    if status is None:
+        # Connection failures and timeouts from either client carry no status
+        return type(error).__name__ in ('APIConnectionError', 'APITimeoutError', 'TimeoutError',
+                                        'ConnectionError', 'ConnectionResetError', 'ConnectError',
+                                        'ReadTimeout', 'ConnectTimeout', 'RemoteProtocolError')
+    return False
+
+def _retry_after(error):
+    """Read a Retry-After header from an API error, in seconds."""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or getattr(error, 'resp', None)
+    if not headers:
+        return None
+    try:
+        value = headers.get('retry-after')
+        return float(value) if value is not None else None
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+# Limiter shared by every GmailService and RAGEngine in the process, so
+# concurrent sessions and pipeline workers draw from the same quota
+shared_rate_limiter = RateLimiter()
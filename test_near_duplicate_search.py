@@ -0,0 +1,58 @@
+import hashlib
+import types
+import numpy as np
+import pytest
+
+from rag_engine import RAGEngine
+
+class FakeEmbeddings:
+    """Stands in for the OpenAI embeddings API with a fixed random vector per text."""
+    def create(self, model, input, **kwargs):
+        data = []
+        for position, text in enumerate(input):
+            seed = int(hashlib.md5(text.encode('utf-8')).hexdigest()[:8], 16)
+            embedding = np.random.default_rng(seed).standard_normal(1536).astype(np.float32)
+            data.append(types.SimpleNamespace(embedding=embedding.tolist(), index=position))
+        return types.SimpleNamespace(data=data, usage=types.SimpleNamespace(total_tokens=10 * len(input)))
+
+def receipt(order_number, day):
+    body = (f"Thank you for shopping with us. This is the order confirmation for order {order_number}. "
+            f"Your parcel has been handed to the carrier and the tracking number for order {order_number} "
+            "is included below. You can follow its progress online at any time and we will let you "
+            "know as soon as it has been delivered to your address.")
+    return {
+        'id': f"receipt-{order_number}",
+        'thread_id': f"receipt-{order_number}",
+        'subject': "Your order confirmation",
+        'sender': "orders@shop.example.com",
+        'date': f"Mon, {day:02d} Jun 2025 09:00:00",
+        'snippet': body[:100],
+        'body_text': body,
+        'labels': ['INBOX'],
+    }
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('OPENAI_API_KEY', 'test-key')
+    engine = RAGEngine()
+    engine.client = types.SimpleNamespace(embeddings=FakeEmbeddings())
+    yield engine
+    engine.close()
+
+def test_member_matched_by_text_is_not_collapsed_into_representative(engine):
+    engine._create_index_from_samples([receipt(111, 2), receipt(222, 3), receipt(333, 4)])
+    representative = engine.store.doc_ids_for(['receipt-111'])['receipt-111']
+    member = engine.store.doc_ids_for(['receipt-222'])['receipt-222']
+    assert engine.metadata.representative(member) == representative
+
+    results = engine._search_similar_emails("order confirmation tracking 222", top_k=1)
+
+    assert [email['id'] for email in results] == ['receipt-222']
+
+def test_group_is_still_returned_once(engine):
+    engine._create_index_from_samples([receipt(111, 2), receipt(222, 3), receipt(333, 4)])
+
+    results = engine._search_similar_emails("order confirmation tracking 222", top_k=5)
+
+    assert [email['id'] for email in results] == ['receipt-222']
@@ -1,4 +1,5 @@
 import os
+import re
 import streamlit as st
 import json
 from datetime import datetime, timedelta
@@ -157,6 +158,12 @@ def extract_query_parameters(query):
     elif "this month" in query or "last month" in query:
         params["time_period"] = 30
     
+    # Check for a sender, as in "emails from amazon" or "from my boss"
+    # Shorter terms, such as a stray letter, would match part of almost any sender
+    sender_match = re.search(r"\bfrom (?:my |the )?([a-z0-9][a-z0-9._@-]{2,})", query)
+    if sender_match and sender_match.group(1) not in ("today", "yesterday", "this", "last"):
+        params["sender"] = sender_match.group(1)
+    
     # Check for attachment mentions
     if any(word in query for word in ["attachment", "file", "document", "attached"]):
         params["has_attachment"] = True
@@ -0,0 +1,527 @@
+import math
+import os
+import faiss
+import numpy as np
+
+INDEX_TYPES = ('flat', 'ivf', 'hnsw', 'auto')
+
+# Compressed encodings for the vectors inside the primary index
+QUANTIZATIONS = (None, 'fp16', 'sq8', 'pq')
+
+# Vectors needed before each encoding can be trained; PQ runs k-means with 256 centroids
+QUANTIZATION_TRAIN_SIZE = {'fp16': 0, 'sq8': 1000, 'pq': 39 * 256}
+
+# Training runs on at most this many vectors, since k-means time grows with them
+MAX_TRAINING_VECTORS = 20000
+
+class FullPrecisionVectors:
+    def __init__(self, dimension, path=None):
+        """Initialize a table of full-precision vectors stored by integer ID.
+        
+        With a path, rows live in a memory-mapped file, so they occupy the
+        page cache only while being read instead of the process heap.
+        Without one they are kept in an in-memory array.
+        """
+        self.dimension = dimension
+        self.path = path
+        self._array = np.zeros((0, dimension), dtype=np.float32)
+        if path is not None and os.path.exists(path):
+            rows = os.path.getsize(path) // (dimension * 4)
+            if rows:
+                self._array = np.memmap(path, dtype=np.float32, mode='r+', shape=(rows, dimension))
+    
+    def put(self, ids, vectors):
+        """Store vectors under the given IDs, overwriting any previous ones."""
+        if len(ids) == 0:
+            return
+        self._reserve(int(ids.max()) + 1)
+        self._array[ids] = vectors
+    
+    def __len__(self):
+        """Number of rows in the table; IDs at or past it have no vector stored."""
+        return len(self._array)
+    
+    def get(self, ids):
+        """Return the vectors stored under the given IDs as an in-memory array."""
+        return np.array(self._array[ids], dtype=np.float32)
+    
+    def memory_usage(self):
+        """Bytes held on the heap; a memory-mapped file holds none."""
+        return 0 if isinstance(self._array, np.memmap) else self._array.nbytes
+    
+    def flush(self):
+        """Write memory-mapped rows through to disk."""
+        if isinstance(self._array, np.memmap):
+            self._array.flush()
+    
+    def _reserve(self, rows):
+        """Grow the table to at least rows rows, doubling to keep growth amortized."""
+        if rows <= len(self._array):
+            return
+        capacity = max(rows, 2 * len(self._array), 1024)
+        if self.path is None:
+            array = np.zeros((capacity, self.dimension), dtype=np.float32)
+            array[:len(self._array)] = self._array
+            self._array = array
+            return
+        
+        self.flush()
+        self._array = None
+        with open(self.path, 'ab') as f:
+            f.truncate(capacity * self.dimension * 4)
+        self._array = np.memmap(self.path, dtype=np.float32, mode='r+', shape=(capacity, self.dimension))
+
+class VectorIndex:
+    def __init__(self, dimension, index_type='auto', ann_threshold=20000, hnsw_m=32,
+                 hnsw_ef_search=64, ivf_nprobe=16, quantization=None, search_dimension=None,
+                 vectors_path=None, rerank_factor=4, compaction_threshold=0.2):
+        """Initialize an ID-mapped FAISS index of the configured type.
+        
+        Vectors are stored under caller-supplied int64 IDs, so results can be
+        mapped back to emails and single emails can be removed.
+        
+        index_type is one of:
+        - 'flat': exact brute-force search at any size
+        - 'hnsw': HNSW graph from the start
+        - 'ivf': exact search until there are enough vectors to train an
+          inverted file index, then IVF
+        - 'auto': exact search up to ann_threshold vectors, then HNSW
+        
+        quantization compresses the vectors held in the index: 'fp16' halves
+        them, 'sq8' stores one byte per dimension and 'pq' a quarter byte.
+        search_dimension keeps only the leading dimensions of each vector,
+        renormalized, which text-embedding-3 models are trained to allow.
+        Either one keeps the full-precision vectors in a separate table,
+        memory-mapped from vectors_path when given, and re-ranks the top
+        k * rerank_factor candidates against them. Encodings that need
+        training are used once enough vectors have been added.
+        
+        HNSW graphs can't delete vectors, so removed IDs are tombstoned and
+        skipped at search time until they make up compaction_threshold of
+        the index, when needs_compaction asks for the graph to be rebuilt.
+        """
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"Unknown index type '{index_type}', expected one of {INDEX_TYPES}")
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization '{quantization}', expected one of {QUANTIZATIONS}")
+        
+        self.dimension = dimension
+        self.index_type = index_type
+        self.ann_threshold = ann_threshold
+        self.hnsw_m = hnsw_m
+        self.hnsw_ef_search = hnsw_ef_search
+        self.ivf_nprobe = ivf_nprobe
+        self.quantization = quantization
+        self.search_dimension = min(search_dimension or dimension, dimension)
+        self.rerank_factor = rerank_factor
+        self.compaction_threshold = compaction_threshold
+        self.tombstones = set()
+        self.pq_m = self._pq_subquantizers(self.search_dimension)
+        self.full_vectors = None
+        if quantization is not None or self.search_dimension < dimension:
+            self.full_vectors = FullPrecisionVectors(dimension, vectors_path)
+        self.index = self._new_index('hnsw' if index_type == 'hnsw' else 'flat')
+    
+    @property
+    def ntotal(self):
+        """Number of vectors in the index, not counting tombstoned ones."""
+        return self.index.ntotal - len(self.tombstones)
+    
+    @property
+    def needs_compaction(self):
+        """Whether enough removed IDs are tombstoned that the graph should be rebuilt."""
+        return len(self.tombstones) > self.compaction_threshold * max(1, self.index.ntotal)
+    
+    @property
+    def kind(self):
+        """The structure currently backing the index: 'flat', 'ivf' or 'hnsw'."""
+        inner = faiss.downcast_index(self.index.index) if isinstance(self.index, faiss.IndexIDMap) else self.index
+        if isinstance(inner, faiss.IndexHNSW):
+            return 'hnsw'
+        if isinstance(inner, faiss.IndexIVF):
+            return 'ivf'
+        return 'flat'
+    
+    @property
+    def quantized(self):
+        """Whether the index currently stores compressed vectors."""
+        inner = faiss.downcast_index(self.index.index)
+        if isinstance(inner, faiss.IndexHNSW):
+            return not isinstance(faiss.downcast_index(inner.storage), faiss.IndexFlat)
+        if isinstance(inner, faiss.IndexIVF):
+            return not isinstance(inner, faiss.IndexIVFFlat)
+        return not isinstance(inner, faiss.IndexFlat)
+    
+    def memory_usage(self):
+        """Approximate number of bytes the index holds in memory."""
+        n = self.index.ntotal
+        # Encoded vectors, plus the ID map's forward array and reverse hash map
+        usage = n * (self._code_size() + 40)
+        kind = self.kind
+        if kind == 'hnsw':
+            # Neighbour lists: 2 * M links on the base layer, a few more on upper layers
+            usage += n * (self.hnsw_m * 2 + 4) * 4
+        elif kind == 'ivf':
+            inner = faiss.downcast_index(self.index.index)
+            usage += n * 8 + inner.nlist * self.search_dimension * 4
+        if self.full_vectors is not None:
+            usage += self.full_vectors.memory_usage()
+        return usage
+    
+    def add(self, vectors, ids):
+        """Add vectors under the given int64 IDs."""
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        ids = np.ascontiguousarray(ids, dtype=np.int64)
+        if len(ids) == 0:
+            return
+        if self.full_vectors is not None:
+            self.full_vectors.put(ids, vectors)
+        self.index.add_with_ids(self._project(vectors), ids)
+        self._maybe_convert()
+    
+    def remove(self, ids):
+        """Remove the vectors stored under the given IDs."""
+        ids = np.ascontiguousarray(ids, dtype=np.int64)
+        if len(ids) == 0 or self.ntotal == 0:
+            return
+        if self.kind == 'hnsw':
+            # HNSW graphs do not support deletion, so hide the IDs until the next compaction
+            stored = faiss.vector_to_array(self.index.id_map)
+            self.tombstones.update(ids[np.isin(ids, stored)].tolist())
+        else:
+            self.index.remove_ids(ids)
+    
+    def begin_compaction(self):
+        """Snapshot the live vectors for build_compacted; call while no other thread changes the index."""
+        all_ids = faiss.vector_to_array(self.index.id_map).astype(np.int64)
+        ids, vectors = self.reconstruct_all()
+        return {'index': self.index, 'all_ids': all_ids, 'tombstones': set(self.tombstones),
+                'ids': ids, 'vectors': vectors}
+    
+    def build_compacted(self, snapshot):
+        """Build a graph holding only the snapshot's live vectors.
+        
+        Reads nothing but the snapshot, so it can run while other threads
+        search and change the index.
+        """
+        return self._build('hnsw', snapshot['ids'], snapshot['vectors'])
+    
+    def finish_compaction(self, snapshot, compacted):
+        """Swap in a compacted graph, replaying changes made since the snapshot.
+        
+        Returns False, leaving the index as it is, if the index was replaced
+        in the meantime.
+        """
+        if self.index is not snapshot['index']:
+            return False
+        added = np.setdiff1d(faiss.vector_to_array(self.index.id_map).astype(np.int64), snapshot['all_ids'])
+        if len(added):
+            if self.full_vectors is not None:
+                vectors = self._project(self.full_vectors.get(added))
+            else:
+                vectors = np.vstack([self.index.reconstruct(int(i)) for i in added])
+            compacted.add_with_ids(vectors, added)
+        self.index = compacted
+        self.tombstones = self.tombstones - snapshot['tombstones']
+        return True
+    
+    def search(self, vectors, k, id_mask=None):
+        """Search for the k nearest vectors, returning distances and IDs.
+        
+        id_mask is an optional boolean array indexed by ID; only vectors whose
+        ID is set in it are considered. Approximate indexes widen their search
+        in proportion to how few IDs are allowed, so a selective filter still
+        finds k results. Compressed or reduced indexes return candidates
+        re-ranked by their exact distance to the full-precision vectors.
+        """
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if self.full_vectors is None:
+            return self._search_index(vectors, k, id_mask)
+        _, candidates = self._search_index(self._project(vectors), k * self.rerank_factor, id_mask)
+        return self._rerank(vectors, candidates, k)
+    
+    def measure_recall(self, queries=None, k=10, sample_size=50, seed=0):
+        """Estimate how many of the exact k nearest neighbours search finds.
+        
+        Results are compared with brute-force search over the full-precision
+        vectors. queries defaults to a sample of stored vectors, each of
+        which is left out of its own results. Returns recall with and without
+        re-ranking, and how much smaller each vector is in the index than at
+        full precision; None if the index keeps no full-precision vectors or
+        is empty.
+        """
+        if self.full_vectors is None or self.ntotal == 0:
+            return None
+        
+        ids = faiss.vector_to_array(self.index.id_map).astype(np.int64)
+        if self.tombstones:
+            ids = ids[~np.isin(ids, list(self.tombstones))]
+        exclude = None
+        if queries is None:
+            exclude = np.random.default_rng(seed).choice(ids, size=min(sample_size, len(ids)), replace=False)
+            queries = self.full_vectors.get(exclude)
+        queries = np.ascontiguousarray(queries, dtype=np.float32).reshape(-1, self.dimension)
+        # One extra result per query stands in for the excluded query vector itself
+        fetch = k + 1 if exclude is not None else k
+        
+        # Exact neighbours, scanning the stored vectors a block at a time
+        best_distances = np.full((len(queries), 0), np.inf, dtype=np.float32)
+        best_ids = np.zeros((len(queries), 0), dtype=np.int64)
+        for start in range(0, len(ids), 10000):
+            block_ids = ids[start:start + 10000]
+            distances = self._squared_distances(queries, self.full_vectors.get(block_ids))
+            best_distances = np.concatenate([best_distances, distances], axis=1)
+            best_ids = np.concatenate([best_ids, np.broadcast_to(block_ids, distances.shape)], axis=1)
+            keep = np.argsort(best_distances, axis=1)[:, :fetch]
+            best_distances = np.take_along_axis(best_distances, keep, axis=1)
+            best_ids = np.take_along_axis(best_ids, keep, axis=1)
+        
+        _, reranked = self.search(queries, fetch)
+        _, unreranked = self._search_index(self._project(queries), fetch)
+        
+        def recall(found):
+            hits = total = 0
+            for row in range(len(queries)):
+                own = exclude[row] if exclude is not None else None
+                truth = [i for i in best_ids[row].tolist() if i != own][:k]
+                results = set(i for i in found[row].tolist() if i != own and i >= 0)
+                hits += len(results.intersection(truth))
+                total += len(truth)
+            return hits / total if total else 1.0
+        
+        return {
+            'recall': recall(reranked),
+            'recall_without_rerank': recall(unreranked),
+            'k': k,
+            'queries': len(queries),
+            'bytes_per_vector': self._code_size(),
+            'compression': self.dimension * 4 / self._code_size(),
+            'memory_mb': self.memory_usage() / (1024 * 1024)
+        }
+    
+    def reconstruct_all(self):
+        """Return every live ID along with its vector, at full precision if it is kept."""
+        ids = faiss.vector_to_array(self.index.id_map).astype(np.int64)
+        live = ~np.isin(ids, list(self.tombstones)) if self.tombstones else slice(None)
+        if self.full_vectors is not None:
+            return ids[live], self.full_vectors.get(ids[live])
+        inner = faiss.downcast_index(self.index.index)
+        if inner.ntotal == 0:
+            return ids, np.zeros((0, self.dimension), dtype=np.float32)
+        if isinstance(inner, faiss.IndexIVF):
+            # IVF can only reconstruct through a direct map, which blocks removals
+            inner.make_direct_map(True)
+            try:
+                return ids[live], inner.reconstruct_n(0, inner.ntotal)[live]
+            finally:
+                inner.make_direct_map(False)
+        return ids[live], inner.reconstruct_n(0, inner.ntotal)[live]
+    
+    def save(self, path):
+        """Write the index to disk, with its tombstoned IDs alongside it."""
+        faiss.write_index(self.index, path)
+        tombstones_path = f"{path}.tombstones.npy"
+        if self.tombstones:
+            np.save(tombstones_path, np.array(sorted(self.tombstones), dtype=np.int64))
+        elif os.path.exists(tombstones_path):
+            os.remove(tombstones_path)
+        if self.full_vectors is not None:
+            self.full_vectors.flush()
+    
+    def load(self, path):
+        """Read an index previously written by save."""
+        index = faiss.read_index(path)
+        if not isinstance(index, faiss.IndexIDMap):
+            raise ValueError(f"{path} does not contain an ID-mapped index; rebuild the email index")
+        if index.d != self.search_dimension:
+            raise ValueError(f"{path} holds {index.d}-dimensional vectors, expected {self.search_dimension}; "
+                             "rebuild the email index")
+        inner = faiss.downcast_index(index.index)
+        if self.full_vectors is not None and index.ntotal:
+            # An index saved before quantization was turned on has no full-precision vectors to rerank with
+            ids = faiss.vector_to_array(index.id_map).astype(np.int64)
+            if int(ids.max()) >= len(self.full_vectors):
+                if not isinstance(inner, faiss.IndexFlat) or index.d != self.dimension:
+                    raise ValueError(f"{path} has no full-precision vectors alongside it; rebuild the email index")
+                self.full_vectors.put(ids, inner.reconstruct_n(0, inner.ntotal))
+                self.full_vectors.flush()
+        tombstones = set()
+        if os.path.exists(f"{path}.tombstones.npy"):
+            tombstones = set(np.load(f"{path}.tombstones.npy").tolist())
+        self.index = index
+        self.tombstones = tombstones
+        self._configure(inner)
+    
+    def _search_index(self, vectors, k, id_mask=None):
+        """Search the FAISS index itself, whatever precision it stores."""
+        if id_mask is None and not self.tombstones:
+            return self.index.search(vectors, k)
+        
+        # The ID map translates the selector from stored IDs to internal positions
+        if id_mask is None:
+            tombstones = np.array(sorted(self.tombstones), dtype=np.int64)
+            excluded = faiss.IDSelectorBatch(len(tombstones), faiss.swig_ptr(tombstones))
+            selector = faiss.IDSelectorNot(excluded)
+            widen = self.index.ntotal / max(1, self.ntotal)
+        else:
+            if self.tombstones:
+                id_mask = np.array(id_mask, dtype=bool)
+                tombstones = np.array([i for i in self.tombstones if i < len(id_mask)], dtype=np.int64)
+                id_mask[tombstones] = False
+            bitmap = np.packbits(np.asarray(id_mask, dtype=bool), bitorder='little')
+            selector = faiss.IDSelectorBitmap(len(bitmap), faiss.swig_ptr(bitmap))
+            widen = self.index.ntotal / max(1, int(np.count_nonzero(id_mask)))
+        inner = faiss.downcast_index(self.index.index)
+        if isinstance(inner, faiss.IndexHNSW):
+            ef_search = int(min(1024, max(k, self.hnsw_ef_search * widen)))
+            params = faiss.SearchParametersHNSW(sel=selector, efSearch=ef_search)
+        elif isinstance(inner, faiss.IndexIVF):
+            nprobe = int(min(inner.nlist, max(1, self.ivf_nprobe * widen)))
+            params = faiss.SearchParametersIVF(sel=selector, nprobe=nprobe)
+        elif isinstance(inner, faiss.IndexPQ):
+            # IndexPQ takes no search parameters, so over-fetch and drop disallowed IDs
+            distances, ids = self.index.search(vectors, int(min(self.index.ntotal, max(k, 2 * k * widen))))
+            allowed = (ids >= 0) & (ids < len(id_mask))
+            allowed[allowed] = np.asarray(id_mask, dtype=bool)[ids[allowed]]
+            kept_distances = np.full((len(vectors), k), np.inf, dtype=np.float32)
+            kept_ids = np.full((len(vectors), k), -1, dtype=np.int64)
+            for row in range(len(vectors)):
+                keep = np.flatnonzero(allowed[row])[:k]
+                kept_distances[row, :len(keep)] = distances[row, keep]
+                kept_ids[row, :len(keep)] = ids[row, keep]
+            return kept_distances, kept_ids
+        else:
+            params = faiss.SearchParameters(sel=selector)
+        return self.index.search(vectors, k, params=params)
+    
+    def _rerank(self, vectors, candidates, k):
+        """Order each query's candidate IDs by exact distance to their full-precision vectors."""
+        distances = np.full((len(vectors), k), np.inf, dtype=np.float32)
+        ids = np.full((len(vectors), k), -1, dtype=np.int64)
+        for row, (vector, candidate_ids) in enumerate(zip(vectors, candidates)):
+            candidate_ids = candidate_ids[candidate_ids >= 0]
+            if len(candidate_ids) == 0:
+                continue
+            exact = self._squared_distances(vector[np.newaxis], self.full_vectors.get(candidate_ids))[0]
+            order = np.argsort(exact)[:k]
+            distances[row, :len(order)] = exact[order]
+            ids[row, :len(order)] = candidate_ids[order]
+        return distances, ids
+    
+    @staticmethod
+    def _squared_distances(queries, vectors):
+        """Squared L2 distances between every query and every vector."""
+        return (np.einsum('ij,ij->i', queries, queries)[:, np.newaxis]
+                - 2 * queries @ vectors.T
+                + np.einsum('ij,ij->i', vectors, vectors)[np.newaxis, :])
+    
+    def _project(self, vectors):
+        """Keep the leading search_dimension dimensions of each vector, renormalized."""
+        if self.search_dimension == self.dimension:
+            return vectors
+        reduced = np.ascontiguousarray(vectors[:, :self.search_dimension])
+        norms = np.linalg.norm(reduced, axis=1, keepdims=True)
+        return reduced / np.where(norms > 0, norms, 1)
+    
+    def _code_size(self):
+        """Bytes each vector takes inside the index."""
+        if not self.quantized:
+            return self.search_dimension * 4
+        return {'fp16': self.search_dimension * 2, 'sq8': self.search_dimension, 'pq': self.pq_m}[self.quantization]
+    
+    @staticmethod
+    def _pq_subquantizers(dimension):
+        """Number of PQ sub-vectors: one byte per four dimensions, as long as it divides the dimension."""
+        m = max(1, dimension // 4)
+        while dimension % m:
+            m -= 1
+        return m
+    
+    def _new_index(self, kind, training_vectors=None):
+        """Create an empty ID-mapped index of the given kind.
+        
+        The configured quantization is used when training_vectors has enough
+        vectors to train it, or when it needs no training.
+        """
+        d = self.search_dimension
+        n = 0 if training_vectors is None else len(training_vectors)
+        quantize = self.quantization is not None and n >= QUANTIZATION_TRAIN_SIZE[self.quantization]
+        qtype = faiss.ScalarQuantizer.QT_fp16 if self.quantization == 'fp16' else faiss.ScalarQuantizer.QT_8bit
+        if kind == 'hnsw':
+            if not quantize:
+                inner = faiss.IndexHNSWFlat(d, self.hnsw_m)
+            elif self.quantization == 'pq':
+                inner = faiss.IndexHNSWPQ(d, self.pq_m, self.hnsw_m)
+            else:
+                inner = faiss.IndexHNSWSQ(d, qtype, self.hnsw_m)
+            inner.hnsw.efConstruction = 80
+        elif kind == 'ivf':
+            quantizer = faiss.IndexFlatL2(d)
+            nlist = self._ivf_nlist(n)
+            if not quantize:
+                inner = faiss.IndexIVFFlat(quantizer, d, nlist)
+            elif self.quantization == 'pq':
+                inner = faiss.IndexIVFPQ(quantizer, d, nlist, self.pq_m, 8)
+            else:
+                inner = faiss.IndexIVFScalarQuantizer(quantizer, d, nlist, qtype)
+        else:
+            if not quantize:
+                inner = faiss.IndexFlatL2(d)
+            elif self.quantization == 'pq':
+                inner = faiss.IndexPQ(d, self.pq_m, 8)
+            else:
+                inner = faiss.IndexScalarQuantizer(d, qtype)
+        if not inner.is_trained:
+            # IVF still gets its 39 points per list
+            limit = max(MAX_TRAINING_VECTORS, 39 * inner.nlist) if kind == 'ivf' else MAX_TRAINING_VECTORS
+            if n > limit:
+                sample = np.random.default_rng(0).choice(n, size=limit, replace=False)
+                training_vectors = training_vectors[np.sort(sample)]
+            inner.train(training_vectors)
+        self._configure(inner)
+        # The Python wrappers keep inner and quantizer alive alongside the ID map
+        return faiss.IndexIDMap2(inner)
+    
+    def _build(self, kind, ids, vectors):
+        """Create an index of the given kind holding the given full vectors."""
+        projected = self._project(vectors)
+        index = self._new_index(kind, training_vectors=projected)
+        if len(ids):
+            index.add_with_ids(projected, ids)
+        return index
+    
+    def _rebuild(self, kind, ids, vectors):
+        """Replace the index with a new one of the given kind holding the given live vectors."""
+        self.index = self._build(kind, ids, vectors)
+        self.tombstones = set()
+    
+    def _ivf_nlist(self, n):
+        """Number of IVF lists for n vectors; about 4 * sqrt(n) is the usual starting point."""
+        return max(1, int(4 * math.sqrt(n)))
+    
+    def _configure(self, inner):
+        """Apply search-time parameters to a freshly created or loaded index."""
+        if isinstance(inner, faiss.IndexHNSW):
+            inner.hnsw.efSearch = self.hnsw_ef_search
+        elif isinstance(inner, faiss.IndexIVF):
+            inner.nprobe = self.ivf_nprobe
+    
+    def _maybe_convert(self):
+        """Switch to an approximate or compressed index once there are enough vectors for it."""
+        kind = self.kind
+        target = kind
+        if kind == 'flat' and self.index_type != 'flat':
+            if self.index_type == 'ivf':
+                # FAISS wants about 39 training points per list
+                if self.ntotal >= max(self.ann_threshold, 39 * self._ivf_nlist(self.ntotal)):
+                    target = 'ivf'
+            elif self.ntotal >= self.ann_threshold:
+                target = 'hnsw'
+        quantize = (self.quantization is not None and not self.quantized
+                    and self.ntotal >= QUANTIZATION_TRAIN_SIZE[self.quantization])
+        if target == kind and not quantize:
+            return
+        
+        description = f"{target.upper()} ({self.quantization})" if self.quantization else target.upper()
+        print(f"Converting vector index to {description} at {self.ntotal} vectors")
+        self._rebuild(target, *self.reconstruct_all())